@@ -0,0 +1,216 @@
+import argparse
+import pathlib
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from benchmark_utils import benchmark
+from fixtures import FIXTURES, make_fixtures
+
+# Runs every dataset entry point against synthetic fixtures, so the benchmarks need
+# neither the real archives nor network access. HMDB51 (rar) and LSUN (lmdb) are not
+# covered, since their archives cannot be written without the proprietary or native
+# tools.
+
+Benchmark = Tuple[Callable[[], Any], Tuple[str, ...]]
+
+
+def _caltech101(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from caltech101.main import caltech101, caltech101_meta
+
+    benchmarks: List[Benchmark] = [
+        (lambda: caltech101(root, image_decoder=None), ("no image decoding",)),
+        (lambda: caltech101_meta(root), ("meta",)),
+    ]
+    if decode:
+        benchmarks.append((lambda: caltech101(root), ()))
+    return benchmarks
+
+
+def _caltech256(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from caltech256.main import caltech256, caltech256_meta
+
+    benchmarks: List[Benchmark] = [
+        (lambda: caltech256(root, handler=None), ("no image decoding",)),
+        (lambda: caltech256_meta(root), ("meta",)),
+        (lambda: caltech256_meta(root, probe=True), ("meta", "probe")),
+    ]
+    if decode:
+        benchmarks.append((lambda: caltech256(root), ()))
+    return benchmarks
+
+
+def _celeba(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from celeba.main import celeba
+
+    benchmarks: List[Benchmark] = [
+        (lambda: celeba(root, split="all", decoder=None), ("no image decoding",)),
+    ]
+    if decode:
+        benchmarks.append((lambda: celeba(root, split="all"), ()))
+    return benchmarks
+
+
+def _cifar(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from cifar.main import CIFAR10, CIFAR100
+
+    # the images are always converted to PIL images
+    if not decode:
+        return []
+
+    return [
+        (lambda: CIFAR10(root), ("CIFAR10",)),
+        (lambda: CIFAR100(root), ("CIFAR100",)),
+    ]
+
+
+def _coco(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from coco.main import coco, coco_meta
+
+    images = root / "train2014.zip"
+    annotations = root / "annotations.zip"
+    benchmarks: List[Benchmark] = [
+        (lambda: coco(images, annotations, decoder=None), ("no image decoding",)),
+        (lambda: coco_meta(images, annotations), ("meta",)),
+        (lambda: coco_meta(images, annotations, probe=True), ("meta", "probe")),
+    ]
+    if decode:
+        benchmarks.append((lambda: coco(images, annotations), ()))
+    return benchmarks
+
+
+def _imagenet(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from imagenet.main import ImageNet
+
+    benchmarks: List[Benchmark] = []
+    for split in ("train", "val"):
+        benchmarks.extend(
+            [
+                (
+                    lambda split=split: ImageNet(root, split=split, decoder=None),
+                    (split, "no image decoding"),
+                ),
+                (
+                    lambda split=split: ImageNet(root, split=split).metadata(
+                        probe=True
+                    ),
+                    (split, "meta", "probe"),
+                ),
+            ]
+        )
+        if decode:
+            benchmarks.append(
+                (lambda split=split: ImageNet(root, split=split), (split,))
+            )
+    return benchmarks
+
+
+def _voc(root: pathlib.Path, decode: bool) -> List[Benchmark]:
+    from voc.alternative import VOC as VOCSemiDP
+    from voc.main import VOC
+
+    benchmarks: List[Benchmark] = []
+    for target_type in ("detection", "segmentation"):
+        for cls, name in ((VOC, "VOCFullDP"), (VOCSemiDP, "VOCSemiDP")):
+            benchmarks.append(
+                (
+                    lambda cls=cls, target_type=target_type: cls(
+                        root, target_type=target_type, decoder=None
+                    ),
+                    (name, target_type, "no image decoding"),
+                )
+            )
+            if decode:
+                benchmarks.append(
+                    (
+                        lambda cls=cls, target_type=target_type: cls(
+                            root, target_type=target_type
+                        ),
+                        (name, target_type),
+                    )
+                )
+    benchmarks.append(
+        (lambda: VOC(root).metadata(probe=True), ("VOCFullDP", "meta", "probe"))
+    )
+    return benchmarks
+
+
+_BENCHMARKS: Dict[str, Callable[[pathlib.Path, bool], List[Benchmark]]] = {
+    "caltech101": _caltech101,
+    "caltech256": _caltech256,
+    "celeba": _celeba,
+    "cifar": _cifar,
+    "coco": _coco,
+    "imagenet": _imagenet,
+    "voc": _voc,
+}
+
+
+def _can_decode() -> bool:
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return False
+    else:
+        return True
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the datasets against synthetic fixtures."
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help=f"Datasets to benchmark out of {', '.join(FIXTURES)}. Defaults to all.",
+    )
+    parser.add_argument(
+        "--root",
+        type=pathlib.Path,
+        help=(
+            "Directory of the fixtures. Existing fixtures are reused, so the same "
+            "archives can be benchmarked across revisions. "
+            "Defaults to a temporary directory."
+        ),
+    )
+    parser.add_argument("--num-samples", type=int, default=1000)
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        nargs=2,
+        metavar=("HEIGHT", "WIDTH"),
+        help="Defaults to the typical size of the images of each dataset.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    names = args.names or list(FIXTURES)
+    unknown = set(names).difference(FIXTURES)
+    if unknown:
+        parser.error(f"Unknown datasets {', '.join(sorted(unknown))}")
+
+    decode = _can_decode()
+    if not decode:
+        print("PIL is not installed. Skipping all benchmarks that decode images.")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root or pathlib.Path(tmp)
+        for name in names:
+            if not (root / name).exists():
+                try:
+                    make_fixtures(
+                        root,
+                        names=[name],
+                        num_samples=args.num_samples,
+                        image_size=tuple(args.image_size) if args.image_size else None,
+                        seed=args.seed,
+                    )
+                except ImportError as error:
+                    print(f"Skipping {name}, since {error.name} is not installed.")
+                    continue
+
+            for constructor, descriptors in _BENCHMARKS[name](root / name, decode):
+                benchmark(constructor, name, *descriptors, n=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,39 @@
 import pathlib
-import sys
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.utils.data.datapipes as dp
-
+from torch.utils.data import IterDataPipe
 from torch.utils.data.datapipes.utils.decoder import imagehandler
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import Drop, mathandler, DependentGroupByKey
+from utils import (
+    DropByPath,
+    mathandler,
+    DependentGroupByKey,
+    MemberPath,
+    MemberRef,
+    ReadFilesFromArchive,
+    Resumable,
+    Sample,
+    member_path,
+    optimize,
+)
 
 
-def _images_drop_condition(data: Tuple[str, Any]) -> bool:
-    return pathlib.Path(data[0]).parent.name == "BACKGROUND_Google"
+def _is_background(path: MemberPath) -> bool:
+    return path.parents[0] == "BACKGROUND_Google"
 
 
 def _images_key_fn(data: Tuple[str, Any]) -> Tuple[str, int]:
-    path = pathlib.Path(data[0])
-
-    cls = path.parent.name
-    idx = int(path.stem.split("_")[1])
-
-    return cls, idx
+    path = member_path(data[0])
+    return path.parents[0], path.idx
 
 
 CLASS_MAP = {
     "Faces_2": "Faces",
     "Faces_3": "Faces_easy",
-    "Motorbikes": "Motorbikes_16",
-    "airplanes": "Airplanes_Side_2",
+    "Motorbikes_16": "Motorbikes",
+    "Airplanes_Side_2": "airplanes",
 }
 
 
@@ -44,50 +49,101 @@ def _collate_ann(data: Tuple[str, Dict[str, Any]]):
     return key, data
 
 
-def _collate_sample(data: List[Tuple[str, Any]]):
-    image_path, image = image_data = data[0]
+class Caltech101Sample(Sample):
+    __slots__ = ("image_path", "image", "ann_path", "cls", "obj_contour")
+
+    def __init__(
+        self, image_path: str, image: Any, ann_path: str, cls: str, obj_contour: Any
+    ) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.ann_path = ann_path
+        self.cls = cls
+        self.obj_contour = obj_contour
+
+
+def _collate_sample(data: List[Tuple[str, Any]]) -> Caltech101Sample:
+    image_path, image = data[0]
     _, (ann_path, ann) = data[1]
 
-    cls, _ = _images_key_fn(image_data)
-    obj_contour = torch.from_numpy(ann["obj_contour"])
-    return dict(
-        image_path=image_path,
-        image=image,
-        ann_path=ann_path,
-        cls=cls,
-        obj_contour=obj_contour,
+    return Caltech101Sample(
+        image_path,
+        image,
+        ann_path,
+        member_path(image_path).parents[0],
+        torch.from_numpy(ann["obj_contour"]),
     )
 
 
+def _collate_meta(data: Tuple[str, MemberRef]) -> Dict[str, Any]:
+    image_path, ref = data
+    cls, _ = _images_key_fn(data)
+    return dict(image_path=image_path, size=ref.size, cls=cls)
+
+
+def _images_datapipe(root: pathlib.Path) -> IterDataPipe:
+    images_datapipe: Iterable = (str(root / "101_ObjectCategories.tar.gz"),)
+    images_datapipe = dp.iter.LoadFilesFromDisk(images_datapipe)
+    images_datapipe = ReadFilesFromArchive(images_datapipe)
+    return DropByPath(images_datapipe, _is_background)
+
+
+def _anns_datapipe(root: pathlib.Path) -> IterDataPipe:
+    datapipe: Iterable = (str(root / "101_Annotations.tar"),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    datapipe = ReadFilesFromArchive(datapipe)
+    datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[mathandler()])
+    return dp.iter.Map(datapipe, _collate_ann)
+
+
 def caltech101(
-    root: Union[str, pathlib.Path], image_decoder: Optional[str] = "pil"
+    root: Union[str, pathlib.Path],
+    image_decoder: Optional[str] = "pil",
+    prefetch: int = 0,
 ) -> Iterable[Dict[str, Any]]:
     root = pathlib.Path(root).resolve()
 
-    images_datapipe: Iterable = (str(root / "101_ObjectCategories.tar.gz"),)
-    images_datapipe = dp.iter.LoadFilesFromDisk(images_datapipe)
-    images_datapipe = dp.iter.ReadFilesFromTar(images_datapipe)
-    images_datapipe = Drop(images_datapipe, _images_drop_condition)
+    images_datapipe = _images_datapipe(root)
     if image_decoder:
         images_datapipe = dp.iter.RoutedDecoder(
             images_datapipe, handlers=[imagehandler(image_decoder)]
         )
 
-    anns_datapipe: Iterable = (str(root / "101_Annotations.tar"),)
-    anns_datapipe = dp.iter.LoadFilesFromDisk(anns_datapipe)
-    anns_datapipe = dp.iter.ReadFilesFromTar(anns_datapipe)
-    anns_datapipe = dp.iter.RoutedDecoder(anns_datapipe, handlers=[mathandler()])
-    anns_datapipe = dp.iter.Map(anns_datapipe, _collate_ann)
+    anns_datapipe = _anns_datapipe(root)
 
     datapipe = DependentGroupByKey(
-        images_datapipe, anns_datapipe, key_fn=_images_key_fn
+        images_datapipe, anns_datapipe, key_fn=_images_key_fn, prefetch=prefetch
     )
     datapipe = dp.iter.Map(datapipe, fn=_collate_sample)
 
-    return datapipe
+    # merges the drop of the background images into the archive reader
+    return Resumable(optimize(datapipe))
+
+
+def caltech101_meta(root: Union[str, pathlib.Path]) -> Iterable[Dict[str, Any]]:
+    # The class is encoded in the image path, so the annotations are not needed and
+    # no image is ever read. Since the archive is compressed, it still has to be
+    # decompressed to get to the headers though.
+    datapipe = _images_datapipe(pathlib.Path(root).resolve())
+    datapipe = dp.iter.Map(datapipe, fn=_collate_meta)
+
+    return Resumable(optimize(datapipe))
+
+
+def caltech101_annotations(root: Union[str, pathlib.Path]) -> Iterator[Dict[str, Any]]:
+    # One flat row per annotated image for utils.write_table, keyed by the path of the
+    # image relative to the category folders
+    for (cls, idx), (_, ann) in _anns_datapipe(pathlib.Path(root).resolve()):
+        yield dict(
+            sample_id=f"{cls}/image_{idx:04d}.jpg",
+            cls=cls,
+            box_coord=ann["box_coord"].ravel().tolist(),
+            obj_contour=ann["obj_contour"].tolist(),
+        )
 
 
-for sample in caltech101("."):
-    image_path = sample["image_path"]
-    ann_path = sample["ann_path"]
-    assert _images_key_fn((image_path, None)) == _anns_key_fn((ann_path, None))
+if __name__ == "__main__":
+    for sample in caltech101(pathlib.Path(__file__).parent):
+        image_path = sample["image_path"]
+        ann_path = sample["ann_path"]
+        assert _images_key_fn((image_path, None)) == _anns_key_fn((ann_path, None))
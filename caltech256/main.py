@@ -1,34 +1,105 @@
+import functools
 import pathlib
 from typing import Any, Dict, Iterable, Optional, Tuple, Union
 
-import PIL.Image
-
 import torch.utils.data.datapipes as dp
-from torch.utils.data.datapipes.utils.decoder import imagehandler
+from torch.utils.data import IterDataPipe
+
+from utils import (
+    imagehandler,
+    ImageInfo,
+    MemberRef,
+    ProbeImages,
+    ReadFilesFromArchive,
+    Resumable,
+    Sample,
+    member_path,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_folder(folder: str) -> Tuple[int, str]:
+    # There are only 257 class folders, so each is only parsed once
+    label, cls = folder.split(".")
+    return int(label), cls
+
+
+def _label(path: str) -> Tuple[int, str]:
+    return _parse_folder(member_path(path).parents[0])
+
 
+class Caltech256Sample(Sample):
+    __slots__ = ("image", "path", "label", "cls")
 
-def _caltech256_sample_map(sample: Tuple[str, Any]) -> Dict[str, Any]:
+    def __init__(self, image: Any, path: str, label: int, cls: str) -> None:
+        self.image = image
+        self.path = path
+        self.label = label
+        self.cls = cls
+
+
+def _caltech256_sample_map(sample: Tuple[str, Any]) -> Caltech256Sample:
     path, image = sample
-    label_, cls = str(pathlib.Path(path).parent.name).split(".")
-    label = int(label_)
-    return dict(image=image, path=path, label=label, cls=cls)
+    label, cls = _label(path)
+    return Caltech256Sample(image, path, label, cls)
 
 
-def caltech256(
-    root: Union[str, pathlib.Path],
-    handler: Optional[str] = "pil",
-) -> Iterable[Dict[str, Any]]:
+def _caltech256_meta_map(
+    sample: Tuple[str, Union[MemberRef, ImageInfo]],
+) -> Dict[str, Any]:
+    path, ref = sample
+    label, cls = _label(path)
+    if isinstance(ref, ImageInfo):
+        return dict(
+            path=path,
+            size=ref.size,
+            label=label,
+            cls=cls,
+            width=ref.width,
+            height=ref.height,
+            mode=ref.mode,
+        )
+    return dict(path=path, size=ref.size, label=label, cls=cls)
+
+
+def _archive_datapipe(
+    root: Union[str, pathlib.Path], *, zero_copy: bool = False
+) -> IterDataPipe:
     root = pathlib.Path(root).resolve()
     datapipe: Iterable = (str(root / "256_ObjectCategories.tar"),)
     datapipe = dp.iter.LoadFilesFromDisk(datapipe)
-    datapipe = dp.iter.ReadFilesFromTar(datapipe)
+    return ReadFilesFromArchive(datapipe, zero_copy=zero_copy)
+
+
+def caltech256(
+    root: Union[str, pathlib.Path],
+    handler: Optional[str] = "pil",
+    zero_copy: bool = False,
+) -> Iterable[Caltech256Sample]:
+    datapipe = _archive_datapipe(root, zero_copy=zero_copy)
     if handler:
         datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[imagehandler(handler)])
     datapipe = dp.iter.Map(datapipe, fn=_caltech256_sample_map)
 
-    return datapipe
+    return Resumable(datapipe)
+
+
+def caltech256_meta(
+    root: Union[str, pathlib.Path], probe: bool = False
+) -> Iterable[Dict[str, Any]]:
+    # Labels are encoded in the paths, so only the headers of the archive are read. With
+    # probe, the headers of the images are read as well to get their dimensions.
+    datapipe = _archive_datapipe(root)
+    if probe:
+        datapipe = ProbeImages(datapipe)
+    datapipe = dp.iter.Map(datapipe, fn=_caltech256_meta_map)
+
+    return Resumable(datapipe)
+
 
+if __name__ == "__main__":
+    import PIL.Image
 
-for sample in caltech256("."):
-    assert isinstance(sample["image"], PIL.Image.Image)
-    assert isinstance(sample["label"], int)
+    for sample in caltech256(pathlib.Path(__file__).parent):
+        assert isinstance(sample["image"], PIL.Image.Image)
+        assert isinstance(sample["label"], int)
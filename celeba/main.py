@@ -1,15 +1,34 @@
+import functools
 import pathlib
-from typing import Any, Dict, Tuple, Union, Iterable, Optional, List
+from typing import Any, Dict, Tuple, Union, Iterable, Iterator, Optional, List
 
 import torch
 import torch.utils.data.datapipes as dp
+from torch.utils.data import IterDataPipe
 from torch.utils.data.datapipes.utils.decoder import imagehandler
 
-import sys
-
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import DependentGroupByKey, DependentDrop, ReadRowsFromCsv
-
+from utils import (
+    DependentGroupByKey,
+    MemberPath,
+    ReadRowsFromCsv,
+    ReadFilesFromArchive,
+    Resumable,
+    Sample,
+    SharedMapping,
+    Verify,
+    member_path,
+    shared,
+)
+
+
+MD5S = {
+    "img_align_celeba.zip": "00d2c5bc6d35e252742224ab0c1e8fcb",
+    "list_attr_celeba.txt": "75e246fa4810816ffd6ee81facbd244c",
+    "identity_CelebA.txt": "32bd1bd63d3c78cd57e08160ec5ed1e2",
+    "list_bbox_celeba.txt": "00566efa6fedff7a56946cd1c10f1c16",
+    "list_landmarks_align_celeba.txt": "cc24ecafdb5b50baae59b03474781f8c",
+    "list_eval_partition.txt": "d32c9cbf5e040fd4025c592c306e6668",
+}
 
 SPLIT_MAP = {
     "train": 0,
@@ -18,35 +37,60 @@ SPLIT_MAP = {
 }
 
 
-def _not_in_split(data: Tuple[str, str], *, split: str) -> Tuple[str, bool]:
-    _, (image_id, split_idx) = data
-    in_split = False if split == "all" else int(split_idx) != SPLIT_MAP[split]
-    return image_id, in_split
+def _load_files(root: pathlib.Path, file: str, *, verify: bool) -> IterDataPipe:
+    datapipe = (str(root / file),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    if verify:
+        datapipe = Verify(datapipe, MD5S)
+    return datapipe
 
 
-def _splits_datapipe(root: pathlib.Path, *, split: str) -> Iterable[Tuple[str, bool]]:
-    datapipe = (str(root / "list_eval_partition.txt"),)
-    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+def _read_partition(root: pathlib.Path, *, verify: bool) -> SharedMapping:
+    datapipe = _load_files(root, "list_eval_partition.txt", verify=verify)
     datapipe = ReadRowsFromCsv(datapipe)
-    datapipe = dp.iter.Map(datapipe, _not_in_split, fn_kwargs=dict(split=split))
+    return SharedMapping(
+        (image_id, int(split_idx)) for _, (image_id, split_idx) in datapipe
+    )
 
-    return datapipe
+
+def _partition(root: pathlib.Path, *, verify: bool) -> SharedMapping:
+    # image_id -> split index. The partition file is only read once. Afterwards, every
+    # process, e.g. a DataLoader worker, memory maps it from the cache.
+    return shared(
+        "celeba-partition",
+        (root / "list_eval_partition.txt",),
+        lambda: _read_partition(root, verify=verify),
+        verify=verify,
+    )
+
+
+def _in_split(path: MemberPath, *, partition: SharedMapping, split: str) -> bool:
+    return partition.get(path.name) == SPLIT_MAP[split]
 
 
 def _key_fn(data: Tuple[str, Any]) -> str:
-    return pathlib.Path(data[0]).name
+    return member_path(data[0]).name
 
 
 def _images_datapipe(
     root: pathlib.Path,
-    split_datapipe: Iterable[Tuple[str, bool]],
     *,
-    decoder: Optional[str]
+    split: str,
+    decoder: Optional[str],
+    num_threads: int,
+    verify: bool,
 ) -> Iterable[Tuple[str, Any]]:
-    images_datapipe = (str(root / "img_align_celeba.zip"),)
-    images_datapipe = dp.iter.LoadFilesFromDisk(images_datapipe)
-    images_datapipe = dp.iter.ReadFilesFromZip(images_datapipe)
-    images_datapipe = DependentDrop(images_datapipe, split_datapipe, key_fn=_key_fn)
+    filter_fn = None
+    if split != "all":
+        # Images of other splits are skipped without being read
+        filter_fn = functools.partial(
+            _in_split, partition=_partition(root, verify=verify), split=split
+        )
+
+    images_datapipe = _load_files(root, "img_align_celeba.zip", verify=verify)
+    images_datapipe = ReadFilesFromArchive(
+        images_datapipe, num_threads=num_threads, filter_fn=filter_fn
+    )
     if decoder:
         images_datapipe = dp.iter.RoutedDecoder(
             images_datapipe, handlers=[imagehandler(decoder)]
@@ -60,7 +104,9 @@ def _collate_ann(data: Tuple[str, List[str]]) -> Tuple[str, List[str]]:
     return key, ann
 
 
-def _ann_datapipes(root: pathlib.Path) -> List[Iterable[Tuple[str, List[str]]]]:
+def _ann_datapipes(
+    root: pathlib.Path, *, verify: bool
+) -> List[Iterable[Tuple[str, List[str]]]]:
     ann_datapipes = []
     for file, csv_kwargs in (
         ("identity_CelebA.txt", dict()),
@@ -68,8 +114,7 @@ def _ann_datapipes(root: pathlib.Path) -> List[Iterable[Tuple[str, List[str]]]]:
         ("list_bbox_celeba.txt", dict(skip_rows=2)),
         ("list_landmarks_align_celeba.txt", dict(skip_rows=2)),
     ):
-        ann_datapipe = (str(root / file),)
-        ann_datapipe = dp.iter.LoadFilesFromDisk(ann_datapipe)
+        ann_datapipe = _load_files(root, file, verify=verify)
         ann_datapipe = ReadRowsFromCsv(ann_datapipe, **csv_kwargs)
         ann_datapipe = dp.iter.Map(ann_datapipe, _collate_ann)
 
@@ -78,48 +123,107 @@ def _ann_datapipes(root: pathlib.Path) -> List[Iterable[Tuple[str, List[str]]]]:
     return ann_datapipes
 
 
-def _collate_sample(data: List[Tuple[str, Any]]) -> Dict[str, Any]:
-    sample: Dict[str, Any] = {}
-
-    image_path, image = data[0]
-    sample["image_path"] = image_path
-    sample["image"] = image
-
-    _, identity_ = data[1]
-    identity = int(identity_[0])
-    sample["identity"] = identity
-
-    _, attr_ = data[2]
-    attr = torch.tensor([int(x) for x in attr_]).add(1).bool()
-    sample["attr"] = attr
-
-    _, bbox_ = data[3]
-    bbox = torch.tensor([int(x) for x in bbox_])
-    sample["bbox"] = bbox
-
-    _, landmarks_ = data[4]
-    landmarks = torch.tensor([int(x) for x in landmarks_])
-    sample["landmarks"] = landmarks
-
-    return sample
+class CelebASample(Sample):
+    __slots__ = ("image_path", "image", "identity", "attr", "bbox", "landmarks")
+
+    def __init__(
+        self,
+        image_path: str,
+        image: Any,
+        identity: int,
+        attr: torch.Tensor,
+        bbox: torch.Tensor,
+        landmarks: torch.Tensor,
+    ) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.identity = identity
+        self.attr = attr
+        self.bbox = bbox
+        self.landmarks = landmarks
+
+
+def _collate_sample(data: List[Tuple[str, Any]]) -> CelebASample:
+    (image_path, image), (_, identity), (_, attr), (_, bbox), (_, landmarks) = data
+    return CelebASample(
+        image_path,
+        image,
+        int(identity[0]),
+        torch.tensor([int(x) for x in attr]).add(1).bool(),
+        torch.tensor([int(x) for x in bbox]),
+        torch.tensor([int(x) for x in landmarks]),
+    )
 
 
 def celeba(
     root: Union[str, pathlib.Path],
     split: str = "train",
     decoder: Optional[str] = "pil",
-) -> Iterable[Dict[str, Any]]:
+    prefetch: int = 0,
+    num_threads: int = 0,
+    verify: bool = False,
+) -> Iterable[CelebASample]:
     root = pathlib.Path(root).resolve()
 
-    split_datapipe = _splits_datapipe(root, split=split)
-    images_datapipe = _images_datapipe(root, split_datapipe, decoder=decoder)
-    ann_datapipes = _ann_datapipes(root)
-
-    datapipe = DependentGroupByKey(images_datapipe, *ann_datapipes, key_fn=_key_fn)
+    images_datapipe = _images_datapipe(
+        root,
+        split=split,
+        decoder=decoder,
+        num_threads=num_threads,
+        verify=verify,
+    )
+    ann_datapipes = _ann_datapipes(root, verify=verify)
+
+    datapipe = DependentGroupByKey(
+        images_datapipe, *ann_datapipes, key_fn=_key_fn, prefetch=prefetch
+    )
     datapipe = dp.iter.Map(datapipe, _collate_sample)
 
-    return datapipe
+    return Resumable(datapipe)
+
+
+def _header(root: pathlib.Path, file: str) -> List[str]:
+    # The first line holds the number of images and the second the column names
+    with open(root / file) as fh:
+        next(fh)
+        return [name for name in next(fh).split() if name != "image_id"]
+
+
+def celeba_annotations(
+    root: Union[str, pathlib.Path], split: str = "all"
+) -> Iterator[Dict[str, Any]]:
+    # One flat row per image for utils.write_table, keyed by the file name, with a
+    # column for every attribute, box coordinate, and landmark
+    root = pathlib.Path(root).resolve()
+    attr_names, bbox_names, landmark_names = (
+        _header(root, file)
+        for file in (
+            "list_attr_celeba.txt",
+            "list_bbox_celeba.txt",
+            "list_landmarks_align_celeba.txt",
+        )
+    )
+
+    split_datapipe = _load_files(root, "list_eval_partition.txt", verify=False)
+    split_datapipe = ReadRowsFromCsv(split_datapipe)
+    for (_, (image_id, split_idx)), *anns in zip(
+        split_datapipe, *_ann_datapipes(root, verify=False)
+    ):
+        if any(key != image_id for key, _ in anns):
+            raise RuntimeError(f"The annotation files are not aligned at {image_id}")
+        if split != "all" and int(split_idx) != SPLIT_MAP[split]:
+            continue
+
+        (_, identity), (_, attr), (_, bbox), (_, landmarks) = anns
+        row: Dict[str, Any] = dict(
+            sample_id=image_id, split=int(split_idx), identity=int(identity[0])
+        )
+        row.update((name, value == "1") for name, value in zip(attr_names, attr))
+        row.update((name, int(value)) for name, value in zip(bbox_names, bbox))
+        row.update((name, int(value)) for name, value in zip(landmark_names, landmarks))
+        yield row
 
 
-for sample in celeba("."):
-    pass
+if __name__ == "__main__":
+    for sample in celeba(pathlib.Path(__file__).parent):
+        pass
@@ -1,16 +1,29 @@
 import pathlib
 import pickle
 from io import BufferedIOBase
-from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
-
-import PIL.Image
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import torch.utils.data.datapipes as dp
 from torch.utils.data import IterDataPipe
 
+from utils import ReadFilesFromArchive, ResumableInput, Verify, aiterate, member_path
+
+if TYPE_CHECKING:
+    import PIL.Image
+
 
 class _CIFAR(IterDataPipe):
-    ARCHIVE = Tuple[str, str]
+    ARCHIVE: Tuple[str, str]
 
     TRAIN_FILES: Iterable[Tuple[str, str]]
     TEST_FILES: Iterable[Tuple[str, str]]
@@ -21,21 +34,45 @@ class _CIFAR(IterDataPipe):
 
     HEIGHT = WIDTH = 32
 
-    def __init__(self, root: Union[str, pathlib.Path], *, train: bool = True) -> None:
+    def __init__(
+        self,
+        root: Union[str, pathlib.Path],
+        *,
+        train: bool = True,
+        verify: bool = False,
+    ) -> None:
         self.root = pathlib.Path(root).resolve()
         self.train = train
         self._label_to_class: Optional[Dict[int, str]] = None
 
-    def __iter__(self) -> Iterator[Tuple[PIL.Image.Image, Dict[str, Any]]]:
-        names_to_read, _ = zip(*(self.TRAIN_FILES if self.train else self.TEST_FILES))
+        archive = pathlib.Path(self.ARCHIVE[0]).name
+        dp1 = dp.iter.LoadFilesFromDisk((str(self.root / archive),))
+        if verify:
+            # The archive is compressed and thus read completely anyway
+            dp1 = Verify(dp1, {archive: self.ARCHIVE[1]})
+        self.datapipe = ReadFilesFromArchive(dp1)
+        if verify:
+            files = self.TRAIN_FILES if self.train else self.TEST_FILES
+            self.datapipe = Verify(self.datapipe, dict((*files, self.META_FILE)))
+
+        # A batch file holds thousands of samples. To resume in the middle of one, we
+        # need to know how many of them were already yielded.
+        self._input = ResumableInput(self.datapipe)
+        self._num_samples: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Tuple["PIL.Image.Image", Dict[str, Any]]]:
+        import PIL.Image
+
+        state, self._resume = self._resume, None
+        if state:
+            self._label_to_class = state["label_to_class"]
 
-        dp1 = dp.iter.LoadFilesFromDisk(
-            (str(self.root / pathlib.Path(self.ARCHIVE[0]).name),)
-        )
-        dp2 = dp.iter.ReadFilesFromTar(dp1)
+        names_to_read, _ = zip(*(self.TRAIN_FILES if self.train else self.TEST_FILES))
 
-        for path, data in dp2:
-            name = pathlib.Path(path).name
+        for (path, data), num_samples in self._input.iterate(state):
+            self._num_samples = None
+            name = member_path(path).name
             if name not in names_to_read:
                 if name == self.META_FILE[0]:
                     self._load_meta(data)
@@ -45,9 +82,22 @@ class _CIFAR(IterDataPipe):
             images = content["data"].view(-1, 3, self.HEIGHT, self.WIDTH)
             labels = content[self.LABELS_KEY]
 
-            for image_, label in zip(images, labels):
-                image = PIL.Image.fromarray(image_.permute(2, 1, 0).numpy())
-                yield image, label
+            for idx in range(num_samples or 0, len(labels)):
+                image = PIL.Image.fromarray(images[idx].permute(2, 1, 0).numpy())
+                self._num_samples = idx + 1
+                yield image, labels[idx]
+
+    def __aiter__(self) -> AsyncIterator[Tuple["PIL.Image.Image", Dict[str, Any]]]:
+        return aiterate(self)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or dict(
+            self._input.state_dict(self._num_samples),
+            label_to_class=self._label_to_class,
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
 
     def _load_meta(self, data: BufferedIOBase) -> None:
         content = pickle.load(data)
@@ -97,10 +147,13 @@ class CIFAR100(_CIFAR):
     CLASSES_KEY = "fine_label_names"
 
 
-for image, label in CIFAR10("."):
-    assert isinstance(image, PIL.Image.Image)
-    assert isinstance(label, int)
+if __name__ == "__main__":
+    import PIL.Image
+
+    for image, label in CIFAR10(pathlib.Path(__file__).parent):
+        assert isinstance(image, PIL.Image.Image)
+        assert isinstance(label, int)
 
-for image, label in CIFAR100("."):
-    assert isinstance(image, PIL.Image.Image)
-    assert isinstance(label, int)
+    for image, label in CIFAR100(pathlib.Path(__file__).parent):
+        assert isinstance(image, PIL.Image.Image)
+        assert isinstance(label, int)
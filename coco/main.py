@@ -1,15 +1,34 @@
+import functools
 import pathlib
-import sys
 from collections import defaultdict
-from typing import Any, Dict, Tuple, Union, Iterable, Iterator, Optional, List
+from typing import (
+    Any,
+    Dict,
+    Tuple,
+    Union,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    List,
+)
 
 import torch.utils.data.datapipes as dp
 from torch.utils.data import IterDataPipe
 from torch.utils.data.datapipes.utils.decoder import imagehandler
 
-
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import DependentGroupByKey
+from utils import (
+    ImageInfo,
+    MemberPath,
+    ProbeImages,
+    Prefetch,
+    ReadFilesFromArchive,
+    Resumable,
+    ResumableInput,
+    Sample,
+    SharedMapping,
+    shared,
+)
 
 
 class IterateOverAnnotations(IterDataPipe):
@@ -17,16 +36,30 @@ class IterateOverAnnotations(IterDataPipe):
         super().__init__()
         self.datapipe = datapipe
 
+        self._input = ResumableInput(datapipe)
+        self._num_images: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
     def __iter__(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
-        for path, content in self.datapipe:
+        state, self._resume = self._resume, None
+        for (path, content), num_images in self._input.iterate(state):
             images = content["images"]
             # We index the annotations to enable O(1) access through the image id
             anns = self._index_anns(content["annotations"])
-            for image in images:
+            self._num_images = num_images
+            for idx in range(num_images or 0, len(images)):
+                image = images[idx]
                 key = image["file_name"]
                 data = dict(image_id=image["id"], annotations=anns[image["id"]])
+                self._num_images = idx + 1
                 yield key, data
 
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._num_images)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
     @staticmethod
     def _index_anns(anns: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
         indexed_anns: Dict[str, List[Dict[str, Any]]] = defaultdict(lambda: [])
@@ -38,45 +71,215 @@ class IterateOverAnnotations(IterDataPipe):
         return indexed_anns
 
 
-def _collate_image(data: Tuple[str, Any]) -> Tuple[str, Dict[str, Any]]:
-    path, image = data
-    return str(pathlib.Path(path).name), dict(image_path=path, image=image)
+class CocoSample(Sample):
+    __slots__ = ("image_path", "image", "image_id", "annotations")
+
+    def __init__(
+        self,
+        image_path: str,
+        image: Any,
+        image_id: int,
+        annotations: List[Dict[str, Any]],
+    ) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.image_id = image_id
+        self.annotations = annotations
+
+
+class _AnnotationsByFileName:
+    # The annotation file has to be loaded completely anyway. Thus, we index it by the
+    # file name of the images and join them while iterating the image archive in the
+    # order of its central directory. Images without annotations are never read. The
+    # index is only built once. Afterwards, every process, e.g. a DataLoader worker,
+    # memory maps it from the cache rather than holding the parsed annotations.
+    def __init__(
+        self,
+        annotation_archive: pathlib.Path,
+        annotation_file: str,
+        datapipe: Iterable[Tuple[str, Dict[str, Any]]],
+    ) -> None:
+        self.annotation_archive = annotation_archive
+        self.annotation_file = annotation_file
+        self.datapipe = datapipe
+        self._index: Optional[Mapping[str, Dict[str, Any]]] = None
+
+    @property
+    def index(self) -> Mapping[str, Dict[str, Any]]:
+        if self._index is None:
+            self._index = shared(
+                "coco-annotations",
+                (self.annotation_archive,),
+                lambda: SharedMapping(self._unique_items()),
+                annotation_file=self.annotation_file,
+            )
+        return self._index
+
+    def _unique_items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # SharedMapping resolves duplicate keys as last wins. Thus, we fail loudly
+        # rather than silently joining an image with the wrong annotations.
+        seen = set()
+        for key, data in self.datapipe:
+            if key in seen:
+                raise ValueError(
+                    f"{self.annotation_file} in {self.annotation_archive} contains "
+                    f"the image {key} multiple times"
+                )
+            seen.add(key)
+            yield key, data
+        if not seen:
+            raise FileNotFoundError(
+                f"{self.annotation_archive} contains no images in "
+                f"{self.annotation_file}"
+            )
+
+    def selects(self, path: MemberPath) -> bool:
+        return path.name in self.index
+
+    def __call__(self, data: Tuple[MemberPath, Any]) -> "CocoSample":
+        path, image = data
+        anns = self.index[path.name]
+        return CocoSample(path, image, anns["image_id"], anns["annotations"])
+
+    def meta(self, data: Tuple[MemberPath, Any]) -> Dict[str, Any]:
+        path, info = data
+        sample = dict(image_path=path, size=info.size)
+        if isinstance(info, ImageInfo):
+            sample.update(info._asdict())
+        sample.update(self.index[path.name])
+        return sample
+
+
+def _is_annotation_file(path: MemberPath, *, name: str) -> bool:
+    return path.name == name
+
+
+def _annotation_file(annotations: str, split: str) -> str:
+    # The annotation archive contains one file per annotation type and split, e.g.
+    # captions_train2014.json and instances_train2014.json, which all list the same
+    # images. Thus, only the requested one is joined.
+    return f"{annotations}_{split}.json"
+
+
+def _record_json_file(path: MemberPath, *, names: List[str]) -> bool:
+    # Rejects every member. Thus, only the paths are read, but not the data.
+    if path.suffix == ".json":
+        names.append(path.name)
+    return False
+
+
+def _resolve_annotation_file(
+    annotation_archive: pathlib.Path, annotation_file: str
+) -> str:
+    # If the archive only contains a single annotation file, e.g. the sample archive
+    # next to this file, it is used regardless of its name.
+    names: List[str] = []
+    datapipe: Iterable = (str(annotation_archive),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    datapipe = ReadFilesFromArchive(
+        datapipe, filter_fn=functools.partial(_record_json_file, names=names)
+    )
+    for _ in datapipe:
+        pass
+
+    if annotation_file in names or len(names) != 1:
+        return annotation_file
+    return names[0]
+
+
+def _split(image_archive: Union[str, pathlib.Path]) -> str:
+    # The image archives are named after the split, e.g. train2014.zip
+    return pathlib.Path(image_archive).stem
 
 
-def _collate_sample(data: List[Tuple[Any, Dict[str, Any]]]) -> Dict[str, Any]:
-    sample: Dict[str, Any] = {}
-    for _, partial_data in data:
-        sample.update(partial_data)
-    return sample
+def _annotations(
+    annotation_archive: Union[str, pathlib.Path], annotation_file: str
+) -> _AnnotationsByFileName:
+    annotation_archive = pathlib.Path(annotation_archive).resolve()
+    annotation_file = _resolve_annotation_file(annotation_archive, annotation_file)
+    datapipe: Iterable = (str(annotation_archive),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    datapipe = ReadFilesFromArchive(
+        datapipe,
+        filter_fn=functools.partial(_is_annotation_file, name=annotation_file),
+    )
+    datapipe = dp.iter.RoutedDecoder(datapipe)
+    return _AnnotationsByFileName(
+        annotation_archive, annotation_file, IterateOverAnnotations(datapipe)
+    )
+
+
+def _image_datapipe(
+    image_archive: Union[str, pathlib.Path],
+    annotations: _AnnotationsByFileName,
+    *,
+    num_threads: int = 0,
+) -> IterDataPipe:
+    datapipe: Iterable = (str(pathlib.Path(image_archive).resolve()),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    return ReadFilesFromArchive(
+        datapipe, num_threads=num_threads, filter_fn=annotations.selects
+    )
 
 
 def coco(
     image_archive: Union[str, pathlib.Path],
     annotation_archive: Union[str, pathlib.Path],
     decoder: Optional[str] = "pil",
+    prefetch: int = 0,
+    num_threads: int = 0,
+    annotations_type: str = "instances",  # captions, person_keypoints
 ):
-    annotation_datapipe: Iterable = (str(pathlib.Path(annotation_archive).resolve()),)
-    annotation_datapipe = dp.iter.LoadFilesFromDisk(annotation_datapipe)
-    annotation_datapipe = dp.iter.ReadFilesFromZip(annotation_datapipe)
-    annotation_datapipe = dp.iter.RoutedDecoder(annotation_datapipe)
-    annotation_datapipe = IterateOverAnnotations(annotation_datapipe)
-
-    image_datapipe: Iterable = (str(pathlib.Path(image_archive).resolve()),)
-    image_datapipe = dp.iter.LoadFilesFromDisk(image_datapipe)
-    image_datapipe = dp.iter.ReadFilesFromZip(image_datapipe)
+    annotations = _annotations(
+        annotation_archive, _annotation_file(annotations_type, _split(image_archive))
+    )
+    datapipe = _image_datapipe(image_archive, annotations, num_threads=num_threads)
     if decoder:
-        image_datapipe = dp.iter.RoutedDecoder(
-            image_datapipe, handlers=[imagehandler(decoder)]
-        )
-    image_datapipe = dp.iter.Map(image_datapipe, _collate_image)
+        datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[imagehandler(decoder)])
+    datapipe = Prefetch(datapipe, buffer_size=prefetch)
+    datapipe = dp.iter.Map(datapipe, annotations)
+
+    return Resumable(datapipe)
 
-    datapipe = DependentGroupByKey(
-        annotation_datapipe, image_datapipe, key_fn=lambda data: data[0]
+
+def coco_meta(
+    image_archive: Union[str, pathlib.Path],
+    annotation_archive: Union[str, pathlib.Path],
+    probe: bool = False,
+    annotations_type: str = "instances",  # captions, person_keypoints
+):
+    # With probe, only the headers of the images are read to get their dimensions
+    annotations = _annotations(
+        annotation_archive, _annotation_file(annotations_type, _split(image_archive))
     )
-    datapipe = dp.iter.Map(datapipe, _collate_sample)
+    datapipe = _image_datapipe(image_archive, annotations)
+    if probe:
+        datapipe = ProbeImages(datapipe)
+    datapipe = dp.iter.Map(datapipe, annotations.meta)
+
+    return Resumable(datapipe)
 
-    return datapipe
+
+def coco_annotations(
+    annotation_archive: Union[str, pathlib.Path],
+    *,
+    split: str = "train2014",
+    annotations_type: str = "instances",  # captions, person_keypoints
+) -> Iterator[Dict[str, Any]]:
+    # One flat row per annotation for utils.write_table, keyed by the file name of the
+    # image. The segmentations are left out, since they are either polygons or run
+    # length encodings and thus have no common type.
+    annotation_file = _annotation_file(annotations_type, split)
+    for file_name, image in _annotations(annotation_archive, annotation_file).datapipe:
+        for ann in image["annotations"]:
+            row = dict(sample_id=file_name, image_id=image["image_id"])
+            row.update(
+                (key, value) for key, value in ann.items() if key != "segmentation"
+            )
+            yield row
 
 
-for sample in coco("train2014.zip", "annotations.zip"):
-    pass
+if __name__ == "__main__":
+    root = pathlib.Path(__file__).parent
+    for sample in coco(root / "train2014.zip", root / "annotations.zip"):
+        pass
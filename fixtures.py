@@ -0,0 +1,941 @@
+import contextlib
+import gzip
+import io
+import json
+import pathlib
+import pickle
+import random
+import struct
+import tarfile
+import zipfile
+import zlib
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+__all__ = [
+    "encode_jpeg",
+    "encode_png",
+    "make_caltech101",
+    "make_caltech256",
+    "make_celeba",
+    "make_cifar",
+    "make_coco",
+    "make_imagenet",
+    "make_voc",
+    "FIXTURES",
+    "make_fixtures",
+]
+
+# The fixtures are structural stand-ins of the real archives: the same file names,
+# member layouts, compressions, and annotation formats, but with synthetic images of
+# configurable size and number. Everything is derived from the seed and the archives
+# carry fixed timestamps, so two runs with the same arguments produce byte-identical
+# files and thus comparable benchmarks.
+
+_MTIME = 315532800  # 1980-01-01, the earliest timestamp a zip can store
+_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+ImageSize = Tuple[int, int]
+
+
+# JPEG
+
+# Standard luminance DC table of the JPEG specification (Annex K.3)
+_DC_BITS = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)
+_DC_VALUES = tuple(range(12))
+# The images only have DC coefficients, so the AC table only needs the end of block
+_AC_BITS = (1,) + (0,) * 15
+_AC_VALUES = (0x00,)
+
+
+def _huffman_codes(
+    bits: Sequence[int], values: Sequence[int]
+) -> Dict[int, Tuple[int, int]]:
+    codes = {}
+    code = 0
+    values_iter = iter(values)
+    for length, count in enumerate(bits, 1):
+        for _ in range(count):
+            codes[next(values_iter)] = (code, length)
+            code += 1
+        code <<= 1
+    return codes
+
+
+_DC_CODES = _huffman_codes(_DC_BITS, _DC_VALUES)
+_EOB = _huffman_codes(_AC_BITS, _AC_VALUES)[0x00]
+
+
+class _BitWriter:
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._acc = 0
+        self._num_bits = 0
+
+    def write(self, value: int, length: int) -> None:
+        self._acc = (self._acc << length) | value
+        self._num_bits += length
+        while self._num_bits >= 8:
+            self._num_bits -= 8
+            byte = (self._acc >> self._num_bits) & 0xFF
+            self._buffer.append(byte)
+            # byte stuffing, since 0xFF starts a marker
+            if byte == 0xFF:
+                self._buffer.append(0x00)
+        self._acc &= (1 << self._num_bits) - 1
+
+    def getvalue(self) -> bytes:
+        if self._num_bits:
+            padding = 8 - self._num_bits
+            self.write((1 << padding) - 1, padding)
+        return bytes(self._buffer)
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    return struct.pack(">HH", marker, len(payload) + 2) + payload
+
+
+def encode_jpeg(
+    size: ImageSize, *, rng: Optional[random.Random] = None, block_size: int = 8
+) -> bytes:
+    # Encodes a baseline YCbCr JPEG of the given (height, width) without any
+    # dependency. Every block of 8x8 pixels has a random flat color, which the
+    # decoders have to process like any other image, i.e. with inverse DCT and color
+    # conversion. Since only DC coefficients are stored, the files are smaller than
+    # photos of the same size.
+    rng = rng or random.Random(0)
+    height, width = size
+    num_blocks = ((height + block_size - 1) // block_size) * (
+        (width + block_size - 1) // block_size
+    )
+
+    writer = _BitWriter()
+    previous = [0, 0, 0]
+    for _ in range(num_blocks):
+        for component in range(3):
+            # The quantization table is all ones, so the DC coefficient is 8 times the
+            # level shifted mean of the block.
+            dc = 8 * (rng.randrange(256) - 128)
+            diff = dc - previous[component]
+            previous[component] = dc
+
+            category = abs(diff).bit_length()
+            writer.write(*_DC_CODES[category])
+            if category:
+                writer.write(diff if diff > 0 else diff + (1 << category) - 1, category)
+            writer.write(*_EOB)
+
+    components = b"".join(struct.pack(">BBB", idx, 0x11, 0) for idx in (1, 2, 3))
+    return b"".join(
+        (
+            b"\xff\xd8",
+            _segment(0xFFE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"),
+            _segment(0xFFDB, b"\x00" + b"\x01" * 64),
+            _segment(0xFFC0, struct.pack(">BHHB", 8, height, width, 3) + components),
+            _segment(0xFFC4, b"\x00" + bytes(_DC_BITS) + bytes(_DC_VALUES)),
+            _segment(0xFFC4, b"\x10" + bytes(_AC_BITS) + bytes(_AC_VALUES)),
+            _segment(
+                0xFFDA,
+                b"\x03"
+                + b"".join(struct.pack(">BB", idx, 0x00) for idx in (1, 2, 3))
+                + b"\x00\x3f\x00",
+            ),
+            writer.getvalue(),
+            b"\xff\xd9",
+        )
+    )
+
+
+# PNG
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_png(rows: Sequence[bytes], *, palette: bytes) -> bytes:
+    # Encodes a palette image, i.e. one byte per pixel indexing into the palette
+    height, width = len(rows), len(rows[0])
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+            _chunk(b"PLTE", palette),
+            _chunk(b"IDAT", zlib.compress(b"".join(b"\x00" + row for row in rows))),
+            _chunk(b"IEND", b""),
+        )
+    )
+
+
+def _voc_palette() -> bytes:
+    palette = bytearray()
+    for label in range(256):
+        r = g = b = 0
+        for shift in range(8):
+            r |= ((label >> (3 * shift)) & 1) << (7 - shift)
+            g |= ((label >> (3 * shift + 1)) & 1) << (7 - shift)
+            b |= ((label >> (3 * shift + 2)) & 1) << (7 - shift)
+        palette += bytes((r, g, b))
+    return bytes(palette)
+
+
+# archives
+
+
+def _tar_info(name: str, size: int = 0, *, is_dir: bool = False) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.mtime = _MTIME
+    if is_dir:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = size
+        info.mode = 0o644
+    return info
+
+
+def _pack_tar(
+    fh: BinaryIO,
+    members: Iterable[Tuple[str, Optional[bytes]]],
+    *,
+    compress: bool = False,
+) -> None:
+    # Members without data are directories. The gzip header carries neither a
+    # timestamp nor a file name to keep the archive reproducible.
+    with contextlib.ExitStack() as stack:
+        if compress:
+            fh = stack.enter_context(
+                gzip.GzipFile(filename="", fileobj=fh, mode="wb", mtime=0)
+            )
+        tar = stack.enter_context(
+            tarfile.open(fileobj=fh, mode="w", format=tarfile.GNU_FORMAT)
+        )
+        for name, data in members:
+            if data is None:
+                tar.addfile(_tar_info(name, is_dir=True))
+            else:
+                tar.addfile(_tar_info(name, len(data)), io.BytesIO(data))
+
+
+def _write_tar(
+    file: pathlib.Path,
+    members: Iterable[Tuple[str, Optional[bytes]]],
+    *,
+    compress: bool = False,
+) -> None:
+    with open(file, "wb") as fh:
+        _pack_tar(fh, members, compress=compress)
+
+
+def _tar_bytes(members: Iterable[Tuple[str, Optional[bytes]]]) -> bytes:
+    with io.BytesIO() as buffer:
+        _pack_tar(buffer, members)
+        return buffer.getvalue()
+
+
+def _write_zip(
+    file: pathlib.Path,
+    members: Iterable[Tuple[str, Optional[bytes]]],
+    *,
+    compression: int = zipfile.ZIP_STORED,
+) -> None:
+    with zipfile.ZipFile(file, "w") as zip:
+        for name, data in members:
+            info = zipfile.ZipInfo(name, date_time=_DATE_TIME)
+            if data is None:
+                info.external_attr = 0o40755 << 16 | 0x10
+                zip.writestr(info, b"")
+            else:
+                info.compress_type = compression
+                info.external_attr = 0o644 << 16
+                zip.writestr(info, data)
+
+
+def _mat_bytes(content: Dict[str, Any]) -> bytes:
+    import scipy.io
+
+    buffer = io.BytesIO()
+    scipy.io.savemat(buffer, content)
+    # The text of the header holds the creation time
+    data = bytearray(buffer.getvalue())
+    data[:116] = b"MATLAB 5.0 MAT-file, synthetic".ljust(116)
+    return bytes(data)
+
+
+def _with_parents(
+    members: Iterable[Tuple[str, Optional[bytes]]],
+) -> List[Tuple[str, Optional[bytes]]]:
+    # Inserts the directory entries in front of their first member as tar and zip do
+    # when packing a directory tree.
+    seen = set()
+    result: List[Tuple[str, Optional[bytes]]] = []
+    for name, data in members:
+        parts = name.rstrip("/").split("/")
+        for idx in range(1, len(parts)):
+            parent = "/".join(parts[:idx]) + "/"
+            if parent not in seen:
+                seen.add(parent)
+                result.append((parent, None))
+        result.append((name, data))
+    return result
+
+
+def _prepare(root: Union[str, pathlib.Path]) -> pathlib.Path:
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def _split(num_samples: int, *fractions: float) -> List[int]:
+    # Distributes the samples among the splits and gives the rest to the last one
+    counts = [int(num_samples * fraction) for fraction in fractions]
+    counts.append(num_samples - sum(counts))
+    return counts
+
+
+# datasets
+
+_CALTECH101_CLASSES = (
+    "Faces",
+    "Faces_easy",
+    "Motorbikes",
+    "airplanes",
+    "accordion",
+    "anchor",
+    "ant",
+    "barrel",
+    "bass",
+    "beaver",
+)
+
+# Inverse of caltech101.main.CLASS_MAP: the annotation folders of these classes are
+# named differently than the image folders
+_CALTECH101_ANNOTATION_FOLDERS = {
+    "Faces": "Faces_2",
+    "Faces_easy": "Faces_3",
+    "Motorbikes": "Motorbikes_16",
+    "airplanes": "Airplanes_Side_2",
+}
+
+
+def _class_names(names: Sequence[str], num_classes: int) -> List[str]:
+    return [
+        names[idx] if idx < len(names) else f"class_{idx:03d}"
+        for idx in range(num_classes)
+    ]
+
+
+def make_caltech101(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    num_classes: int = 10,
+    image_size: ImageSize = (300, 200),
+    seed: int = 0,
+) -> pathlib.Path:
+    # The annotations are MATLAB files and thus need scipy to be written
+    import numpy as np
+    import scipy.io  # noqa: F401
+
+    root = _prepare(root)
+    rng = random.Random(seed)
+    classes = _class_names(_CALTECH101_CLASSES, num_classes)
+
+    images = []
+    annotations = []
+    for cls in ["BACKGROUND_Google", *classes]:
+        for idx in range(1, max(num_samples // (num_classes + 1), 1) + 1):
+            images.append(
+                (
+                    f"101_ObjectCategories/{cls}/image_{idx:04d}.jpg",
+                    encode_jpeg(image_size, rng=rng),
+                )
+            )
+            if cls == "BACKGROUND_Google":
+                continue
+
+            height, width = image_size
+            top, left = rng.randrange(height // 2), rng.randrange(width // 2)
+            bottom, right = top + height // 2, left + width // 2
+            contour = np.array(
+                [
+                    [rng.uniform(0, right - left) for _ in range(8)],
+                    [rng.uniform(0, bottom - top) for _ in range(8)],
+                ]
+            )
+            annotation = _mat_bytes(
+                dict(
+                    box_coord=np.array([[top, bottom, left, right]], dtype=np.uint16),
+                    obj_contour=contour,
+                )
+            )
+            folder = _CALTECH101_ANNOTATION_FOLDERS.get(cls, cls)
+            annotations.append(
+                (f"Annotations/{folder}/annotation_{idx:04d}.mat", annotation)
+            )
+
+    _write_tar(
+        root / "101_ObjectCategories.tar.gz", _with_parents(images), compress=True
+    )
+    _write_tar(root / "101_Annotations.tar", _with_parents(annotations))
+    return root
+
+
+def make_caltech256(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    num_classes: int = 10,
+    image_size: ImageSize = (300, 200),
+    seed: int = 0,
+) -> pathlib.Path:
+    root = _prepare(root)
+    rng = random.Random(seed)
+
+    # the real archive ends with the clutter class
+    classes = [
+        *((label, f"class_{label:03d}") for label in range(1, num_classes)),
+        (257, "clutter"),
+    ]
+    members = []
+    for label, cls in classes:
+        for idx in range(1, max(num_samples // num_classes, 1) + 1):
+            members.append(
+                (
+                    f"256_ObjectCategories/{label:03d}.{cls}/{label:03d}_{idx:04d}.jpg",
+                    encode_jpeg(image_size, rng=rng),
+                )
+            )
+
+    _write_tar(root / "256_ObjectCategories.tar", _with_parents(members))
+    return root
+
+
+_CELEBA_ATTRIBUTES = (
+    "5_o_Clock_Shadow Arched_Eyebrows Attractive Bags_Under_Eyes Bald Bangs Big_Lips "
+    "Big_Nose Black_Hair Blond_Hair Blurry Brown_Hair Bushy_Eyebrows Chubby "
+    "Double_Chin Eyeglasses Goatee Gray_Hair Heavy_Makeup High_Cheekbones Male "
+    "Mouth_Slightly_Open Mustache Narrow_Eyes No_Beard Oval_Face Pale_Skin "
+    "Pointy_Nose Receding_Hairline Rosy_Cheeks Sideburns Smiling Straight_Hair "
+    "Wavy_Hair Wearing_Earrings Wearing_Hat Wearing_Lipstick Wearing_Necklace "
+    "Wearing_Necktie Young"
+).split()
+
+_CELEBA_LANDMARKS = (
+    "lefteye_x lefteye_y righteye_x righteye_y nose_x nose_y "
+    "leftmouth_x leftmouth_y rightmouth_x rightmouth_y"
+).split()
+
+
+def make_celeba(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    image_size: ImageSize = (218, 178),
+    seed: int = 0,
+) -> pathlib.Path:
+    root = _prepare(root)
+    rng = random.Random(seed)
+    height, width = image_size
+
+    image_ids = [f"{idx:06d}.jpg" for idx in range(1, num_samples + 1)]
+    _write_zip(
+        root / "img_align_celeba.zip",
+        _with_parents(
+            (f"img_align_celeba/{image_id}", encode_jpeg(image_size, rng=rng))
+            for image_id in image_ids
+        ),
+    )
+
+    def write(name: str, header: Optional[Sequence[str]], rows: Iterable[str]) -> None:
+        lines = [] if header is None else [str(num_samples), " ".join(header)]
+        lines.extend(rows)
+        (root / name).write_text("".join(f"{line}\n" for line in lines))
+
+    num_train, num_valid, _ = _split(num_samples, 0.8, 0.1)
+    write(
+        "list_eval_partition.txt",
+        None,
+        (
+            f"{image_id} {0 if idx < num_train else 1 if idx < num_train + num_valid else 2}"
+            for idx, image_id in enumerate(image_ids)
+        ),
+    )
+    write(
+        "identity_CelebA.txt",
+        None,
+        (
+            f"{image_id} {rng.randint(1, max(num_samples // 20, 1))}"
+            for image_id in image_ids
+        ),
+    )
+    write(
+        "list_attr_celeba.txt",
+        _CELEBA_ATTRIBUTES,
+        (
+            " ".join([image_id, *(rng.choice(("-1", "1")) for _ in _CELEBA_ATTRIBUTES)])
+            for image_id in image_ids
+        ),
+    )
+    write(
+        "list_bbox_celeba.txt",
+        ("image_id", "x_1", "y_1", "width", "height"),
+        (
+            f"{image_id} {rng.randrange(width // 2)} {rng.randrange(height // 2)} "
+            f"{width // 2} {height // 2}"
+            for image_id in image_ids
+        ),
+    )
+    write(
+        "list_landmarks_align_celeba.txt",
+        _CELEBA_LANDMARKS,
+        (
+            " ".join(
+                [
+                    image_id,
+                    *(
+                        str(rng.randrange(width if name.endswith("x") else height))
+                        for name in _CELEBA_LANDMARKS
+                    ),
+                ]
+            )
+            for image_id in image_ids
+        ),
+    )
+    return root
+
+
+def _cifar_batch(
+    rng: random.Random, num_samples: int, labels_keys: Sequence[str], num_labels: int
+) -> bytes:
+    # The datasets view the data as tensor, so it is stored as such
+    import torch
+
+    generator = torch.Generator().manual_seed(rng.randrange(2**32))
+    content: Dict[str, Any] = dict(
+        batch_label="synthetic",
+        data=torch.randint(
+            256, (num_samples, 3 * 32 * 32), dtype=torch.uint8, generator=generator
+        ),
+        filenames=[f"synthetic_{idx:05d}.png" for idx in range(num_samples)],
+    )
+    for key in labels_keys:
+        content[key] = [rng.randrange(num_labels) for _ in range(num_samples)]
+    return pickle.dumps(content)
+
+
+def make_cifar(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    seed: int = 0,
+) -> pathlib.Path:
+    # Writes the archives of CIFAR10 and CIFAR100. The train split has num_samples
+    # images and the test split a fifth of that. The image size is fixed to 32x32.
+    root = _prepare(root)
+    rng = random.Random(seed)
+    num_test = max(num_samples // 5, 1)
+
+    _write_tar(
+        root / "cifar-10-python.tar.gz",
+        [
+            ("cifar-10-batches-py/", None),
+            (
+                "cifar-10-batches-py/batches.meta",
+                pickle.dumps(
+                    dict(
+                        num_cases_per_batch=num_samples // 5,
+                        label_names=[f"class_{idx}" for idx in range(10)],
+                        num_vis=3 * 32 * 32,
+                    )
+                ),
+            ),
+            (
+                "cifar-10-batches-py/test_batch",
+                _cifar_batch(rng, num_test, ("labels",), 10),
+            ),
+            *(
+                (
+                    f"cifar-10-batches-py/data_batch_{idx}",
+                    _cifar_batch(rng, batch_size, ("labels",), 10),
+                )
+                for idx, batch_size in enumerate(_split(num_samples, *(0.2,) * 4), 1)
+            ),
+        ],
+        compress=True,
+    )
+
+    labels_keys = ("fine_labels", "coarse_labels")
+    _write_tar(
+        root / "cifar-100-python.tar.gz",
+        [
+            ("cifar-100-python/", None),
+            (
+                "cifar-100-python/meta",
+                pickle.dumps(
+                    dict(
+                        fine_label_names=[f"class_{idx}" for idx in range(100)],
+                        coarse_label_names=[f"superclass_{idx}" for idx in range(20)],
+                    )
+                ),
+            ),
+            ("cifar-100-python/test", _cifar_batch(rng, num_test, labels_keys, 20)),
+            (
+                "cifar-100-python/train",
+                _cifar_batch(rng, num_samples, labels_keys, 20),
+            ),
+        ],
+        compress=True,
+    )
+    return root
+
+
+def make_coco(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    num_categories: int = 10,
+    image_size: ImageSize = (480, 640),
+    seed: int = 0,
+) -> pathlib.Path:
+    root = _prepare(root)
+    rng = random.Random(seed)
+    height, width = image_size
+
+    # like the real ids, the image ids are sparse and the archive is not sorted by them
+    image_ids = sorted(rng.sample(range(1, 100 * num_samples + 1), num_samples))
+    images = [
+        dict(
+            id=image_id,
+            file_name=f"COCO_train2014_{image_id:012d}.jpg",
+            width=width,
+            height=height,
+        )
+        for image_id in image_ids
+    ]
+    rng.shuffle(images)
+    _write_zip(
+        root / "train2014.zip",
+        _with_parents(
+            (f"train2014/{image['file_name']}", encode_jpeg(image_size, rng=rng))
+            for image in images
+        ),
+    )
+
+    annotations = []
+    for image in sorted(images, key=lambda image: image["id"]):
+        # about one percent of the images have no annotations
+        for _ in range(0 if rng.random() < 0.01 else rng.randint(1, 7)):
+            x, y = rng.uniform(0, width / 2), rng.uniform(0, height / 2)
+            w, h = rng.uniform(1, width / 2), rng.uniform(1, height / 2)
+            annotations.append(
+                dict(
+                    id=len(annotations) + 1,
+                    image_id=image["id"],
+                    category_id=rng.randint(1, num_categories),
+                    segmentation=[[x, y, x + w, y, x + w, y + h, x, y + h]],
+                    area=w * h,
+                    bbox=[x, y, w, h],
+                    iscrowd=0,
+                )
+            )
+    content = dict(
+        info=dict(description="synthetic COCO", year=2014),
+        images=images,
+        annotations=annotations,
+        categories=[
+            dict(id=idx, name=f"category_{idx}", supercategory="synthetic")
+            for idx in range(1, num_categories + 1)
+        ],
+    )
+    _write_zip(
+        root / "annotations.zip",
+        _with_parents(
+            [("annotations/instances_train2014.json", json.dumps(content).encode())]
+        ),
+        compression=zipfile.ZIP_DEFLATED,
+    )
+    return root
+
+
+def make_imagenet(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    num_classes: int = 10,
+    image_size: ImageSize = (375, 500),
+    seed: int = 0,
+) -> pathlib.Path:
+    # The train archive is a tar of one tar per class, the val archive is flat.
+    # num_samples is the number of images of each split. The devkit holds the
+    # MATLAB meta file and thus is only written if scipy is available. Without it, the
+    # dataset yields no labels, just like for the real archives.
+    root = _prepare(root)
+    rng = random.Random(seed)
+    wnids = [f"n{rng.randrange(10 ** 8):08d}" for _ in range(num_classes)]
+    wnids.sort()
+
+    members = []
+    for wnid, num_images in zip(
+        wnids, _split(num_samples, *(1 / num_classes,) * (num_classes - 1))
+    ):
+        members.append(
+            (
+                f"{wnid}.tar",
+                _tar_bytes(
+                    (f"{wnid}_{idx}.JPEG", encode_jpeg(image_size, rng=rng))
+                    for idx in sorted(rng.sample(range(1, 10**5), num_images))
+                ),
+            )
+        )
+    _write_tar(root / "ILSVRC2012_img_train.tar", members)
+
+    val_labels = [rng.randint(1, num_classes) for _ in range(num_samples)]
+    _write_tar(
+        root / "ILSVRC2012_img_val.tar",
+        (
+            (f"ILSVRC2012_val_{idx:08d}.JPEG", encode_jpeg(image_size, rng=rng))
+            for idx in range(1, num_samples + 1)
+        ),
+    )
+
+    try:
+        import numpy as np
+        import scipy.io
+    except ImportError:
+        return root
+
+    fields = (
+        "ILSVRC2012_ID",
+        "WNID",
+        "words",
+        "gloss",
+        "num_children",
+        "children",
+        "wordnet_height",
+        "num_train_images",
+    )
+    synsets = np.array(
+        [
+            (
+                label,
+                wnid,
+                f"class {label}, synonym {label}",
+                "synthetic",
+                0,
+                np.array([]),
+                0,
+                0,
+            )
+            for label, wnid in enumerate(wnids, 1)
+        ]
+        # the real devkit also lists the inner nodes of the hierarchy
+        + [
+            (
+                num_classes + 1,
+                "n99999999",
+                "entity",
+                "synthetic",
+                num_classes,
+                np.arange(1, num_classes + 1),
+                1,
+                0,
+            )
+        ],
+        dtype=[(field, object) for field in fields],
+    )
+    _write_tar(
+        root / "ILSVRC2012_devkit_t12.tar.gz",
+        _with_parents(
+            [
+                (
+                    "ILSVRC2012_devkit_t12/data/ILSVRC2012_validation_ground_truth.txt",
+                    "".join(f"{label}\n" for label in val_labels).encode(),
+                ),
+                (
+                    "ILSVRC2012_devkit_t12/data/meta.mat",
+                    _mat_bytes(dict(synsets=synsets)),
+                ),
+            ]
+        ),
+        compress=True,
+    )
+    return root
+
+
+_VOC_CLASSES = (
+    "aeroplane",
+    "bicycle",
+    "bird",
+    "boat",
+    "bottle",
+    "bus",
+    "car",
+    "cat",
+    "chair",
+    "cow",
+    "diningtable",
+    "dog",
+    "horse",
+    "motorbike",
+    "person",
+    "pottedplant",
+    "sheep",
+    "sofa",
+    "train",
+    "tvmonitor",
+)
+
+
+def _voc_annotation(
+    rng: random.Random, name: str, image_size: ImageSize, segmented: bool
+) -> Tuple[bytes, List[Tuple[int, int, int, int, int]]]:
+    height, width = image_size
+    objects = []
+    xml = [
+        "<annotation>",
+        "<folder>VOC2012</folder>",
+        f"<filename>{name}.jpg</filename>",
+        f"<size><width>{width}</width><height>{height}</height><depth>3</depth></size>",
+        f"<segmented>{int(segmented)}</segmented>",
+    ]
+    for _ in range(rng.randint(1, 4)):
+        label = rng.randint(1, len(_VOC_CLASSES))
+        xmin, ymin = rng.randint(1, width // 2), rng.randint(1, height // 2)
+        xmax = rng.randint(xmin + 1, width)
+        ymax = rng.randint(ymin + 1, height)
+        objects.append((label, xmin, ymin, xmax, ymax))
+        xml.extend(
+            (
+                "<object>",
+                f"<name>{_VOC_CLASSES[label - 1]}</name>",
+                "<pose>Unspecified</pose>",
+                "<truncated>0</truncated>",
+                "<difficult>0</difficult>",
+                f"<bndbox><xmin>{xmin}</xmin><ymin>{ymin}</ymin>"
+                f"<xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox>",
+                "</object>",
+            )
+        )
+    xml.append("</annotation>")
+    return "\n".join(xml).encode(), objects
+
+
+def _voc_mask(
+    image_size: ImageSize, objects: Sequence[Tuple[int, int, int, int, int]]
+) -> List[bytes]:
+    # The objects are painted as boxes with the 255 "void" label on their border, as
+    # the outlines in the real masks
+    height, width = image_size
+    rows = [bytearray(width) for _ in range(height)]
+    for label, xmin, ymin, xmax, ymax in objects:
+        for y in range(ymin - 1, ymax):
+            row = rows[y]
+            if y in (ymin - 1, ymax - 1):
+                row[xmin - 1 : xmax] = b"\xff" * (xmax - xmin + 1)
+            else:
+                row[xmin - 1 : xmax] = bytes((label,)) * (xmax - xmin + 1)
+                row[xmin - 1] = row[xmax - 1] = 255
+    return [bytes(row) for row in rows]
+
+
+def make_voc(
+    root: Union[str, pathlib.Path],
+    *,
+    num_samples: int = 100,
+    image_size: ImageSize = (375, 500),
+    seed: int = 0,
+) -> pathlib.Path:
+    # Half of the samples are in the train and half in the val split. Like in the real
+    # dataset, only a subset of them, every fourth, has a segmentation mask.
+    root = _prepare(root)
+    rng = random.Random(seed)
+    palette = _voc_palette()
+    prefix = "VOCdevkit/VOC2012"
+
+    names = [f"2012_{idx:06d}" for idx in range(1, num_samples + 1)]
+    segmented = set(names[::4])
+
+    annotations, images, masks = [], [], []
+    for name in names:
+        xml, objects = _voc_annotation(rng, name, image_size, name in segmented)
+        annotations.append((f"{prefix}/Annotations/{name}.xml", xml))
+        images.append(
+            (f"{prefix}/JPEGImages/{name}.jpg", encode_jpeg(image_size, rng=rng))
+        )
+        if name in segmented:
+            masks.append(
+                (
+                    f"{prefix}/SegmentationClass/{name}.png",
+                    encode_png(_voc_mask(image_size, objects), palette=palette),
+                )
+            )
+
+    image_sets = []
+    for folder, split_names in (
+        ("Main", names),
+        ("Segmentation", [name for name in names if name in segmented]),
+    ):
+        splits = dict(
+            train=split_names[::2], val=split_names[1::2], trainval=split_names
+        )
+        for split, split_names in splits.items():
+            image_sets.append(
+                (
+                    f"{prefix}/ImageSets/{folder}/{split}.txt",
+                    "".join(f"{name}\n" for name in split_names).encode(),
+                )
+            )
+
+    _write_tar(
+        root / "VOCtrainval_11-May-2012.tar",
+        _with_parents([*annotations, *image_sets, *images, *masks]),
+    )
+    return root
+
+
+FIXTURES: Dict[str, Callable[..., pathlib.Path]] = {
+    "caltech101": make_caltech101,
+    "caltech256": make_caltech256,
+    "celeba": make_celeba,
+    "cifar": make_cifar,
+    "coco": make_coco,
+    "imagenet": make_imagenet,
+    "voc": make_voc,
+}
+
+
+def make_fixtures(
+    root: Union[str, pathlib.Path],
+    *,
+    names: Optional[Iterable[str]] = None,
+    num_samples: int = 100,
+    image_size: Optional[ImageSize] = None,
+    seed: int = 0,
+) -> Dict[str, pathlib.Path]:
+    # Every fixture is written to a subfolder of the same name. Without image_size,
+    # every dataset uses the typical size of its real images.
+    root = pathlib.Path(root)
+    roots = {}
+    for name in FIXTURES if names is None else names:
+        make = FIXTURES[name]
+        kwargs: Dict[str, Any] = dict(num_samples=num_samples, seed=seed)
+        if image_size is not None and name != "cifar":
+            kwargs["image_size"] = image_size
+        roots[name] = make(root / name, **kwargs)
+    return roots
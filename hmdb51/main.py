@@ -1,37 +1,117 @@
 import pathlib
-import sys
 import warnings
-from typing import Any, Dict, Iterator, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import torch.utils.data.datapipes as dp
-from torch.utils.data.datapipes.utils.decoder import torch_video
+from torch.utils.data import IterDataPipe
 
+from utils import (
+    aiterate,
+    Clip,
+    DecodeClips,
+    ReadFilesFromArchive,
+    pipeline_state_dict,
+    load_pipeline_state_dict,
+    member_path,
+    Prefetch,
+    Sample,
+    VideoIndex,
+)
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import ReadFilesFromRar
+
+class HMDB51Sample(Sample):
+    __slots__ = ("video_path", "video", "cls")
+
+    def __init__(self, video_path: str, video: Any, cls: str) -> None:
+        self.video_path = video_path
+        self.video = video
+        self.cls = cls
+
+
+class HMDB51ClipSample(Sample):
+    __slots__ = ("video_path", "video", "frames", "fps", "cls")
+
+    def __init__(
+        self, video_path: str, video: Any, frames: List[int], fps: float, cls: str
+    ) -> None:
+        self.video_path = video_path
+        self.video = video
+        self.frames = frames
+        self.fps = fps
+        self.cls = cls
 
 
 class HMDB51:
-    def __init__(self, root: Union[str, pathlib.Path], *, decode: bool = True) -> None:
+    def __init__(
+        self,
+        root: Union[str, pathlib.Path],
+        *,
+        decode: bool = True,
+        prefetch: int = 0,
+        clip_sampler: Optional[Callable[[str, VideoIndex], List[List[int]]]] = None,
+        num_threads: int = 0,
+    ) -> None:
         self.root = pathlib.Path(root)
 
-        datapipe = ((self.root / "hmdb51_org.rar").resolve(),)
-        datapipe = dp.iter.LoadFilesFromDisk(str(file) for file in datapipe)
-        datapipe = ReadFilesFromRar(datapipe)
-        datapipe = ReadFilesFromRar(datapipe)
-        if decode:
+        datapipe = self._archive_datapipe()
+        if clip_sampler:
+            # one sample per clip, for which only the needed frames are decoded
+            datapipe = DecodeClips(datapipe, clip_sampler, num_threads=num_threads)
+        elif decode:
+            # the video decoder pulls in torchvision / av, so only import it if needed
+            from torch.utils.data.datapipes.utils.decoder import torch_video
+
             datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[torch_video])
+        datapipe = Prefetch(datapipe, buffer_size=prefetch)
         self.datapipe = datapipe
 
-    def __iter__(self) -> Iterator[Dict[str, Any]]:
-        for path, video in self.datapipe:
-            cls = pathlib.Path(path).parent.name
-            yield dict(video_path=path, video=video, cls=cls)
+    def _archive_datapipe(self, *, headers_only: bool = False) -> IterDataPipe:
+        datapipe = (str((self.root / "hmdb51_org.rar").resolve()),)
+        datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+        # the archive is a rar of rars
+        return ReadFilesFromArchive(datapipe, nested=True, headers_only=headers_only)
+
+    def __iter__(self) -> Iterator[Union[HMDB51Sample, HMDB51ClipSample]]:
+        for data in self.datapipe:
+            yield self._sample(data)
+
+    def __aiter__(self) -> AsyncIterator[Union[HMDB51Sample, HMDB51ClipSample]]:
+        # With prefetch, up to that many videos are decoded at the same time
+        return aiterate(self.datapipe, fn=self._sample)
+
+    def _sample(self, data: Tuple[str, Any]) -> Union[HMDB51Sample, HMDB51ClipSample]:
+        path, video = data
+        cls = member_path(path).parents[0]
+        if isinstance(video, Clip):
+            return HMDB51ClipSample(path, video.video, video.frames, video.fps, cls)
+        return HMDB51Sample(path, video, cls)
+
+    def metadata(self) -> Iterator[Dict[str, Any]]:
+        # The videos are never opened, which would mean extracting them
+        for path, info in self._archive_datapipe(headers_only=True):
+            cls = member_path(path).parents[0]
+            yield dict(video_path=path, size=info.file_size, cls=cls)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return pipeline_state_dict(self.datapipe)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state)
 
 
 if __name__ == "__main__":
     # TODO: Without this a warning is emitted for every decoded video
     warnings.simplefilter("ignore", UserWarning)
 
-    for sample in HMDB51("."):
+    for sample in HMDB51(pathlib.Path(__file__).parent):
         pass
@@ -1,11 +1,10 @@
 import pathlib
-import sys
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
 from benchmark_utils import benchmark
 
-from main import ImageNet
+from imagenet.main import ImageNet
 
+ROOT = pathlib.Path(__file__).parent
 
-benchmark(lambda: ImageNet(".", decoder=None), "ImageNet", "no image decoding", n=None)
-benchmark(lambda: ImageNet("."), "ImageNet", n=None)
+benchmark(lambda: ImageNet(ROOT, decoder=None), "ImageNet", "no image decoding", n=None)
+benchmark(lambda: ImageNet(ROOT), "ImageNet", n=None)
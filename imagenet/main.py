@@ -1,79 +1,194 @@
+import io
 import pathlib
-import sys
-from typing import Any, Dict, Union, Iterator, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Union,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
 import torch.utils.data.datapipes as dp
-from torch.utils.data.datapipes.utils.decoder import imagehandler
+from torch.utils.data import IterDataPipe
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import find
+from utils import (
+    aiterate,
+    find,
+    imagehandler,
+    ReadFilesFromArchive,
+    pipeline_state_dict,
+    load_pipeline_state_dict,
+    MemberPath,
+    member_path,
+    Verify,
+    Prefetch,
+    ProbeImages,
+    Sample,
+    SharedMapping,
+    shared,
+)
+
+
+MD5S = {
+    "ILSVRC2012_img_train.tar": "1d675b47d978889d74fa0da5fadfb00e",
+    "ILSVRC2012_img_val.tar": "29b22e2961454d5413ddabcf34fc5622",
+}
 
 
 class _ImageNetMeta:
-    def __init__(self, root: pathlib.Path, *, split: str):
+    def __init__(
+        self,
+        root: pathlib.Path,
+        *,
+        split: str,
+        wnids: Optional[Collection[str]] = None,
+        classes: Optional[Collection[str]] = None,
+    ):
         self.split = split
-        self.available = False
+        self.available = self._load_devkit(root)
 
+        if classes is not None:
+            if not self.available:
+                raise RuntimeError("Selecting classes by name requires the devkit")
+            classes = set(classes)
+            unknown = classes.difference(*(clss for _, clss in self._synsets.values()))
+            if unknown:
+                raise ValueError(f"Unknown classes {sorted(unknown)}")
+            wnids = [
+                wnid
+                for wnid, (_, clss) in self._synsets.items()
+                if classes.intersection(clss)
+            ]
+        elif wnids is not None:
+            if self.available:
+                unknown = set(wnids).difference(self._synsets)
+                if unknown:
+                    raise ValueError(f"Unknown wnids {sorted(unknown)}")
+            elif split != "train":
+                raise RuntimeError(
+                    "Selecting classes for the validation split requires the devkit"
+                )
+
+        # The labels of a subset are remapped to a compact range. Since the labels of
+        # the devkit are assigned in sorted order of the wnids, we can do the same.
+        self.wnids: Optional[FrozenSet[str]] = (
+            frozenset(wnids) if wnids is not None else None
+        )
+        self._compact_labels: Optional[Dict[str, int]] = (
+            {wnid: label for label, wnid in enumerate(sorted(self.wnids), 1)}
+            if self.wnids is not None
+            else None
+        )
+
+    def _load_devkit(self, root: pathlib.Path) -> bool:
+        # The devkit is only parsed once. Afterwards, every process, e.g. a DataLoader
+        # worker, memory maps the metadata from the cache.
         devkit = root / f"ILSVRC2012_devkit_t12.tar.gz"
         if not devkit.exists():
-            return
+            return False
 
         try:
-            import scipy.io
+            self._synsets = shared(
+                "imagenet-synsets", (devkit,), lambda: _read_synsets(devkit)
+            )
+            self._val_wnids = shared(
+                "imagenet-val",
+                (devkit,),
+                lambda: _read_val_wnids(devkit, self._synsets),
+            )
         except ImportError:
-            return
+            # scipy is only needed to parse the devkit
+            return False
 
-        self.available = True
+        return True
 
-        datapipe = (str(devkit),)
-        datapipe = dp.iter.LoadFilesFromDisk(datapipe)
-        datapipe = dp.iter.ReadFilesFromTar(datapipe)
+    def _wnid(self, path: MemberPath) -> Optional[str]:
+        if self.split == "train":
+            return path.stem.split("_")[0]
+        elif self.available:  # self.split == "val"
+            return self._val_wnids[path.name]
+        else:
+            return None
 
-        (_, stream), datapipe = find(
-            datapipe,
-            "ILSVRC2012_validation_ground_truth.txt",
-            lambda data: pathlib.Path(data[0]).name,
-        )
-        self._val_labels = {
-            f"ILSVRC2012_val_{idx:08d}.JPEG": label
-            for idx, label in enumerate(
-                (int(line.decode().strip()) for line in stream), 1
-            )
-        }
+    def selects(self, path: MemberPath) -> bool:
+        # For the train split this is called with the paths of the inner class tars as
+        # well as with the paths of the images.
+        return self.wnids is None or self._wnid(path) in self.wnids
 
-        (_, stream), datapipe = find(
-            datapipe, "meta.mat", lambda data: pathlib.Path(data[0]).name
-        )
-        synsets = scipy.io.loadmat(stream, squeeze_me=True)["synsets"]
-        labels, wnids, clss = zip(
-            *(
-                (label, wnid, tuple(classes.split(", ")))
-                for label, wnid, classes, _, num_children, *_ in synsets
-                if num_children == 0
-            )
-        )
-        self._wnid_to_label = dict(zip(wnids, labels))
-        self._label_to_wnid = dict(zip(labels, wnids))
-        self._label_to_cls = dict(zip(labels, clss))
+    def labels(
+        self, path: Union[str, pathlib.Path]
+    ) -> Tuple[Optional[int], Optional[str], Optional[Tuple[str, ...]]]:
+        path = member_path(path)
+        wnid = self._wnid(path)
+        label, cls = self._synsets[wnid] if self.available else (None, None)
+
+        # The compact labels only need the wnid. Thus, they are also available for the
+        # train split without the devkit.
+        if wnid is not None and self._compact_labels is not None:
+            label = self._compact_labels[wnid]
+
+        return label, wnid, cls
 
     def __call__(self, path: Union[str, pathlib.Path]) -> Dict[str, Any]:
-        path = pathlib.Path(path)
-        if self.split == "train":
-            wnid = path.stem.split("_")[0]
-            label = None
-        else:  # self.split == "val"
-            label = self._val_labels[path.name] if self.available else None
-            wnid = None
+        label, wnid, cls = self.labels(path)
+        return dict(label=label, wnid=wnid, cls=cls)
 
-        if self.available:
-            if label:
-                wnid = self._label_to_wnid[label]
-            elif wnid:
-                label = self._wnid_to_label[wnid]
 
-        cls = self._label_to_cls[label] if label else None
+def _read_devkit_member(devkit: pathlib.Path, name: str) -> bytes:
+    datapipe: Iterable = (str(devkit),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    datapipe = ReadFilesFromArchive(datapipe)
+    (_, stream), datapipe = find(datapipe, name, lambda data: member_path(data[0]).name)
+    return stream.read()
 
-        return dict(label=label, wnid=wnid, cls=cls)
+
+def _read_synsets(devkit: pathlib.Path) -> SharedMapping:
+    # wnid -> (label, classes) of the leaf synsets
+    import scipy.io
+
+    synsets = scipy.io.loadmat(
+        io.BytesIO(_read_devkit_member(devkit, "meta.mat")), squeeze_me=True
+    )["synsets"]
+    return SharedMapping(
+        (str(wnid), (int(label), tuple(classes.split(", "))))
+        for label, wnid, classes, _, num_children, *_ in synsets
+        if num_children == 0
+    )
+
+
+def _read_val_wnids(devkit: pathlib.Path, synsets: SharedMapping) -> SharedMapping:
+    # file name -> wnid of the validation images
+    label_to_wnid = {label: wnid for wnid, (label, _) in synsets.items()}
+    lines = _read_devkit_member(
+        devkit, "ILSVRC2012_validation_ground_truth.txt"
+    ).splitlines()
+    return SharedMapping(
+        (f"ILSVRC2012_val_{idx:08d}.JPEG", label_to_wnid[int(line)])
+        for idx, line in enumerate(lines, 1)
+    )
+
+
+class ImageNetSample(Sample):
+    __slots__ = ("image_path", "image", "label", "wnid", "cls")
+
+    def __init__(
+        self,
+        image_path: str,
+        image: Any,
+        label: Optional[int],
+        wnid: Optional[str],
+        cls: Optional[Tuple[str, ...]],
+    ) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.label = label
+        self.wnid = wnid
+        self.cls = cls
 
 
 class ImageNet:
@@ -83,28 +198,82 @@ class ImageNet:
         *,
         split: str = "train",
         decoder: Optional[str] = "pil",
+        zero_copy: bool = False,
+        wnids: Optional[Collection[str]] = None,
+        classes: Optional[Collection[str]] = None,
+        verify: bool = False,
+        prefetch: int = 0,
     ):
         self.root = pathlib.Path(root)
         self.split = split
-        self._meta = _ImageNetMeta(self.root, split=self.split)
+        self._meta = _ImageNetMeta(
+            self.root, split=self.split, wnids=wnids, classes=classes
+        )
 
-        datapipe = (str((self.root / f"ILSVRC2012_img_{split}.tar").resolve()),)
-        datapipe = dp.iter.LoadFilesFromDisk(datapipe)
-        datapipe = dp.iter.ReadFilesFromTar(datapipe)
-        if split == "train":
-            # the train archive is a tar of tars
-            datapipe = dp.iter.ReadFilesFromTar(datapipe)
+        datapipe = self._archive_datapipe(zero_copy=zero_copy, verify=verify)
         if decoder:
             datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[imagehandler(decoder)])
+        # with prefetch, decodes in the background while the consumer works on the
+        # previous images
+        datapipe = Prefetch(datapipe, buffer_size=prefetch)
         self.datapipe = datapipe
 
-    def __iter__(self) -> Iterator[Dict[str, Any]]:
-        for path, image in self.datapipe:
-            sample = dict(image_path=path, image=image)
+    def _archive_datapipe(
+        self, *, zero_copy: bool = False, verify: bool = False
+    ) -> IterDataPipe:
+        datapipe = (str((self.root / f"ILSVRC2012_img_{self.split}.tar").resolve()),)
+        datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+        if verify:
+            datapipe = Verify(datapipe, MD5S)
+        # the train archive is a tar of tars
+        return ReadFilesFromArchive(
+            datapipe,
+            nested=self.split == "train",
+            zero_copy=zero_copy,
+            filter_fn=self._meta.selects if self._meta.wnids is not None else None,
+        )
+
+    def __iter__(self) -> Iterator[ImageNetSample]:
+        for data in self.datapipe:
+            yield self._sample(data)
+
+    def __aiter__(self) -> AsyncIterator[ImageNetSample]:
+        # With prefetch, up to that many images are decoded at the same time
+        return aiterate(self.datapipe, fn=self._sample)
+
+    def _sample(self, data: Tuple[str, Any]) -> ImageNetSample:
+        path, image = data
+        return ImageNetSample(path, image, *self._meta.labels(path))
+
+    def metadata(self, *, probe: bool = False) -> Iterator[Dict[str, Any]]:
+        # The labels are either encoded in the paths or stored in the devkit. Thus, we
+        # only need to walk the headers of the archive, which skips over the images.
+        # With probe, the headers of the images are read as well.
+        datapipe = self._archive_datapipe()
+        if probe:
+            datapipe = ProbeImages(datapipe)
+        for path, info in datapipe:
+            sample = dict(image_path=path, size=info.size)
+            if probe:
+                sample.update(info._asdict())
             sample.update(self._meta(path))
             yield sample
 
+    def annotations(self) -> Iterator[Dict[str, Any]]:
+        # One flat row per image for utils.write_table, keyed by the file name. Like
+        # metadata(), this only walks the headers of the archive.
+        for path, _ in self._archive_datapipe():
+            row = dict(sample_id=member_path(path).name)
+            row.update(self._meta(path))
+            yield row
+
+    def state_dict(self) -> Dict[str, Any]:
+        return pipeline_state_dict(self.datapipe)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state)
+
 
 if __name__ == "__main__":
-    for sample in ImageNet(".", split="train"):
+    for sample in ImageNet(pathlib.Path(__file__).parent, split="train"):
         pass
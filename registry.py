@@ -0,0 +1,97 @@
+import importlib
+import inspect
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+__all__ = ["register", "list_datasets", "get", "load", "autotune"]
+
+# Maps the dataset name to the module and attribute of its entry point. The module is
+# only imported once the dataset is requested, so importing this registry is cheap,
+# e.g. when a spawned DataLoader worker re-imports the dataset definitions.
+_REGISTRY: Dict[str, Tuple[str, str]] = {
+    "caltech101": ("caltech101.main", "caltech101"),
+    "caltech256": ("caltech256.main", "caltech256"),
+    "celeba": ("celeba.main", "celeba"),
+    "cifar10": ("cifar.main", "CIFAR10"),
+    "cifar100": ("cifar.main", "CIFAR100"),
+    "coco": ("coco.main", "coco"),
+    "hmdb51": ("hmdb51.main", "HMDB51"),
+    "imagenet": ("imagenet.main", "ImageNet"),
+    "voc": ("voc.main", "VOC"),
+}
+
+
+def _usable_cpus() -> int:
+    # Respects the affinity of the process, e.g. the CPUs a job scheduler assigned
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _num_threads_candidates() -> List[int]:
+    # Reading in the calling thread and then doubling the pool up to the usable CPUs
+    cpus = _usable_cpus()
+    candidates = [0]
+    num_threads = 1
+    while num_threads < cpus:
+        candidates.append(num_threads)
+        num_threads *= 2
+    candidates.append(cpus)
+    return candidates
+
+
+def _prefetch_candidates() -> List[int]:
+    # Doubling the buffer while it pays off. Buffers that exceed the memory budget are
+    # rejected by Autotune, so there is no need for a fixed upper bound below that.
+    return [0, *(2**exponent for exponent in range(1, 11))]
+
+
+# Candidate values of the knobs that the datasets expose, in the order they are tried.
+# Autotune stops trying the values of a knob as soon as the throughput stops improving.
+_KNOBS: Dict[str, Callable[[], List[Any]]] = {
+    "num_threads": _num_threads_candidates,
+    "prefetch": _prefetch_candidates,
+}
+
+
+def register(name: str, module: str, attr: str) -> None:
+    if name in _REGISTRY:
+        raise ValueError(f"A dataset with the name {name} is already registered")
+
+    _REGISTRY[name] = (module, attr)
+
+
+def list_datasets() -> List[str]:
+    return sorted(_REGISTRY.keys())
+
+
+def get(name: str) -> Callable[..., Any]:
+    try:
+        module, attr = _REGISTRY[name]
+    except KeyError as error:
+        raise ValueError(
+            f"Unknown dataset {name}. "
+            f"Available datasets are {', '.join(list_datasets())}."
+        ) from error
+
+    return getattr(importlib.import_module(module), attr)
+
+
+def load(name: str, *args: Any, **kwargs: Any) -> Any:
+    return get(name)(*args, **kwargs)
+
+
+def autotune(name: str, *args: Any, **kwargs: Any) -> Any:
+    # Knobs that are passed explicitly are pinned and thus not tuned
+    from utils import Autotune
+
+    factory = get(name)
+    parameters = inspect.signature(factory).parameters
+    knobs = {
+        knob: candidates()
+        for knob, candidates in _KNOBS.items()
+        if knob in parameters and knob not in kwargs
+    }
+    # The dataset is built only once. Autotune sets the knobs on its stages.
+    return Autotune(factory(*args, **kwargs), knobs)
@@ -0,0 +1,157 @@
+import hashlib
+import io
+import itertools
+import pickle
+import tarfile
+import warnings
+from typing import Any, Dict, List, Tuple
+
+import pytest
+import torch.utils.data.datapipes as dp
+
+import registry
+import utils
+from fixtures import make_fixtures
+from utils import Verify, optimize
+
+# name, fixture, args relative to the fixture root, and kwargs that skip the decoding
+DATASETS = [
+    ("caltech256", "caltech256", (), dict(handler=None)),
+    ("celeba", "celeba", (), dict(decoder=None, prefetch=4)),
+    (
+        "coco",
+        "coco",
+        ("train2014.zip", "annotations.zip"),
+        dict(decoder=None),
+    ),
+    ("imagenet", "imagenet", (), dict(split="train", decoder=None, prefetch=4)),
+    ("voc", "voc", (), dict(decoder=None)),
+    ("voc", "voc", (), dict(target_type="segmentation", decoder=None)),
+]
+
+
+@pytest.fixture(scope="module")
+def roots(tmp_path_factory):
+    return make_fixtures(
+        tmp_path_factory.mktemp("fixtures"),
+        names={fixture for _, fixture, _, _ in DATASETS},
+        num_samples=20,
+        image_size=(16, 16),
+    )
+
+
+def _load(roots, name, fixture, args, kwargs):
+    root = roots[fixture]
+    return registry.load(name, *(root / arg for arg in args or (root,)), **kwargs)
+
+
+def _comparable(sample: Any) -> List[Tuple[str, Any]]:
+    # The streams are compared by their content and nested data by its repr
+    items = []
+    for key, value in dict(sample).items():
+        if hasattr(value, "read"):
+            value = value.read()
+        elif not isinstance(value, (str, int, float, type(None))):
+            value = repr(value)
+        items.append((key, value))
+    return items
+
+
+@pytest.mark.parametrize(("name", "fixture", "args", "kwargs"), DATASETS)
+def test_resume_mid_epoch(roots, name, fixture, args, kwargs):
+    expected = [
+        _comparable(sample) for sample in _load(roots, name, fixture, args, kwargs)
+    ]
+    assert expected
+
+    for num_samples in (0, 1, len(expected) // 2, len(expected)):
+        dataset = _load(roots, name, fixture, args, kwargs)
+        head = [
+            _comparable(sample)
+            for sample in itertools.islice(iter(dataset), num_samples)
+        ]
+        state = pickle.loads(pickle.dumps(dataset.state_dict()))
+
+        resumed = _load(roots, name, fixture, args, kwargs)
+        resumed.load_state_dict(state)
+        tail = [_comparable(sample) for sample in resumed]
+
+        assert head == expected[:num_samples]
+        assert tail == expected[num_samples:]
+
+
+@pytest.mark.parametrize(("name", "fixture", "args", "kwargs"), DATASETS)
+def test_optimize(roots, name, fixture, args, kwargs):
+    expected = [
+        _comparable(sample) for sample in _load(roots, name, fixture, args, kwargs)
+    ]
+    actual = [
+        _comparable(sample)
+        for sample in optimize(_load(roots, name, fixture, args, kwargs))
+    ]
+    assert actual == expected
+
+
+def test_budgeted_queue_spill_order(monkeypatch):
+    monkeypatch.setattr(utils._MEMORY_BUDGET, "limit", 10_000)
+    items = [bytes([idx]) * 1_000 for idx in range(50)]
+
+    queue = utils._BudgetedQueue("test")
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter("always")
+        for item in items:
+            queue.put(item)
+
+    assert any("spilling test" in str(record.message) for record in records)
+    assert any(isinstance(entry, utils._Spilled) for entry in queue._entries)
+    assert list(queue) == items
+    assert list(queue.drain()) == items
+    assert queue.empty()
+
+
+def _write_tar(path, members: Dict[str, bytes]) -> None:
+    with tarfile.open(path, "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _verify(path, checksum: str) -> List[str]:
+    datapipe = dp.iter.LoadFilesFromDisk([str(path)])
+    datapipe = Verify(datapipe, {path.name: checksum})
+    return [path for path, stream in datapipe]
+
+
+def test_verify(tmp_path):
+    path = tmp_path / "archive.tar"
+    _write_tar(path, {"a.txt": b"a" * 1_000, "b.txt": b"b" * 1_000})
+    checksum = hashlib.md5(path.read_bytes()).hexdigest()
+
+    assert _verify(path, checksum) == [str(path)]
+
+
+def test_verify_rejects_corrupted_archive(tmp_path):
+    path = tmp_path / "archive.tar"
+    _write_tar(path, {"a.txt": b"a" * 1_000, "b.txt": b"b" * 1_000})
+    checksum = hashlib.md5(path.read_bytes()).hexdigest()
+
+    # Same size, but a single byte of the data differs
+    data = bytearray(path.read_bytes())
+    data[data.index(b"b" * 1_000)] = ord("c")
+    path.write_bytes(bytes(data))
+
+    with pytest.raises(RuntimeError, match="checksum"):
+        _verify(path, checksum)
+
+
+@pytest.mark.parametrize("suffix", [".arrow", ".parquet"])
+def test_annotation_table_without_rows(tmp_path, suffix):
+    pytest.importorskip("pyarrow")
+
+    table = utils.AnnotationTable(utils.write_table([], tmp_path / f"table{suffix}"))
+
+    assert len(table) == 0
+    assert "sample_id" not in table
+    with pytest.raises(KeyError):
+        table["sample_id"]
@@ -1,29 +1,80 @@
+import abc
+import array
+import asyncio
+import bisect
+import bz2
 import collections
+import concurrent.futures
+import contextlib
+import copy
 import csv
+import functools
+import gzip
+import hashlib
+import inspect
 import io
 import itertools
+import json
+import logging
+import lzma
+import mmap
+import os
 import pathlib
+import pickle
+import posixpath
 import queue
+import random
+import re
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import warnings
+import weakref
+import zipfile
+import zlib
+from collections.abc import Mapping, MutableMapping
 from typing import (
     Any,
+    AsyncIterator,
     Callable,
+    Deque,
     Dict,
+    FrozenSet,
     Generic,
     Iterable,
     List,
     Iterator,
+    NamedTuple,
     Optional,
+    Sequence,
+    Set,
     Union,
     Tuple,
+    Type,
     TypeVar,
+    cast,
 )
 
+import torch.utils.data.datapipes as dp
 from torch.utils.data import IterDataPipe
 from torch.utils.data.datapipes.utils.common import validate_pathname_binary_tuple
+from torch.utils.data.datapipes.utils.decoder import Decoder
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
 
 __all__ = [
     "mathandler",
+    "imagehandler",
+    "MemoryBudget",
+    "memory_budget",
     "Drop",
+    "DropByPath",
     "next_until_key",
     "DependentDrop",
     "DependentGroupByKey",
@@ -31,12 +82,48 @@ __all__ = [
     "SplitByKey",
     "ReadLineFromFile",
     "collate_sample",
+    "Sample",
     "find",
     "ReadFilesFromRar",
+    "ReadFilesFromTar",
+    "ReadFilesFromZip",
+    "ReadFilesFromArchive",
+    "Verify",
+    "MemberRef",
+    "MemberPath",
+    "member_path",
+    "MemberIndex",
+    "SharedMapping",
+    "shared",
+    "pipeline_state_dict",
+    "load_pipeline_state_dict",
+    "Resumable",
+    "ResumableInput",
+    "optimize",
+    "Prefetch",
+    "Interleave",
+    "Autotune",
+    "aiterate",
+    "BatchImages",
+    "decode_image_into",
+    "decode_mask",
+    "decode_mask_into",
+    "DecodeMasks",
+    "ImageInfo",
+    "probe_image",
+    "ProbeImages",
+    "VideoIndex",
+    "Clip",
+    "UniformClipSampler",
+    "RandomClipSampler",
+    "DecodeClips",
+    "write_table",
+    "AnnotationTable",
 ]
 
 D = TypeVar("D")
 K = TypeVar("K")
+P = TypeVar("P", bound="_PackedIndex")
 
 
 class MatHandler:
@@ -58,6 +145,51 @@ def mathandler(**loadmat_kwargs: Any) -> MatHandler:
     return MatHandler(**loadmat_kwargs)
 
 
+class ImageHandler:
+    # Drop-in for torch's image handler that decodes the memoryviews yielded with
+    # zero_copy=True through a reader over the view. torch's handler wraps the data into
+    # an io.BytesIO, which copies the encoded image first. Everything else is passed on.
+    def __init__(self, imagespec: str) -> None:
+        from torch.utils.data.datapipes.utils.decoder import imagehandler
+
+        self.imagespec = imagespec.lower()
+        self._handler = imagehandler(imagespec)
+
+    def __call__(self, key: str, data: Any) -> Any:
+        if not isinstance(data, memoryview):
+            return self._handler(key, data)
+
+        # key is either the extension or the full path depending on the torch version
+        if key.rsplit(".", 1)[-1].lower() not in _IMAGE_EXTENSIONS:
+            return None
+
+        import numpy as np
+        import torch
+        from torch.utils.data.datapipes.utils.decoder import imagespecs
+
+        atype, etype, mode = imagespecs[self.imagespec]
+        image = _open_image(data)
+        image.load()
+        if mode:
+            image = image.convert(mode.upper())
+        if atype == "pil":
+            return image
+
+        array = np.asarray(image)
+        if atype == "numpy":
+            return array if etype == "uint8" else array.astype("f") / 255.0
+
+        # Like torch's handler, grayscale images stay two-dimensional
+        if array.ndim == 3:
+            array = array.transpose(2, 0, 1)
+        tensor = torch.tensor(np.array(array))
+        return tensor if etype == "uint8" else tensor / 255.0
+
+
+def imagehandler(imagespec: str) -> ImageHandler:
+    return ImageHandler(imagespec)
+
+
 class Drop(IterDataPipe):
     def __init__(self, datapipe: Iterable[D], condition: Callable[[D], bool]) -> None:
         super().__init__()
@@ -72,8 +204,322 @@ class Drop(IterDataPipe):
             yield data
 
 
+class DropByPath(IterDataPipe):
+    # Like Drop, but the condition only sees the path of the (path, data) pairs. Thus,
+    # optimize() may move it below the stages that keep the paths, e.g. decoders, or
+    # even into the filter_fn of an archive reader.
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, D]],
+        condition: Callable[["MemberPath"], bool],
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.condition = condition
+
+    def __iter__(self) -> Iterator[Tuple[str, D]]:
+        for data in self.datapipe:
+            if self.condition(member_path(data[0])):
+                continue
+
+            yield data
+
+
+def _sizeof(obj: Any) -> int:
+    # Rough estimate of the memory held by an item, which is all the budget needs
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    elif isinstance(obj, memoryview):
+        return obj.nbytes
+    elif isinstance(obj, MemberRef):
+        stream = obj._stream if obj._stream is not None else obj._source
+        if isinstance(stream, io.BytesIO) and not stream.closed:
+            with stream.getbuffer() as view:
+                return sys.getsizeof(obj) + view.nbytes
+        return sys.getsizeof(obj)
+    elif isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(_sizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            _sizeof(key) + _sizeof(value) for key, value in obj.items()
+        )
+    elif isinstance(obj, Sample):
+        return sys.getsizeof(obj) + sum(_sizeof(value) for value in obj.values())
+
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy arrays and torch tensors
+        return nbytes
+    elif hasattr(obj, "getbands") and hasattr(obj, "size"):
+        # PIL images
+        width, height = obj.size
+        return width * height * len(obj.getbands())
+
+    return sys.getsizeof(obj)
+
+
+class _BudgetAccount:
+    def __init__(self, name: str, spill: Optional[Callable[[], None]]) -> None:
+        self.name = name
+        self.spill = spill
+        self.nbytes = 0
+
+
+class MemoryBudget:
+    # Process-wide accounting of the bytes held by the buffers of all datapipes. If the
+    # limit is exceeded, the largest buffers are spilled to disk and the stages that
+    # hold the memory are reported. Threads that produce ahead, e.g. Prefetch, wait
+    # until memory is available again.
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self._accounts: "weakref.WeakSet[_BudgetAccount]" = weakref.WeakSet()
+        self._reported: set = set()
+        self._lock = threading.RLock()
+
+    def account(
+        self, name: str, *, spill: Optional[Callable[[], None]] = None
+    ) -> _BudgetAccount:
+        account = _BudgetAccount(name, spill)
+        with self._lock:
+            self._accounts.add(account)
+        return account
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(account.nbytes for account in self._accounts)
+
+    def exceeded(self) -> bool:
+        return self.limit is not None and self.total() > self.limit
+
+    def usage(self) -> Dict[str, int]:
+        usage: Dict[str, int] = collections.defaultdict(int)
+        with self._lock:
+            for account in self._accounts:
+                usage[account.name] += account.nbytes
+        return dict(sorted(usage.items(), key=lambda item: item[1], reverse=True))
+
+    def charge(self, account: _BudgetAccount, nbytes: int) -> None:
+        with self._lock:
+            account.nbytes += nbytes
+            if nbytes <= 0 or not self.exceeded():
+                return
+
+            for candidate in sorted(
+                self._accounts, key=lambda account: account.nbytes, reverse=True
+            ):
+                if candidate.spill is None or not candidate.nbytes:
+                    continue
+
+                self._report(f"spilling {candidate.name}", candidate.name)
+                candidate.spill()
+                if not self.exceeded():
+                    return
+
+            self._report("nothing left to spill", None)
+
+    def _report(self, action: str, name: Optional[str]) -> None:
+        # Only report once per stage to not flood the output
+        if name in self._reported:
+            return
+        self._reported.add(name)
+
+        usage = ", ".join(
+            f"{stage}: {nbytes}" for stage, nbytes in self.usage().items() if nbytes
+        )
+        warnings.warn(
+            f"The memory budget of {self.limit} bytes is exceeded, {action}. "
+            f"Buffered bytes per stage: {usage}"
+        )
+
+
+_MEMORY_BUDGET = MemoryBudget(
+    int(os.environ["DATAPIPES_MEMORY_LIMIT"])
+    if "DATAPIPES_MEMORY_LIMIT" in os.environ
+    else None
+)
+
+
+def memory_budget() -> MemoryBudget:
+    return _MEMORY_BUDGET
+
+
+class _SpillFile:
+    def __init__(self) -> None:
+        self._file: Optional[Any] = None
+
+    def write(self, obj: Any) -> Tuple[int, int]:
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        self._file.seek(0, io.SEEK_END)
+        offset = self._file.tell()
+        pickle.dump(obj, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        return offset, self._file.tell() - offset
+
+    def read(self, location: Tuple[int, int]) -> Any:
+        offset, length = location
+        self._file.seek(offset)
+        return pickle.loads(self._file.read(length))
+
+    def __del__(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class _InMemory(NamedTuple):
+    item: Any
+    nbytes: int
+
+
+class _Spilled(NamedTuple):
+    location: Tuple[int, int]
+
+
+class _BudgetedBuffer(abc.ABC):
+    # Holds items in memory and accounts for them with the memory budget. If the budget
+    # decides so, the items are pickled to a temporary file until they are needed.
+    # The budget might spill from another thread, so the entries are guarded by a lock.
+    # The lock is never held while charging the budget to avoid lock order inversions.
+    def __init__(self, name: str) -> None:
+        self._lock = threading.RLock()
+        self._spill_file = _SpillFile()
+        self._spillable = True
+        spill = weakref.WeakMethod(self._spill)
+        self._account = _MEMORY_BUDGET.account(name, spill=lambda: spill()())
+
+    def _wrap(self, item: Any) -> _InMemory:
+        entry = _InMemory(item, _sizeof(item))
+        _MEMORY_BUDGET.charge(self._account, entry.nbytes)
+        return entry
+
+    def _unwrap(self, entry: Union[_InMemory, _Spilled]) -> Any:
+        if isinstance(entry, _Spilled):
+            with self._lock:
+                return self._spill_file.read(entry.location)
+
+        _MEMORY_BUDGET.charge(self._account, -entry.nbytes)
+        return entry.item
+
+    def _peek(self, entry: Union[_InMemory, _Spilled]) -> Any:
+        if isinstance(entry, _Spilled):
+            with self._lock:
+                return self._spill_file.read(entry.location)
+        return entry.item
+
+    def _spill_entry(
+        self, entry: Union[_InMemory, _Spilled]
+    ) -> Union[_InMemory, _Spilled]:
+        if isinstance(entry, _Spilled) or not self._spillable:
+            return entry
+
+        try:
+            spilled = _Spilled(self._spill_file.write(entry.item))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # Items like open file objects cannot be spilled
+            self._spillable = False
+            return entry
+
+        self._account.nbytes -= entry.nbytes
+        return spilled
+
+    @abc.abstractmethod
+    def _spill(self) -> None:
+        # Called by the memory budget to move all spillable entries to the spill file
+        pass
+
+
+class _BudgetedDict(_BudgetedBuffer, MutableMapping):
+    def __init__(self, name: str, items: Iterable[Tuple[Any, Any]] = ()) -> None:
+        super().__init__(name)
+        self._entries: Dict[Any, Union[_InMemory, _Spilled]] = dict()
+        self.update(items)
+
+    def __getitem__(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._entries[key]
+        return self._peek(entry)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if key in self._entries:
+            del self[key]
+        entry = self._wrap(value)
+        with self._lock:
+            self._entries[key] = entry
+
+    def __delitem__(self, key: Any) -> None:
+        with self._lock:
+            entry = self._entries.pop(key)
+        self._unwrap(entry)
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        with self._lock:
+            if key not in self._entries and default:
+                return default[0]
+            entry = self._entries.pop(key)
+        return self._unwrap(entry)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[Any]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _spill(self) -> None:
+        with self._lock:
+            for key, entry in self._entries.items():
+                self._entries[key] = self._spill_entry(entry)
+
+
+class _BudgetedQueue(_BudgetedBuffer):
+    def __init__(self, name: str, items: Iterable[Any] = ()) -> None:
+        super().__init__(name)
+        self._entries: Deque[Union[_InMemory, _Spilled]] = collections.deque()
+        for item in items:
+            self.put(item)
+
+    def put(self, item: Any) -> None:
+        entry = self._wrap(item)
+        with self._lock:
+            self._entries.append(entry)
+
+    def get(self) -> Any:
+        with self._lock:
+            entry = self._entries.popleft()
+        return self._unwrap(entry)
+
+    def empty(self) -> bool:
+        return not self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Any]:
+        # In contrast to drain(), this does not remove the items
+        with self._lock:
+            entries = list(self._entries)
+        for entry in entries:
+            yield self._peek(entry)
+
+    def drain(self) -> Iterator[Any]:
+        while self._entries:
+            yield self.get()
+
+    def _spill(self) -> None:
+        with self._lock:
+            self._entries = collections.deque(
+                self._spill_entry(entry) for entry in self._entries
+            )
+
+
 def next_until_key(
-    datapipe: Iterable[D], *, key_fn: Callable[[D], K], key: K, buffer: Dict[K, D]
+    datapipe: Iterable[D],
+    *,
+    key_fn: Callable[[D], K],
+    key: K,
+    buffer: MutableMapping[K, D],
 ) -> D:
     if key in buffer:
         return buffer.pop(key)
@@ -88,25 +534,58 @@ def next_until_key(
         raise RuntimeError(f"Key {key} was never found")
 
 
-class DependentDrop(Drop):
+class DependentDrop(IterDataPipe):
     def __init__(
         self,
         datapipe: Iterable[D],
         condition_datapipe: Iterable[Tuple[K, bool]],
         *,
         key_fn: Callable[[D], K],
+        prefetch: int = 0,
     ) -> None:
-        self._buffer = dict()
-        super().__init__(
-            datapipe,
-            condition=lambda data: next_until_key(
-                condition_datapipe,
+        super().__init__()
+        # The sources are always wrapped, so the state does not depend on prefetch
+        datapipe = Prefetch(datapipe, buffer_size=prefetch)
+        condition_datapipe = Prefetch(condition_datapipe, buffer_size=prefetch)
+        self.datapipe = datapipe
+        self.condition_datapipe = condition_datapipe
+        self.key_fn = key_fn
+        self._buffer: MutableMapping[K, Tuple[K, bool]] = dict()
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[D]:
+        state, self._resume = self._resume, None
+        self._buffer = _BudgetedDict(
+            "DependentDrop.buffer", state["buffer"].items() if state else ()
+        )
+
+        # The condition datapipe has to be iterated only once. Otherwise, every lookup
+        # would start from the top again.
+        condition_iterator = iter(self.condition_datapipe)
+        for data in self.datapipe:
+            _, drop = next_until_key(
+                condition_iterator,
                 key_fn=lambda condition_data: condition_data[0],
-                key=key_fn(data),
+                key=self.key_fn(data),
                 buffer=self._buffer,
-            )[1],
+            )
+            if drop:
+                continue
+
+            yield data
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or dict(
+            datapipe=pipeline_state_dict(self.datapipe),
+            condition_datapipe=pipeline_state_dict(self.condition_datapipe),
+            buffer=dict(zip(self._buffer, _unread_members(self._buffer.values()))),
         )
 
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state["datapipe"])
+        load_pipeline_state_dict(self.condition_datapipe, state["condition_datapipe"])
+        self._resume = state
+
 
 class DependentGroupByKey(IterDataPipe):
     def __init__(
@@ -114,32 +593,112 @@ class DependentGroupByKey(IterDataPipe):
         datapipe: Iterable[D],
         *dependent_data_pipes: Iterable[Tuple[K, Any]],
         key_fn: Callable[[D], K],
+        prefetch: int = 0,
     ):
         super().__init__()
+        # With prefetch, every source is produced by its own thread, so the I/O of one
+        # source does not stall the others. The sources are always wrapped, so the
+        # state does not depend on prefetch.
+        datapipe = Prefetch(datapipe, buffer_size=prefetch)
+        dependent_data_pipes = tuple(
+            Prefetch(dependent_datapipe, buffer_size=prefetch)
+            for dependent_datapipe in dependent_data_pipes
+        )
         self.datapipe = datapipe
         self.key_fn = key_fn
         self.dependent_datapipes = dependent_data_pipes
-        self._buffers: Tuple[Dict[K, Any], ...] = tuple(
+        self._buffers: Tuple[MutableMapping[K, Any], ...] = tuple(
             dict() for _ in range(len(dependent_data_pipes))
         )
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def _start(self) -> None:
+        state, self._resume = self._resume, None
+        self._buffers = tuple(
+            _BudgetedDict(
+                f"DependentGroupByKey.buffers[{idx}]",
+                state["buffers"][idx].items() if state else (),
+            )
+            for idx in range(len(self.dependent_datapipes))
+        )
 
     def __iter__(self) -> Iterator[List[Union[D, Any]]]:
+        self._start()
+
+        # Every dependent datapipe is only iterated once. Otherwise, every lookup would
+        # start from the top again.
+        dependent_iterators = [
+            iter(dependent_datapipe) for dependent_datapipe in self.dependent_datapipes
+        ]
         for data in self.datapipe:
             key = self.key_fn(data)
             res: List[Union[D, Any]] = [
                 next_until_key(
-                    dependent_datapipe,
+                    dependent_iterator,
                     key_fn=lambda dependent_data: dependent_data[0],
                     key=key,
                     buffer=buffer,
                 )
-                for dependent_datapipe, buffer in zip(
-                    self.dependent_datapipes, self._buffers
+                for dependent_iterator, buffer in zip(
+                    dependent_iterators, self._buffers
                 )
             ]
             res.insert(0, data)
             yield res
 
+    async def _aiterate(
+        self, executor: Optional[concurrent.futures.Executor]
+    ) -> AsyncIterator[List[Union[D, Any]]]:
+        # Used by aiterate(). The lookups in all dependent datapipes are awaited at the
+        # same time. Thus, their I/O and decoding overlap in the executor of the loop
+        # without a thread per source as with prefetch.
+        self._start()
+
+        dependent_iterators = [
+            _aiter(dependent_datapipe, executor)
+            for dependent_datapipe in self.dependent_datapipes
+        ]
+        async for data in _aiter(self.datapipe, executor):
+            key = self.key_fn(data)
+            res: List[Union[D, Any]] = list(
+                await asyncio.gather(
+                    *[
+                        _anext_until_key(
+                            dependent_iterator,
+                            key_fn=lambda dependent_data: dependent_data[0],
+                            key=key,
+                            buffer=buffer,
+                        )
+                        for dependent_iterator, buffer in zip(
+                            dependent_iterators, self._buffers
+                        )
+                    ]
+                )
+            )
+            res.insert(0, data)
+            yield res
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or dict(
+            datapipe=pipeline_state_dict(self.datapipe),
+            dependent_datapipes=[
+                pipeline_state_dict(dependent_datapipe)
+                for dependent_datapipe in self.dependent_datapipes
+            ],
+            buffers=[
+                dict(zip(buffer, _unread_members(buffer.values())))
+                for buffer in self._buffers
+            ],
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state["datapipe"])
+        for dependent_datapipe, dependent_state in zip(
+            self.dependent_datapipes, state["dependent_datapipes"]
+        ):
+            load_pipeline_state_dict(dependent_datapipe, dependent_state)
+        self._resume = state
+
 
 class ReadRowsFromCsv(IterDataPipe):
     def __init__(
@@ -156,40 +715,123 @@ class ReadRowsFromCsv(IterDataPipe):
         self.fieldnames = fieldnames
         self.skip_rows = skip_rows or (1 if fieldnames is not None else 0)
 
+        self._input = ResumableInput(datapipe)
+        self._offset: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
     def __iter__(self) -> Iterator[Tuple[str, List[str]]]:
-        for path, fh in self.datapipe:
-            for _ in range(self.skip_rows):
-                next(fh)
+        state, self._resume = self._resume, None
+        for (path, fh), offset in self._input.iterate(state):
+            self._offset = None
+            if offset is not None:
+                fh.seek(offset)
+            else:
+                for _ in range(self.skip_rows):
+                    next(fh)
 
             for row in csv.reader((line.decode() for line in fh), delimiter=" "):
+                self._offset = fh.tell()
                 yield path, row
 
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._offset)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
 
 class SplitByKey(Generic[D]):
     def __init__(self, datapipe: Iterable[D], *, key_fn: Callable[[D], Any]):
         self.datapipe = datapipe
-        self._datapipe_iterator = iter(datapipe)
+        self._datapipe_iterator: Optional[Iterator[D]] = None
         self.key_fn = key_fn
-        self.splits = collections.defaultdict(lambda: _SplittedIterDataPipe(self))
+        self.splits: Dict[Any, _SplittedIterDataPipe] = _SplitsDict(self)
+        # Set by optimize() to the keys of the branches that are actually consumed
+        self.consumed_keys: Optional[FrozenSet[Any]] = None
+        # Set by optimize() to the conditions of the DropByPath that were moved from
+        # the branches into the splitter
+        self.drop_conditions: Dict[Any, List[Callable[[MemberPath], bool]]] = {}
+        # The branches might be advanced from different threads, e.g. by the async
+        # iteration of a join
+        self._lock = threading.Lock()
 
     def __getitem__(self, key: Any) -> "_SplittedIterDataPipe":
         return self.splits[key]
 
+    def _consumes(self, key: Any) -> bool:
+        return self.consumed_keys is None or key in self.consumed_keys
+
     def next(self) -> None:
-        data = next(self._datapipe_iterator)
-        key = self.key_fn(data)
-        self.splits[key].put(data)
+        with self._lock:
+            if self._datapipe_iterator is None:
+                self._datapipe_iterator = iter(self.datapipe)
+
+            data = next(self._datapipe_iterator)
+            key = self.key_fn(data)
+            # Otherwise, the items of a branch nobody iterates would be buffered forever
+            if self._consumes(key) and not self._drops(key, data):
+                # The branches might be read from different threads, e.g. by Prefetch.
+                # Members of compressed archives share the file object of the archive,
+                # so they are read while the lock is still held.
+                _detach_members(data)
+                self.splits[key].put(data)
 
+    def _drops(self, key: Any, data: D) -> bool:
+        conditions = self.drop_conditions.get(key)
+        if not conditions:
+            return False
 
-class _SplittedIterDataPipe(IterDataPipe):
+        path = member_path(data[0])  # type: ignore[index]
+        return any(condition(path) for condition in conditions)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(
+            datapipe=pipeline_state_dict(self.datapipe),
+            queues={
+                key: _unread_members(split._queue) for key, split in self.splits.items()
+            },
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state["datapipe"])
+        self._datapipe_iterator = None
+        for key, items in state["queues"].items():
+            if not self._consumes(key):
+                continue
+
+            split = self.splits[key]
+            split._queue = _BudgetedQueue(f"SplitByKey[{key!r}]", items)
+
+
+class _SplitsDict(dict):
     def __init__(self, splitter: SplitByKey[D]) -> None:
+        super().__init__()
+        self._splitter = splitter
+
+    def __missing__(self, key: Any) -> "_SplittedIterDataPipe":
+        if not self._splitter._consumes(key):
+            raise RuntimeError(f"The branch {key!r} was removed by optimize()")
+
+        split = self[key] = _SplittedIterDataPipe(self._splitter, key)
+        return split
+
+
+class _SplittedIterDataPipe(IterDataPipe):
+    def __init__(self, splitter: SplitByKey[D], key: Any) -> None:
         self._splitter = splitter
-        self._queue = queue.Queue()
+        self.key = key
+        self._queue = _BudgetedQueue(f"SplitByKey[{key!r}]")
 
     def __iter__(self):
         while True:
             while self._queue.empty():
-                self._splitter.next()
+                try:
+                    self._splitter.next()
+                except StopIteration:
+                    # Another thread might have put the last items of this branch into
+                    # the queue right before the datapipe was exhausted
+                    if self._queue.empty():
+                        return
 
             yield self._queue.get()
 
@@ -210,15 +852,60 @@ class ReadLineFromFile(IterDataPipe):
         self.encoding = encoding
         self.strip = strip
 
+        self._input = ResumableInput(datapipe)
+        self._offset: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
     def __iter__(self) -> Iterator[Tuple[str, Union[bytes, str]]]:
-        for path, buffer in self.datapipe:
+        state, self._resume = self._resume, None
+        for (path, buffer), offset in self._input.iterate(state):
+            self._offset = None
+            if offset is not None:
+                buffer.seek(offset)
+
             for line in buffer:
+                self._offset = buffer.tell()
                 if self.decode:
                     line = line.decode(self.encoding)
                 if self.strip:
                     line = line.strip()
                 yield path, line
 
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._offset)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+class Sample(Mapping):
+    # Base of the typed sample records of the datasets. The fields are slots, so a
+    # record is a single small object without a __dict__ that the collate functions
+    # fill directly. It still is a read-only view of the dict the datasets used to
+    # yield, e.g. sample["image"], sample.keys(), or dict(sample), without copying.
+    __slots__: Tuple[str, ...] = ()
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        # Only replaces existing fields, e.g. the image by a transformed one
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{key}={getattr(self, key)!r}" for key in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
 
 def collate_sample(data: List[Tuple[Any, Any]]) -> Dict[str, Any]:
     sample: Dict[str, Any] = {}
@@ -232,23 +919,43 @@ def find(
     datapipe: Iterable[D], key: K, key_fn: Callable[[D], K]
 ) -> Tuple[D, Iterable[D]]:
     iterator = iter(datapipe)
-    buffer: List[D] = []
+    buffer: _BudgetedQueue = _BudgetedQueue(f"find({key!r})")
     for data in iterator:
         key_ = key_fn(data)
         if key_ == key:
-            return data, itertools.chain(buffer, iterator)
+            return data, itertools.chain(buffer.drain(), iterator)
         else:
-            buffer.append(data)
+            buffer.put(data)
     else:
         raise RuntimeError(f"Datapipe is exhausted, but key {key} was never found")
 
 
 class ReadFilesFromRar(IterDataPipe):
-    def __init__(self, datapipe: Iterable[Tuple[str, io.BufferedIOBase]]):
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, io.BufferedIOBase]],
+        *,
+        nested: bool = False,
+        headers_only: bool = False,
+        extract: bool = False,
+        filter_fn: Optional[Callable[["MemberPath"], bool]] = None,
+    ):
         self._rarfile = self._verify_dependencies()
 
         super().__init__()
         self.datapipe: Iterable[Tuple[str, io.BufferedIOBase]] = datapipe
+        self.nested = nested
+        # Opening a compressed member spawns an extraction process. If only the
+        # metadata is needed, we yield the RarInfo instead.
+        self.headers_only = headers_only
+        # If set, the compressed members of an archive are extracted by a single process
+        # into a temporary directory, which is removed once the archive is exhausted.
+        self.extract = extract
+        self.filter_fn = filter_fn
+
+        self._input = ResumableInput(datapipe)
+        self._position: Optional[Tuple[int, ...]] = None
+        self._resume: Optional[Dict[str, Any]] = None
 
     @staticmethod
     def _verify_dependencies():
@@ -266,17 +973,3566 @@ class ReadFilesFromRar(IterDataPipe):
         return rarfile
 
     def __iter__(self) -> Iterator[Tuple[str, io.BufferedIOBase]]:
-        for data in self.datapipe:
+        state, self._resume = self._resume, None
+        for data, position in self._input.iterate(state):
             validate_pathname_binary_tuple(data)
             path, stream = data
-            rar = self._rarfile.RarFile(stream)
-            for info in rar.infolist():
-                if info.filename.endswith("/"):
+            self._position = None
+            yield from self._read(path, stream, resume=position or (), prefix=())
+
+    def _read(
+        self,
+        path: str,
+        stream: io.BufferedIOBase,
+        *,
+        resume: Tuple[int, ...],
+        prefix: Tuple[int, ...],
+    ) -> Iterator[Tuple[str, io.BufferedIOBase]]:
+        rar = self._rarfile.RarFile(stream)
+        infos = rar.infolist()
+        extracted = self._extract(rar, path, infos[resume[0] if resume else 0 :])
+        try:
+            yield from self._read_infos(
+                rar, path, infos, extracted, resume=resume, prefix=prefix
+            )
+        finally:
+            if extracted is not None:
+                extracted.cleanup()
+
+    def _selects(self, path: str, info: Any) -> bool:
+        if info.filename.endswith("/"):
+            return False
+        elif self.nested and info.filename.endswith(".rar"):
+            return True
+        return self.filter_fn is None or self.filter_fn(
+            _join_member(path, info.filename)
+        )
+
+    def _extract(
+        self, rar: Any, path: str, infos: List[Any]
+    ) -> Optional[tempfile.TemporaryDirectory]:
+        if not self.extract or self.headers_only:
+            return None
+
+        members = [
+            info
+            for info in infos
+            if self._selects(path, info)
+            and not (self.nested and info.filename.endswith(".rar"))
+            and info.compress_type != self._rarfile.RAR_M0
+        ]
+        if not members:
+            return None
+
+        extracted = tempfile.TemporaryDirectory(prefix="datapipes-")
+        rar.extractall(extracted.name, members=members)
+        return extracted
+
+    def _read_infos(
+        self,
+        rar: Any,
+        path: str,
+        infos: List[Any],
+        extracted: Optional[tempfile.TemporaryDirectory],
+        *,
+        resume: Tuple[int, ...],
+        prefix: Tuple[int, ...],
+    ) -> Iterator[Tuple[str, io.BufferedIOBase]]:
+        for idx in range(resume[0] if resume else 0, len(infos)):
+            info = infos[idx]
+            if not self._selects(path, info):
+                continue
+
+            if resume and idx == resume[0]:
+                if len(resume) == 1:
+                    # This member was already yielded before the checkpoint
                     continue
+                inner_resume = resume[1:]
+            else:
+                inner_resume = ()
+
+            inner_path = _join_member(path, info.filename)
+            position = (*prefix, idx)
+
+            if self.nested and info.filename.endswith(".rar"):
+                yield from self._read(
+                    inner_path,
+                    self._open(rar, info),
+                    resume=inner_resume,
+                    prefix=position,
+                )
+            elif self.headers_only:
+                self._position = position
+                yield inner_path, info
+            elif extracted is not None and info.compress_type != self._rarfile.RAR_M0:
+                self._position = position
+                # The file stays readable after the directory is removed
+                yield inner_path, open(
+                    os.path.join(extracted.name, info.filename), "rb"
+                )
+            else:
+                self._position = position
+                yield inner_path, self._open(rar, info)
+
+    @staticmethod
+    def _open(rar: Any, info: Any) -> io.BufferedIOBase:
+        file_obj = rar.open(info)
+        file_obj.source_rar = rar
+        return file_obj
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._position)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+_NUMBER_PATTERN = re.compile(r"\d+")
+
+_PARENTS_CACHE: Dict[str, Tuple[str, ...]] = {}
+
+
+class _ParsedPath(NamedTuple):
+    name: str
+    stem: str
+    suffix: str
+    parents: Tuple[str, ...]
+    idx: Optional[int]
+
+
+# Key functions usually look at multiple attributes of the same path in a row
+_MEMBER_PATH_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=_MEMBER_PATH_CACHE_SIZE)
+def _parse_member_path(path: str) -> _ParsedPath:
+    # Member names always use "/". Only the path of the archive on disk might use
+    # another separator, so it is normalized before splitting.
+    if os.sep != "/":
+        path = path.replace(os.sep, "/")
+
+    head, _, name = path.rpartition("/")
+    # Same semantics as pathlib.PurePath.suffix
+    idx = name.rfind(".")
+    if 0 < idx < len(name) - 1:
+        stem, suffix = name[:idx], name[idx:]
+    else:
+        stem, suffix = name, ""
+
+    # Many members share the same folder, so we only parse and intern it once
+    parents = _PARENTS_CACHE.get(head)
+    if parents is None:
+        parents = _PARENTS_CACHE[head] = tuple(
+            sys.intern(part) for part in reversed(head.split("/")) if part
+        )
+
+    numbers = _NUMBER_PATTERN.findall(stem)
+    return _ParsedPath(
+        name, stem, suffix, parents, int(numbers[-1]) if numbers else None
+    )
+
+
+class MemberPath(str):
+    # Path of an archive member. Key functions can use the attributes instead of
+    # building pathlib.Path objects for every sample. A str subclass cannot have
+    # slots, and a __dict__ per path would take more memory than the path itself.
+    # Thus, the attributes are parsed on access and the recent results are cached.
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return _parse_member_path(self).name
+
+    @property
+    def stem(self) -> str:
+        return _parse_member_path(self).stem
+
+    @property
+    def suffix(self) -> str:
+        return _parse_member_path(self).suffix
+
+    @property
+    def parents(self) -> Tuple[str, ...]:
+        # Names of the parent folders starting with the direct one
+        return _parse_member_path(self).parents
+
+    @property
+    def idx(self) -> Optional[int]:
+        # Last number in the stem, e.g. 1 for image_0001.jpg
+        return _parse_member_path(self).idx
+
+
+def _join_member(path: str, name: str) -> MemberPath:
+    # The path of the archive is kept as is, since the references to its members are
+    # matched against it. The member name is normalized with "/" on every platform.
+    return MemberPath(f"{path}/{posixpath.normpath(name.lstrip('/'))}")
+
+
+def member_path(path: Union[str, pathlib.Path]) -> MemberPath:
+    return path if isinstance(path, MemberPath) else MemberPath(str(path))
+
+
+class _MemberWindow(io.RawIOBase):
+    def __init__(self, fh: Any, offset: int, size: int) -> None:
+        super().__init__()
+        self._fh = fh
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer: Any) -> int:
+        size = min(len(buffer), self._size - self._pos)
+        if size <= 0:
+            return 0
+
+        # Avoid the seek if we are already at the right position. For compressed
+        # archives a backwards seek means decompressing everything from the start.
+        if self._fh.tell() != self._offset + self._pos:
+            self._fh.seek(self._offset + self._pos)
+        num_read = self._fh.readinto(memoryview(buffer)[:size])
+        self._pos += num_read
+        return num_read
+
+    def close(self) -> None:
+        self._fh.close()
+        super().close()
+
+
+def _inflate(archive: str, offset: int, size: int) -> io.BytesIO:
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = bytearray()
+    with open(archive, "rb") as fh:
+        fh.seek(offset)
+        while len(data) < size and not decompressor.eof:
+            chunk = fh.read(64 * 1024)
+            if not chunk:
+                break
+            data += decompressor.decompress(chunk)
+    return io.BytesIO(data[:size])
+
+
+# Archives are mapped once per process and slices of the views share the mapping, so
+# they do not copy anything. Only the most recently used maps are kept. An evicted map
+# is unmapped as soon as the last view into it is released.
+_MMAP_CACHE_SIZE = 8
+
+
+@functools.lru_cache(maxsize=_MMAP_CACHE_SIZE)
+def _mmap(archive: str) -> memoryview:
+    with open(archive, "rb") as fh:
+        return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class _ViewReader(io.RawIOBase):
+    # File object over a memoryview. In contrast to io.BytesIO it does not copy the
+    # data upfront, but only what is actually read.
+    def __init__(self, view: memoryview) -> None:
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer: Any) -> int:
+        data = self._view[self._pos : self._pos + len(buffer)]
+        memoryview(buffer)[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+_OPENERS: Dict[Optional[str], Callable[[str], Any]] = {
+    None: lambda archive: open(archive, "rb", buffering=0),
+    "gzip": gzip.open,
+    "bz2": bz2.open,
+    "xz": lzma.open,
+}
+
+
+# Marks a closed MemberRef
+_CLOSED = io.BytesIO()
+_CLOSED.close()
+
+
+class MemberRef:
+    # Lightweight reference to a member of an archive. The member is only opened once
+    # it is read. The offset points to the data of the member. For members of
+    # compressed tar archives it is relative to the decompressed stream, whereas
+    # "deflate" means the member itself is compressed, e.g. in a zip archive.
+    #
+    # Indexes and buffers hold a lot of these. Thus, this is a plain object with slots
+    # rather than an io.BufferedIOBase subclass, which would add a __dict__ and the
+    # state of the io machinery to every reference. It is registered as virtual
+    # subclass below though, so it is still treated as binary stream, e.g. by the
+    # torch decoders.
+    __slots__ = ("archive", "offset", "size", "compression", "_source", "_stream")
+
+    def __init__(
+        self,
+        archive: str,
+        offset: int,
+        size: int,
+        compression: Optional[str] = None,
+        *,
+        source: Optional[io.BufferedIOBase] = None,
+    ) -> None:
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+        self.compression = compression
+        # While streaming through a compressed archive, the reader hands over the
+        # member stream it already has, since reopening would mean decompressing
+        # everything up to the offset again.
+        self._source = source
+        self._stream: Optional[io.BufferedIOBase] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}("
+            f"archive={self.archive!r}, "
+            f"offset={self.offset}, "
+            f"size={self.size}, "
+            f"compression={self.compression!r})"
+        )
+
+    def __reduce__(self):
+        return type(self), (self.archive, self.offset, self.size, self.compression)
+
+    def _open(self) -> io.BufferedIOBase:
+        if self._stream is None:
+            if self._source is not None:
+                self._stream, self._source = self._source, None
+            elif self.compression == "deflate":
+                self._stream = _inflate(self.archive, self.offset, self.size)
+            else:
+                self._stream = io.BufferedReader(
+                    _MemberWindow(
+                        _OPENERS[self.compression](self.archive), self.offset, self.size
+                    )
+                )
+        elif self._stream is _CLOSED:
+            raise ValueError("I/O operation on closed file.")
+        return self._stream
+
+    @property
+    def closed(self) -> bool:
+        return self._stream is _CLOSED
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        return self._open().read(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self._open().read1(size)
+
+    def readinto(self, buffer: Any) -> int:
+        return self._open().readinto(buffer)
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        return self._open().readline(size)
+
+    def readlines(self, hint: int = -1) -> List[bytes]:
+        return self._open().readlines(hint)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._open())
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._open().seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._open().tell()
+
+    def view(self) -> memoryview:
+        # Zero-copy access to a member of an uncompressed archive through a memory map
+        if self.compression is not None:
+            raise ValueError(
+                f"Only members of uncompressed archives can be viewed, "
+                f"but {self.archive} uses {self.compression}"
+            )
+        return _mmap(self.archive)[self.offset : self.offset + self.size]
+
+    def _detach(self) -> None:
+        # The stream handed over by the reader shares the file object with the archive.
+        # Thus, it has to be read before the reader moves on in another thread.
+        if self._source is not None:
+            with self._source:
+                self._stream = io.BytesIO(self._source.read())
+            self._source = None
+
+    def close(self) -> None:
+        for stream in (self._stream, self._source):
+            if stream is not None:
+                stream.close()
+        self._stream, self._source = _CLOSED, None
+
+    def __enter__(self) -> "MemberRef":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+io.BufferedIOBase.register(MemberRef)
+
+
+def _unread_members(items: Iterable[Any]) -> List[Any]:
+    # Buffered items in a state must not share the references with the running
+    # pipeline. Otherwise, reading them after the state was taken leaves nothing to
+    # read for the pipeline that is resumed from it. Pickling already does the same.
+    def unread(data: Any) -> Any:
+        if isinstance(data, MemberRef):
+            return MemberRef(data.archive, data.offset, data.size, data.compression)
+        elif isinstance(data, (tuple, list)):
+            return type(data)(unread(item) for item in data)
+        elif isinstance(data, dict):
+            return {key: unread(value) for key, value in data.items()}
+        elif isinstance(data, Sample):
+            sample = copy.copy(data)
+            for key, value in data.items():
+                sample[key] = unread(value)
+            return sample
+        return data
+
+    return [unread(item) for item in items]
+
+
+_COMPRESSIONS = (None, "gzip", "bz2", "xz", "deflate")
+
+
+class _PackedIndex:
+    # Keys packed into a flat buffer and looked up through their sorted hashes. Instead
+    # of a Python object per entry, the subclasses store their values in flat buffers
+    # and arrays as well. Thus, an index can be dumped into a file, which any number of
+    # processes can memory map with load() without copying or parsing anything.
+    def __init__(self) -> None:
+        self._file: Optional[str] = None
+
+        # 32 bit offsets, hashes, and indices limit an index to 4 GB of keys, which is
+        # plenty, but halve the memory per entry compared to 64 bit ones
+        self._keys = bytearray()
+        self._key_offsets = array.array("I", [0])
+
+        self._sorted_hashes = array.array("I")
+        self._sorted_idcs = array.array("I")
+
+    def _add_key(self, key: str) -> None:
+        if self._file is not None:
+            raise RuntimeError(f"{type(self).__name__} of {self._file} is read-only")
+
+        encoded_key = key.encode()
+        self._keys += encoded_key
+        self._key_offsets.append(len(self._keys))
+
+    def _key(self, idx: int) -> bytes:
+        return self._keys[self._key_offsets[idx] : self._key_offsets[idx + 1]]
+
+    def _hash(self, key: bytes) -> int:
+        # crc32 rather than hash() to get the same values in every process
+        return zlib.crc32(key)
+
+    def _sort(self) -> None:
+        # The hashes are computed from the keys while sorting rather than being stored
+        # for every entry
+        if len(self._sorted_idcs) != len(self):
+            hashes = array.array("I", map(self._hash, map(self._key, range(len(self)))))
+            self._sorted_idcs = array.array(
+                "I", sorted(range(len(self)), key=hashes.__getitem__)
+            )
+            self._sorted_hashes = array.array(
+                "I", (hashes[idx] for idx in self._sorted_idcs)
+            )
+
+    def _find(self, key: str) -> Optional[int]:
+        self._sort()
+
+        encoded_key = key.encode()
+        hash = self._hash(encoded_key)
+        found = None
+        pos = bisect.bisect_left(self._sorted_hashes, hash)
+        while pos < len(self) and self._sorted_hashes[pos] == hash:
+            idx = self._sorted_idcs[pos]
+            # If a key was added multiple times, the last one wins as for a dict
+            if self._key(idx) == encoded_key and (found is None or idx > found):
+                found = idx
+            pos += 1
+        return found
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._find(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._key_offsets) - 1
+
+    def keys(self) -> Iterator[str]:  # type: ignore[override]
+        return (str(self._key(idx), "utf-8") for idx in range(len(self)))
+
+    def _attrs(self) -> Dict[str, Any]:
+        # JSON serializable attributes that are stored next to the arrays
+        return dict()
+
+    def _load_attrs(self, attrs: Dict[str, Any]) -> None:
+        pass
+
+    def dump(self, file: Union[str, pathlib.Path]) -> None:
+        self._sort()
+        arrays = {
+            name: value
+            for name, value in vars(self).items()
+            if isinstance(value, (array.array, bytearray))
+        }
+        _dump_arrays(file, type(self).__name__, self._attrs(), arrays)
+
+    @classmethod
+    def load(cls: Type[P], file: Union[str, pathlib.Path]) -> P:
+        kind, attrs, arrays = _load_arrays(file)
+        if kind != cls.__name__:
+            raise ValueError(f"{file} holds a {kind}, but not a {cls.__name__}")
+
+        self = cls.__new__(cls)
+        _PackedIndex.__init__(self)
+        vars(self).update(arrays)
+        self._load_attrs(attrs)
+        self._file = str(file)
+        return self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # A loaded index only transfers the path, e.g. to spawned DataLoader workers
+        if self._file is not None:
+            return dict(_file=self._file)
+        return vars(self)
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        if state.get("_file") is not None:
+            state = vars(self.load(state["_file"]))
+        vars(self).update(state)
+
+
+# The arrays are aligned to their item size in the file. Since the map starts at a page
+# boundary, they can be cast in place.
+_SHARED_MAGIC = b"DPINDEX1"
+_SHARED_ALIGNMENT = 8
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // _SHARED_ALIGNMENT) * _SHARED_ALIGNMENT
+
+
+def _dump_arrays(
+    file: Union[str, pathlib.Path],
+    kind: str,
+    attrs: Dict[str, Any],
+    arrays: Dict[str, Union[array.array, bytearray]],
+) -> None:
+    layout = []
+    offset = 0
+    for name, value in arrays.items():
+        view = memoryview(value)
+        layout.append((name, view.format, view.itemsize, offset, view.nbytes))
+        offset = _aligned(offset + view.nbytes)
+    header = json.dumps(
+        dict(kind=kind, byteorder=sys.byteorder, attrs=attrs, arrays=layout)
+    ).encode()
+    start = _aligned(len(_SHARED_MAGIC) + 8 + len(header))
+
+    file = pathlib.Path(file)
+    tmp = file.with_name(f"{file.name}.{os.getpid()}")
+    try:
+        with open(tmp, "wb") as fh:
+            fh.write(_SHARED_MAGIC)
+            fh.write(struct.pack("<Q", len(header)))
+            fh.write(header)
+            for (_, _, _, offset, _), value in zip(layout, arrays.values()):
+                fh.seek(start + offset)
+                fh.write(value)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, file)
+
+
+def _load_arrays(
+    file: Union[str, pathlib.Path],
+) -> Tuple[str, Dict[str, Any], Dict[str, memoryview]]:
+    # In contrast to _mmap(), every load maps the file anew, since a rebuilt index
+    # replaces the file.
+    with open(file, "rb") as fh:
+        view = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+    if view[: len(_SHARED_MAGIC)] != _SHARED_MAGIC:
+        raise ValueError(f"{file} is not an index")
+    (size,) = struct.unpack_from("<Q", view, len(_SHARED_MAGIC))
+    header_start = len(_SHARED_MAGIC) + 8
+    header = json.loads(bytes(view[header_start : header_start + size]))
+    start = _aligned(header_start + size)
+
+    arrays = {}
+    for name, format, itemsize, offset, nbytes in header["arrays"]:
+        # Indices written on a different platform are rejected rather than misread
+        if header["byteorder"] != sys.byteorder or struct.calcsize(format) != itemsize:
+            raise ValueError(f"{file} was written on an incompatible platform")
+        arrays[name] = view[start + offset : start + offset + nbytes].cast(format)
+    return header["kind"], header["attrs"], arrays
+
+
+class MemberIndex(_PackedIndex):
+    # Packed index from a key to a member of an archive. The paths and references are
+    # stored in flat buffers and arrays as well and only materialized on access.
+    def __init__(self) -> None:
+        super().__init__()
+        self._archives: List[str] = []
+        self._archive_idcs_map: Dict[str, int] = {}
+
+        # The paths are stored relative to the archive
+        self._paths = bytearray()
+        self._path_offsets = array.array("I", [0])
+
+        self._archive_idcs = array.array("H")
+        self._offsets = array.array("Q")
+        self._sizes = array.array("Q")
+        self._compressions = array.array("B")
+
+    def add(self, key: str, path: str, ref: MemberRef) -> None:
+        if not path.startswith(ref.archive):
+            raise ValueError(f"The path {path} does not belong to {ref.archive}")
+
+        self._add_key(key)
+
+        archive_idx = self._archive_idcs_map.get(ref.archive)
+        if archive_idx is None:
+            archive_idx = self._archive_idcs_map[ref.archive] = len(self._archives)
+            self._archives.append(ref.archive)
+
+        self._paths += path[len(ref.archive) :].encode()
+        self._path_offsets.append(len(self._paths))
+
+        self._archive_idcs.append(archive_idx)
+        self._offsets.append(ref.offset)
+        self._sizes.append(ref.size)
+        self._compressions.append(_COMPRESSIONS.index(ref.compression))
+
+    def __getitem__(self, key: str) -> Tuple[str, MemberRef]:
+        idx = self._find(key)
+        if idx is None:
+            raise KeyError(key)
+
+        archive = self._archives[self._archive_idcs[idx]]
+        path = self._paths[self._path_offsets[idx] : self._path_offsets[idx + 1]]
+        return MemberPath(archive + str(path, "utf-8")), MemberRef(
+            archive,
+            self._offsets[idx],
+            self._sizes[idx],
+            _COMPRESSIONS[self._compressions[idx]],
+        )
+
+    def _attrs(self) -> Dict[str, Any]:
+        return dict(archives=self._archives)
+
+    def _load_attrs(self, attrs: Dict[str, Any]) -> None:
+        self._archives = attrs["archives"]
+        self._archive_idcs_map = {
+            archive: idx for idx, archive in enumerate(self._archives)
+        }
+
+
+class SharedMapping(_PackedIndex, Mapping):
+    # Read-only mapping from strings to arbitrary values for metadata that every
+    # DataLoader worker needs. The values are pickled into a flat buffer and only
+    # unpickled on access. Use shared() to build it once and memory map it everywhere.
+    def __init__(self, items: Union[Mapping, Iterable[Tuple[str, Any]]] = ()) -> None:
+        super().__init__()
+        self._values = bytearray()
+        self._value_offsets = array.array("Q", [0])
+
+        for key, value in items.items() if isinstance(items, Mapping) else items:
+            self._add_key(key)
+            self._values += pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            self._value_offsets.append(len(self._values))
+
+    def __getitem__(self, key: str) -> Any:
+        idx = self._find(key)
+        if idx is None:
+            raise KeyError(key)
+        return pickle.loads(
+            self._values[self._value_offsets[idx] : self._value_offsets[idx + 1]]
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+
+def _shared_file(
+    name: str, sources: Sequence[Union[str, pathlib.Path]], params: Dict[str, Any]
+) -> pathlib.Path:
+    fingerprints = [
+        f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+        for source, stat in zip(sources, map(os.stat, sources))
+    ]
+    key = json.dumps([params, fingerprints], sort_keys=True, default=str)
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return _CACHE_DIR / "shared" / name / f"{digest}.index"
+
+
+@contextlib.contextmanager
+def _file_lock(file: pathlib.Path) -> Iterator[None]:
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        fh = open(file.with_name(f"{file.name}.lock"), "a")
+    except OSError:
+        yield
+        return
+
+    with fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        yield
+
+
+def shared(
+    name: str,
+    sources: Sequence[Union[str, pathlib.Path]],
+    build: Callable[[], P],
+    **params: Any,
+) -> P:
+    # Builds an index once and memory maps it from the cache afterwards. Thus, the
+    # DataLoader workers and later runs attach to the index instantly and share its
+    # pages instead of every one building and holding a copy. The entry is keyed by
+    # the name, the params, and the size and modification time of the sources. While
+    # one process builds the index, the others wait for it.
+    try:
+        file = _shared_file(name, sources, params)
+    except OSError:
+        # Let the build fail with a proper message if a source does not exist
+        return build()
+
+    try:
+        return cast(P, _load_shared(file))
+    except (OSError, ValueError):
+        pass
+
+    with _file_lock(file):
+        # Another process might have built the index while we waited for the lock
+        try:
+            return cast(P, _load_shared(file))
+        except (OSError, ValueError):
+            pass
+
+        index = build()
+        try:
+            index.dump(file)
+        except OSError:
+            # The cache is only an optimization
+            return index
+    return cast(P, _load_shared(file))
+
+
+def _load_shared(file: pathlib.Path) -> _PackedIndex:
+    kind, *_ = _load_arrays(file)
+    cls = {cls.__name__: cls for cls in (MemberIndex, SharedMapping)}.get(kind)
+    if cls is None:
+        raise ValueError(f"{file} holds an unknown index {kind}")
+    return cls.load(file)
+
+
+def _seek_tar(tar: tarfile.TarFile, offset: int) -> Optional[tarfile.TarInfo]:
+    # The first member is read when the archive is opened. tarfile treats a seek to
+    # offset 0 as the end of the archive, so there is nothing to do in that case.
+    if offset:
+        tar.firstmember = None
+        tar.offset = offset
+    return tar.next()
+
+
+def _tar_compression(tar: tarfile.TarFile) -> Optional[str]:
+    if isinstance(tar.fileobj, gzip.GzipFile):
+        return "gzip"
+    elif isinstance(tar.fileobj, bz2.BZ2File):
+        return "bz2"
+    elif isinstance(tar.fileobj, lzma.LZMAFile):
+        return "xz"
+    else:
+        # archives opened in stream mode
+        return _STREAM_COMPRESSIONS.get(getattr(tar.fileobj, "comptype", None))
+
+
+_STREAM_COMPRESSIONS = {"gz": "gzip", "bz2": "bz2", "xz": "xz"}
+
+_DECOMPRESSORS: Dict[str, Callable[[], Any]] = {
+    "gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "bz2": bz2.BZ2Decompressor,
+    "xz": lzma.LZMADecompressor,
+}
+
+
+def _is_tar_header(header: bytes) -> bool:
+    return header[257:262] == b"ustar"
+
+
+def _sniff_archive(stream: Any) -> Tuple[Optional[str], Optional[str]]:
+    # Detects the format and compression of an archive from its magic bytes. For
+    # compressed streams only the first block is decompressed to look for a tar header.
+    # The position of the stream is restored afterwards.
+    position = stream.tell()
+    try:
+        header = stream.read(512)
+        if header.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+            return "zip", None
+        elif header.startswith(b"Rar!\x1a\x07"):
+            return "rar", None
+        elif _is_tar_header(header):
+            return "tar", None
+
+        if header.startswith(b"\x1f\x8b"):
+            compression = "gzip"
+        elif header.startswith(b"BZh"):
+            compression = "bz2"
+        elif header.startswith(b"\xfd7zXZ\x00"):
+            compression = "xz"
+        else:
+            return None, None
+
+        decompressor = _DECOMPRESSORS[compression]()
+        stream.seek(position)
+        block = b""
+        while len(block) < 512:
+            chunk = stream.read(64 * 1024)
+            if not chunk:
+                break
+            block += decompressor.decompress(chunk, 512 - len(block))
+        return ("tar" if _is_tar_header(block) else None), compression
+    except (OSError, EOFError, ValueError, zlib.error):
+        return None, None
+    finally:
+        stream.seek(position)
+
+
+class ReadFilesFromTar(IterDataPipe):
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, io.BufferedIOBase]],
+        *,
+        nested: bool = False,
+        zero_copy: bool = False,
+        filter_fn: Optional[Callable[[MemberPath], bool]] = None,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.nested = nested
+        # If set, the members are yielded as memoryviews into a memory map of the
+        # archive rather than as MemberRefs. Only works for uncompressed archives.
+        self.zero_copy = zero_copy
+        # Members as well as nested archives that are rejected are skipped by seeking
+        # past them. Thus, their data is never read.
+        self.filter_fn = filter_fn
+
+        self._input = ResumableInput(datapipe)
+        self._position: Optional[Tuple[int, ...]] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Tuple[str, io.BufferedIOBase]]:
+        state, self._resume = self._resume, None
+        for data, position in self._input.iterate(state):
+            validate_pathname_binary_tuple(data)
+            path, stream = data
+            self._position = None
+            yield from self._read(path, stream, resume=position or (), prefix=())
+
+    def _read(
+        self,
+        path: str,
+        stream: io.BufferedIOBase,
+        *,
+        resume: Tuple[int, ...],
+        prefix: Tuple[int, ...],
+    ) -> Iterator[Tuple[str, Union[MemberRef, memoryview]]]:
+        # A compressed archive that is read in a single pass is opened in stream mode,
+        # which decompresses strictly forward. Resuming requires seeking and nested
+        # archives are read through the outer one, so both use random access.
+        streaming = (
+            not isinstance(stream, MemberRef)
+            and not resume
+            and not self.nested
+            and _sniff_archive(stream)[1] is not None
+        )
+        tar = tarfile.open(fileobj=stream, mode="r|*" if streaming else "r:*")
+
+        if isinstance(stream, MemberRef):
+            # For nested archives the offsets are relative to the outermost archive
+            if tar.fileobj is not stream:
+                raise RuntimeError(f"Nested archive {path} must not be compressed")
+            archive, base, compression = (
+                stream.archive,
+                stream.offset,
+                stream.compression,
+            )
+        else:
+            archive, base, compression = path, 0, _tar_compression(tar)
+            if self.zero_copy and compression:
+                raise ValueError(
+                    f"Zero-copy reading requires an uncompressed archive, "
+                    f"but {path} uses {compression}"
+                )
+
+        if resume:
+            # The position holds the header offsets of the last yielded member and of
+            # all archives it is nested in. Thus, we can seek there directly.
+            info = _seek_tar(tar, resume[0])
+            if len(resume) == 1:
+                # This member was already yielded before the checkpoint
+                info = tar.next()
+        else:
+            info = tar.next()
+
+        while info is not None:
+            # We only stream through the archive, so there is no need to keep the
+            # headers of all members around.
+            tar.members.clear()
+
+            path_ = _join_member(path, info.name)
+            if info.isfile() and (self.filter_fn is None or self.filter_fn(path_)):
+                position = (*prefix, info.offset)
+
+                member = MemberRef(
+                    archive,
+                    base + info.offset_data,
+                    info.size,
+                    compression,
+                    source=tar.extractfile(info) if compression else None,
+                )
+
+                if self.nested and info.name.endswith(".tar"):
+                    yield from self._read(
+                        path_, member, resume=resume[1:], prefix=position
+                    )
+                elif streaming:
+                    # The stream can neither go back nor seek within a member. The
+                    # data has to be decompressed to move past it anyway, so we read
+                    # it right away. Rejected members are still skipped without a copy.
+                    member._detach()
+                    self._position = position
+                    yield path_, member
+                else:
+                    self._position = position
+                    yield path_, member.view() if self.zero_copy else member
+
+            resume = ()
+            info = tar.next()
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._position)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+class ReadFilesFromZip(IterDataPipe):
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, io.BufferedIOBase]],
+        *,
+        num_threads: int = 0,
+        lookahead: int = 256,
+        filter_fn: Optional[Callable[[MemberPath], bool]] = None,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        # If set, runs of consecutive members are read and inflated by a thread pool
+        # ahead of the consumer. Otherwise, every member is inflated lazily once it is
+        # read. lookahead bounds the number of members that are held in memory.
+        self.num_threads = num_threads
+        self.lookahead = lookahead
+        # Members are selected from the central directory, so the rejected ones are
+        # never read.
+        self.filter_fn = filter_fn
+
+        self._input = ResumableInput(datapipe)
+        self._position: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Tuple[str, io.BufferedIOBase]]:
+        state, self._resume = self._resume, None
+        for data, position in self._input.iterate(state):
+            validate_pathname_binary_tuple(data)
+            path, stream = data
+            self._position = None
+
+            archive = zipfile.ZipFile(stream)
+            infos = archive.infolist()
+            paths = [_join_member(path, info.filename) for info in infos]
+            # The central directory gives us random access to every member, so we can
+            # start right after the last member yielded before the checkpoint.
+            indices = [
+                idx
+                for idx in range(0 if position is None else position + 1, len(infos))
+                if not infos[idx].is_dir()
+                and (self.filter_fn is None or self.filter_fn(paths[idx]))
+            ]
+            location = _zip_location(path, stream)
+            members: Iterator[Tuple[int, Union[MemberRef, io.BytesIO]]]
+            if location is None:
+                # The zip only exists as stream, e.g. a member of a compressed archive.
+                # Thus, the members cannot be reopened later and are read right away.
+                members = (
+                    (idx, io.BytesIO(archive.read(infos[idx]))) for idx in indices
+                )
+            elif self.num_threads:
+                members = self._read_ahead(*location, infos, indices)
+            else:
+                file, base = location
+                members = (
+                    (
+                        idx,
+                        MemberRef(
+                            file,
+                            base + _zip_data_offset(stream, infos[idx]),
+                            infos[idx].file_size,
+                            _zip_compression(infos[idx]),
+                        ),
+                    )
+                    for idx in indices
+                )
+
+            for idx, member in members:
+                self._position = idx
+                yield paths[idx], member
+
+    def _read_ahead(
+        self, file: str, base: int, infos: List[zipfile.ZipInfo], indices: List[int]
+    ) -> Iterator[Tuple[int, MemberRef]]:
+        runs = _zip_runs(infos, indices)
+        max_pending = max(self.lookahead // _ZIP_RUN_LENGTH, 1)
+        with concurrent.futures.ThreadPoolExecutor(self.num_threads) as executor:
+            # The runs are submitted in order of the central directory and the results
+            # are collected in the same order, regardless which run finishes first.
+            pending: Deque[concurrent.futures.Future] = collections.deque()
+            try:
+                for run in runs:
+                    pending.append(
+                        executor.submit(
+                            _read_zip_run,
+                            file,
+                            base,
+                            [(idx, infos[idx]) for idx in run],
+                        )
+                    )
+                    if len(pending) == max_pending:
+                        yield from pending.popleft().result()
+
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._position)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+_ZIP_RUN_LENGTH = 16
+_ZIP_RUN_SIZE = 8 * 1024 * 1024
+
+
+def _zip_runs(infos: List[zipfile.ZipInfo], indices: List[int]) -> Iterator[List[int]]:
+    # Groups members that are stored back to back, so a run can be read sequentially
+    run: List[int] = []
+    size = 0
+    for idx in indices:
+        info = infos[idx]
+        if run and (
+            len(run) == _ZIP_RUN_LENGTH
+            or size + info.compress_size > _ZIP_RUN_SIZE
+            or info.header_offset < infos[run[-1]].header_offset
+        ):
+            yield run
+            run, size = [], 0
+        run.append(idx)
+        size += info.compress_size
+    if run:
+        yield run
+
+
+def _zip_location(path: str, stream: Any) -> Optional[Tuple[str, int]]:
+    # The file on disk that holds the zip uncompressed and the offset of the zip in it.
+    # Through them, the members can be reopened without the stream of the zip.
+    if isinstance(stream, MemberRef):
+        if stream.compression is not None:
+            return None
+        return stream.archive, stream.offset
+    elif os.path.isfile(path):
+        return path, 0
+    return None
+
+
+def _read_zip_run(
+    archive: str, base: int, members: List[Tuple[int, zipfile.ZipInfo]]
+) -> List[Tuple[int, MemberRef]]:
+    refs = []
+    with open(archive, "rb") as fh:
+        for idx, info in members:
+            if fh.tell() != base + info.header_offset:
+                fh.seek(base + info.header_offset)
+            header = fh.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            fh.seek(name_length + extra_length, io.SEEK_CUR)
+            offset = fh.tell()
+
+            compression = _zip_compression(info)
+            data = fh.read(info.compress_size)
+            if compression == "deflate":
+                # zlib releases the GIL, so the runs are inflated in parallel
+                data = zlib.decompress(data, -zlib.MAX_WBITS, info.file_size or 1)
+
+            refs.append(
+                (
+                    idx,
+                    MemberRef(
+                        archive,
+                        offset,
+                        info.file_size,
+                        compression,
+                        source=io.BytesIO(data),
+                    ),
+                )
+            )
+    return refs
+
+
+def _zip_data_offset(stream: io.BufferedIOBase, info: zipfile.ZipInfo) -> int:
+    # The central directory only holds the offset of the local header. Its size
+    # depends on the local extra field, which can differ from the central one.
+    stream.seek(info.header_offset)
+    header = stream.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def _zip_compression(info: zipfile.ZipInfo) -> Optional[str]:
+    if info.compress_type == zipfile.ZIP_STORED:
+        return None
+    elif info.compress_type == zipfile.ZIP_DEFLATED:
+        return "deflate"
+    else:
+        raise ValueError(
+            f"Member {info.filename} uses the unsupported compression method "
+            f"{info.compress_type}"
+        )
+
+
+class ReadFilesFromArchive(IterDataPipe):
+    # Detects the format of every archive from its magic bytes and reads it with the
+    # cheapest access mode of the matching reader: compressed tars in stream mode,
+    # uncompressed tars by seeking or, with zero_copy, through a memory map, zips
+    # through their central directory, and rars with a single extraction process per
+    # archive. The options only apply to the formats that support them.
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, io.BufferedIOBase]],
+        *,
+        nested: bool = False,
+        zero_copy: bool = False,
+        num_threads: int = 0,
+        headers_only: bool = False,
+        filter_fn: Optional[Callable[[MemberPath], bool]] = None,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.nested = nested
+        self.zero_copy = zero_copy
+        self.num_threads = num_threads
+        self.headers_only = headers_only
+        self.filter_fn = filter_fn
+
+        self._input = ResumableInput(datapipe)
+        self._reader: Optional[IterDataPipe] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        state, self._resume = self._resume, None
+        for data, position in self._input.iterate(state):
+            validate_pathname_binary_tuple(data)
+            self._reader = self._make_reader(*data)
+            # The position is the state of the reader of the current archive
+            if position is not None:
+                self._reader.load_state_dict(position)
+            yield from self._reader
+
+    def _make_reader(self, path: str, stream: io.BufferedIOBase) -> IterDataPipe:
+        datapipe = ((path, stream),)
+        kind, compression = _sniff_archive(stream)
+        if kind == "tar":
+            return ReadFilesFromTar(
+                datapipe,
+                nested=self.nested,
+                zero_copy=self.zero_copy and compression is None,
+                filter_fn=self.filter_fn,
+            )
+        elif kind == "zip":
+            return ReadFilesFromZip(
+                datapipe, num_threads=self.num_threads, filter_fn=self.filter_fn
+            )
+        elif kind == "rar":
+            return ReadFilesFromRar(
+                datapipe,
+                nested=self.nested,
+                headers_only=self.headers_only,
+                extract=True,
+                filter_fn=self.filter_fn,
+            )
+        else:
+            raise ValueError(f"Unable to detect the archive format of {path}")
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(
+            self._reader.state_dict() if self._reader is not None else None
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+# Verified archives and members are remembered across processes. The key includes the
+# size and modification time of the file, so any change invalidates the entry.
+_CACHE_DIR = (
+    pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+    / "datapipes"
+)
+_VERIFIED: Optional[set] = None
+
+
+def _verified() -> set:
+    global _VERIFIED
+    if _VERIFIED is None:
+        try:
+            with open(_CACHE_DIR / "verified.json") as fh:
+                _VERIFIED = set(json.load(fh))
+        except (OSError, ValueError):
+            _VERIFIED = set()
+    return _VERIFIED
+
+
+def _mark_verified(key: str) -> None:
+    verified = _verified()
+    verified.add(key)
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = _CACHE_DIR / f"verified.json.{os.getpid()}"
+        with open(tmp, "w") as fh:
+            json.dump(sorted(verified), fh)
+        os.replace(tmp, _CACHE_DIR / "verified.json")
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def _fingerprint(path: str, stream: Any, checksum: str) -> Optional[str]:
+    if isinstance(stream, MemberRef):
+        file, location = stream.archive, f"{stream.offset}:{stream.size}"
+    elif os.path.isfile(path):
+        file, location = path, ""
+    else:
+        return None
+
+    stat = os.stat(file)
+    return ":".join(
+        (
+            os.path.abspath(file),
+            location,
+            str(stat.st_size),
+            str(stat.st_mtime_ns),
+            checksum,
+        )
+    )
+
+
+def _stream_size(stream: Any) -> Optional[int]:
+    if isinstance(stream, MemberRef):
+        return stream.size
+
+    try:
+        return os.fstat(stream.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+class _HashedStream(io.BufferedIOBase):
+    # Feeds every byte to the hash while it is read by the pipeline. Forward seeks are
+    # read through, so archives that are only partially read, e.g. tar headers only,
+    # are still consumed in a single sequential pass. As soon as the last byte is
+    # hashed, the stream is complete.
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        stream: Any,
+        *,
+        algorithm: str,
+        on_complete: Callable[["_HashedStream"], None],
+    ) -> None:
+        super().__init__()
+        self.path = path
+        self._stream = stream
+        self._size = _stream_size(stream)
+        self._hash = hashlib.new(algorithm)
+        self._hashed = 0
+        self._on_complete = on_complete
+        self.complete = False
+
+    def _update(self, position: int, data: Any) -> None:
+        # Only bytes that continue the hashed prefix can be fed to the hash
+        end = position + len(data)
+        if position <= self._hashed < end:
+            self._hash.update(memoryview(data)[self._hashed - position :])
+            self._hashed = end
+            if self._hashed == self._size:
+                self._complete()
+
+    def _complete(self) -> None:
+        if not self.complete:
+            self.complete = True
+            self._on_complete(self)
+
+    def _consume(self, stream: Any, end: Optional[int] = None) -> None:
+        stream.seek(self._hashed)
+        while end is None or self._hashed < end:
+            size = (
+                self._CHUNK_SIZE
+                if end is None
+                else min(self._CHUNK_SIZE, end - self._hashed)
+            )
+            data = stream.read(size)
+            if not data:
+                break
+            self._update(self._hashed, data)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        position = self._stream.tell()
+        data = self._stream.read(size)
+        self._update(position, data)
+        return data
+
+    def read1(self, size: int = -1) -> bytes:
+        position = self._stream.tell()
+        data = self._stream.read1(size)
+        self._update(position, data)
+        return data
+
+    def readinto(self, buffer: Any) -> int:
+        position = self._stream.tell()
+        num_read = self._stream.readinto(buffer)
+        self._update(position, memoryview(buffer)[:num_read])
+        return num_read
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        position = self._stream.tell()
+        data = self._stream.readline(size)
+        self._update(position, data)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET and offset > self._hashed:
+            self._consume(self._stream, offset)
+        return self._stream.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def finish(self) -> None:
+        # Hashes everything that was not read by the pipeline
+        if self.complete:
+            return
+
+        if self._stream.closed:
+            if not os.path.isfile(self.path):
+                raise RuntimeError(f"{self.path} was closed before it was fully read")
+            with open(self.path, "rb") as fh:
+                self._consume(fh)
+        else:
+            position = self._stream.tell()
+            self._consume(self._stream)
+            self._stream.seek(position)
+        self._complete()
+
+
+class _HashedFile:
+    # Hashes a file or an uncompressed archive member through its own handle in a
+    # single sequential pass in a background thread. Thus, the hash neither depends on
+    # how the pipeline reads the stream, e.g. only the headers of a tar whose members
+    # are reopened by their MemberRef, nor on whether it reads the stream to the end.
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        open_fn: Callable[[], Any],
+        *,
+        algorithm: str,
+        on_complete: Callable[["_HashedFile"], None],
+    ) -> None:
+        self.path = path
+        self._hash = hashlib.new(algorithm)
+        self._on_complete = on_complete
+        self._error: Optional[Exception] = None
+        self.complete = False
+
+        self._thread = threading.Thread(target=self._run, args=(open_fn,), daemon=True)
+        self._thread.start()
+
+    def _run(self, open_fn: Callable[[], Any]) -> None:
+        try:
+            with open_fn() as fh:
+                for data in iter(functools.partial(fh.read, self._CHUNK_SIZE), b""):
+                    self._hash.update(data)
+        except Exception as error:
+            self._error = error
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def poll(self) -> None:
+        # Checks the hash if it is done, but does not wait for it
+        if not self._thread.is_alive():
+            self.finish()
+
+    def finish(self) -> None:
+        if self.complete:
+            return
+
+        self._thread.join()
+        self.complete = True
+        if self._error is not None:
+            raise RuntimeError(f"{self.path} could not be hashed") from self._error
+        self._on_complete(self)
+
+
+def _hash_source(path: str, stream: Any) -> Optional[Callable[[], Any]]:
+    # Opens an independent handle to the bytes of the stream if there is one
+    if isinstance(stream, MemberRef):
+        if stream.compression is not None:
+            # Reopening would decompress the archive up to the member once more
+            return None
+        return functools.partial(
+            MemberRef, stream.archive, stream.offset, stream.size, None
+        )
+    elif os.path.isfile(path):
+        return functools.partial(open, path, "rb")
+    return None
+
+
+class _CheckedStream(io.BufferedIOBase):
+    # Passes the stream through unchanged. Every read polls the background hash, so a
+    # mismatch is reported while the pipeline is still reading the stream rather than
+    # only when the next item is requested.
+    def __init__(self, stream: Any, hashed: _HashedFile) -> None:
+        super().__init__()
+        self._stream = stream
+        self._hashed = hashed
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        self._hashed.poll()
+        return self._stream.read(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        self._hashed.poll()
+        return self._stream.read1(size)
+
+    def readinto(self, buffer: Any) -> int:
+        self._hashed.poll()
+        return self._stream.readinto(buffer)
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        self._hashed.poll()
+        return self._stream.readline(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._stream.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+
+class Verify(IterDataPipe):
+    # Checks (path, stream) tuples against known checksums. Files and uncompressed
+    # archive members are hashed in a background thread in a single sequential pass
+    # independent of how the pipeline reads them. Other streams, e.g. members of a
+    # compressed archive, are hashed while the downstream datapipes read them. Either
+    # way, a stream is checked as soon as it is hashed completely, but at the latest
+    # when the next item is requested or the pipeline stops iterating.
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, io.BufferedIOBase]],
+        checksums: Dict[str, str],
+        *,
+        key_fn: Callable[[str], str] = lambda path: member_path(path).name,
+        algorithm: str = "md5",
+        strict: bool = True,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.checksums = checksums
+        self.key_fn = key_fn
+        self.algorithm = algorithm
+        self.strict = strict
+
+    def __iter__(self) -> Iterator[Tuple[str, io.BufferedIOBase]]:
+        pending: Optional[Union[_HashedFile, _HashedStream]] = None
+        try:
+            for path, stream in self.datapipe:
+                if pending is not None:
+                    pending.finish()
+                    pending = None
+
+                checksum = self.checksums.get(self.key_fn(path))
+                if checksum is not None:
+                    fingerprint = _fingerprint(path, stream, checksum)
+                    if fingerprint is None or fingerprint not in _verified():
+                        stream, pending = self._hashed(
+                            path, stream, checksum=checksum, fingerprint=fingerprint
+                        )
+
+                yield path, stream
+        finally:
+            # Consumers may stop before the end, e.g. SplitByKey once its branches are
+            # done. The rest of the stream is still hashed and checked.
+            if pending is not None:
+                pending.finish()
+
+    def _hashed(
+        self, path: str, stream: Any, *, checksum: str, fingerprint: Optional[str]
+    ) -> Tuple[Any, Union[_HashedFile, _HashedStream]]:
+        on_complete = functools.partial(
+            self._check, checksum=checksum, fingerprint=fingerprint
+        )
+
+        open_fn = _hash_source(path, stream)
+        if open_fn is None:
+            hashed_stream = _HashedStream(
+                path, stream, algorithm=self.algorithm, on_complete=on_complete
+            )
+            return hashed_stream, hashed_stream
+
+        hashed_file = _HashedFile(
+            path, open_fn, algorithm=self.algorithm, on_complete=on_complete
+        )
+        return _CheckedStream(stream, hashed_file), hashed_file
+
+    def _check(
+        self,
+        stream: Union[_HashedFile, _HashedStream],
+        *,
+        checksum: str,
+        fingerprint: Optional[str],
+    ) -> None:
+        digest = stream.hexdigest()
+        if digest == checksum:
+            if fingerprint is not None:
+                _mark_verified(fingerprint)
+            return
+
+        msg = (
+            f"The {self.algorithm} checksum of {stream.path} is {digest}, "
+            f"but {checksum} was expected"
+        )
+        if self.strict:
+            raise RuntimeError(msg)
+        warnings.warn(msg)
+
+
+# Taking the state of a pipeline walks its graph. Thus, the helpers that need the state
+# of their input for every item only take it every so many items and otherwise count
+# the items drawn since. Resuming draws the counted items again and skips them.
+_SNAPSHOT_INTERVAL = 32
+
+
+class ResumableInput:
+    # Helper for datapipes that consume every item of their input piece by piece, e.g.
+    # the members of an archive or the lines of a file. To be able to resume in the
+    # middle of an item, we record the state of the input *before* the item is drawn.
+    # If the input has no state, we have to skip the items that were already read.
+    def __init__(self, datapipe: Iterable[Any]) -> None:
+        self.datapipe = datapipe
+        self._input_state: Optional[Dict[str, Any]] = None
+        self._skip = 0
+
+    def iterate(self, state: Optional[Dict[str, Any]]) -> Iterator[Tuple[Any, Any]]:
+        input_state, skip, position = None, 0, None
+        if state:
+            input_state = state["input"]
+            if input_state is not None:
+                load_pipeline_state_dict(self.datapipe, input_state)
+            skip, position = state["skip"], state["position"]
+
+        seekable = bool(_stateful_datapipes(self.datapipe))
+        iterator = iter(self.datapipe)
+        # Number of items drawn since input_state was taken
+        drawn = 0
+        while True:
+            if seekable and drawn >= max(skip, _SNAPSHOT_INTERVAL):
+                input_state, drawn = pipeline_state_dict(self.datapipe), 0
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+
+            drawn += 1
+            if drawn <= skip:
+                continue
+            skip = 0
+
+            self._input_state = input_state
+            self._skip = drawn - 1
+            yield data, position
+            position = None
+
+    def state_dict(self, position: Any) -> Dict[str, Any]:
+        return dict(input=self._input_state, skip=self._skip, position=position)
+
+
+def _stateful_datapipes(datapipe: Any) -> List[Any]:
+    # Collects the topmost datapipes with a state in the graph. They are responsible to
+    # store the state of everything upstream of them.
+    stateful = []
+    seen = set()
+
+    def visit(obj: Any) -> None:
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+
+        if hasattr(obj, "state_dict") and hasattr(obj, "load_state_dict"):
+            stateful.append(obj)
+            return
+
+        for value in getattr(obj, "__dict__", {}).values():
+            for child in value if isinstance(value, (list, tuple)) else (value,):
+                if isinstance(child, (IterDataPipe, SplitByKey)):
+                    visit(child)
+
+    visit(datapipe)
+    return stateful
+
+
+def pipeline_state_dict(datapipe: Any) -> Dict[str, Any]:
+    return dict(
+        datapipes=[
+            stateful_datapipe.state_dict()
+            for stateful_datapipe in _stateful_datapipes(datapipe)
+        ]
+    )
+
+
+def load_pipeline_state_dict(datapipe: Any, state: Dict[str, Any]) -> None:
+    stateful_datapipes = _stateful_datapipes(datapipe)
+    if len(stateful_datapipes) != len(state["datapipes"]):
+        raise RuntimeError("The state does not match the structure of the datapipe")
+
+    for stateful_datapipe, stateful_datapipe_state in zip(
+        stateful_datapipes, state["datapipes"]
+    ):
+        stateful_datapipe.load_state_dict(stateful_datapipe_state)
+
+
+class Resumable(IterDataPipe):
+    def __init__(self, datapipe: Iterable[D]) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+
+    def __iter__(self) -> Iterator[D]:
+        yield from self.datapipe
+
+    def __aiter__(self) -> AsyncIterator[D]:
+        return aiterate(self)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return pipeline_state_dict(self.datapipe)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state)
+
+
+def _children(obj: Any) -> Iterator[Tuple[str, Optional[int], Any]]:
+    # Same notion of the graph as _stateful_datapipes(): the inputs are the datapipes
+    # stored as attributes, either directly or in lists and tuples.
+    for name, value in list(getattr(obj, "__dict__", {}).items()):
+        if isinstance(value, (list, tuple)):
+            for idx, child in enumerate(value):
+                if isinstance(child, (IterDataPipe, SplitByKey)):
+                    yield name, idx, child
+        elif isinstance(value, (IterDataPipe, SplitByKey)):
+            yield name, None, value
+
+
+def _replace_child(obj: Any, name: str, idx: Optional[int], old: Any, new: Any) -> None:
+    if idx is None:
+        setattr(obj, name, new)
+    else:
+        value = getattr(obj, name)
+        items = list(value)
+        items[idx] = new
+        setattr(obj, name, items if isinstance(value, list) else tuple(items))
+
+    # Readers iterate their input through a helper that holds a reference as well
+    for value in vars(obj).values():
+        if isinstance(value, ResumableInput) and value.datapipe is old:
+            value.datapipe = new
+
+
+class _FusedMap:
+    def __init__(self, fns: Sequence[Tuple[Callable, Tuple, Dict[str, Any]]]) -> None:
+        self.fns = list(fns)
+
+    def __call__(self, data: Any) -> Any:
+        for fn, args, kwargs in self.fns:
+            data = fn(data, *args, **kwargs)
+        return data
+
+
+# The attributes dp.iter.Map stores its arguments in are not part of its public
+# interface. Thus, maps are only fused for the signature they were written against.
+_MAP_PARAMETERS = ("self", "datapipe", "fn", "fn_args", "fn_kwargs", "nesting_level")
+
+
+@functools.lru_cache(maxsize=None)
+def _known_map_signature() -> bool:
+    try:
+        parameters = tuple(inspect.signature(dp.iter.Map.__init__).parameters)
+    except (TypeError, ValueError):
+        return False
+    return parameters == _MAP_PARAMETERS
+
+
+def _map_fns(datapipe: Any) -> Optional[List[Tuple[Callable, Tuple, Dict[str, Any]]]]:
+    # Only plain maps over the whole item can be fused. Subclasses, e.g. the decoders,
+    # might do more than calling fn.
+    if (
+        type(datapipe) is not dp.iter.Map
+        or not _known_map_signature()
+        or datapipe.nesting_level != 0
+    ):
+        return None
+
+    args = tuple(datapipe.args)
+    kwargs = dict(datapipe.kwargs)
+    if isinstance(datapipe.fn, _FusedMap) and not (args or kwargs):
+        return list(datapipe.fn.fns)
+    return [(datapipe.fn, args, kwargs)]
+
+
+class _ExcludePaths:
+    def __init__(
+        self,
+        filter_fn: Optional[Callable[[MemberPath], bool]],
+        condition: Callable[[MemberPath], bool],
+    ) -> None:
+        self.filter_fn = filter_fn
+        self.condition = condition
+
+    def __call__(self, path: MemberPath) -> bool:
+        if self.filter_fn is not None and not self.filter_fn(path):
+            return False
+        return not self.condition(path)
+
+
+def optimize(datapipe: D) -> D:
+    # Rewrites the graph of a fully constructed pipeline in place and returns its new
+    # head. The rewrites do not change the items that come out:
+    #
+    # 1. DropByPath is moved below all stages that keep the paths, so for example no
+    #    image is decoded just to be dropped afterwards. If it ends up right above an
+    #    archive reader, it is merged into its filter_fn and the dropped members are
+    #    skipped without ever being read. If it ends up right above a branch of a
+    #    SplitByKey, the splitter drops the items before they are buffered.
+    # 2. Chains of plain dp.iter.Map are fused into a single one.
+    # 3. Branches of a SplitByKey that are not part of the graph are removed. Their
+    #    items are dropped right away instead of being buffered forever.
+    #
+    # Stages that are referenced from more than one place are never moved past. Since
+    # the state is collected by walking the graph as well, optimize() has to be called
+    # before state_dict() or load_state_dict().
+    parents: Dict[int, int] = collections.Counter()
+    # Keeps the replaced stages alive, so their ids cannot be reused by new ones
+    nodes: Dict[int, Any] = {}
+
+    def count(obj: Any) -> None:
+        if id(obj) in nodes:
+            return
+        nodes[id(obj)] = obj
+
+        for _, _, child in _children(obj):
+            parents[id(child)] += 1
+            count(child)
+
+    count(datapipe)
+
+    rewritten: Dict[int, Any] = {}
+
+    def rewrite(obj: Any) -> Any:
+        if id(obj) in rewritten:
+            return rewritten[id(obj)]
+        rewritten[id(obj)] = obj
+
+        for name, idx, child in list(_children(obj)):
+            new = rewrite(child)
+            if new is not child:
+                _replace_child(obj, name, idx, child, new)
+
+        new = obj
+        if isinstance(obj, DropByPath):
+            new = _push_down(obj, parents)
+        else:
+            fns = _map_fns(obj)
+            inner_fns = _map_fns(obj.datapipe) if fns is not None else None
+            if inner_fns is not None and parents[id(obj.datapipe)] == 1:
+                new = dp.iter.Map(obj.datapipe.datapipe, _FusedMap(inner_fns + fns))
+                parents[id(new)] = parents[id(obj)]
+
+        rewritten[id(obj)] = new
+        return new
+
+    datapipe = rewrite(datapipe)
+    _remove_unused_branches(datapipe)
+    return datapipe
+
+
+_READERS = (ReadFilesFromArchive, ReadFilesFromTar, ReadFilesFromZip, ReadFilesFromRar)
+
+
+def _keeps_paths(datapipe: Any) -> bool:
+    return isinstance(
+        datapipe,
+        (dp.iter.RoutedDecoder, DecodeMasks, Prefetch, ProbeImages, Drop, DropByPath),
+    )
+
+
+def _push_down(drop: DropByPath, parents: Dict[int, int]) -> Any:
+    above, below = drop, drop.datapipe
+    while _keeps_paths(below) and parents[id(below)] == 1:
+        above, below = below, below.datapipe
+
+    if (
+        isinstance(below, _READERS)
+        and not getattr(below, "nested", False)
+        and parents[id(below)] == 1
+    ):
+        # For nested archives, filter_fn also sees the paths of the inner archives
+        below.filter_fn = _ExcludePaths(below.filter_fn, drop.condition)
+    elif isinstance(below, _SplittedIterDataPipe) and parents[id(below)] == 1:
+        # The splitter drops the items of the branch before they are buffered. The
+        # other branches might still need the same members, so the condition cannot
+        # be moved further into the archive reader.
+        conditions = below._splitter.drop_conditions.setdefault(below.key, [])
+        conditions.append(drop.condition)
+    elif above is drop:
+        return drop
+    else:
+        new = DropByPath(below, drop.condition)
+        parents[id(new)] = 1
+        _replace_child(above, "datapipe", None, below, new)
+
+    return drop.datapipe
+
+
+def _remove_unused_branches(datapipe: Any) -> None:
+    reachable: Dict[int, Any] = {}
+    splitters: Dict[int, SplitByKey] = {}
+
+    def visit(obj: Any) -> None:
+        if id(obj) in reachable:
+            return
+        reachable[id(obj)] = obj
+
+        if isinstance(obj, SplitByKey):
+            splitters[id(obj)] = obj
+        for _, _, child in _children(obj):
+            visit(child)
+
+    visit(datapipe)
+
+    for splitter in splitters.values():
+        consumed = frozenset(
+            key for key, split in splitter.splits.items() if id(split) in reachable
+        )
+        for key in set(splitter.splits).difference(consumed):
+            # Releases the memory budget of the items buffered so far
+            collections.deque(splitter.splits.pop(key)._queue.drain(), maxlen=0)
+        splitter.consumed_keys = consumed
+
+
+class _Done(NamedTuple):
+    error: Optional[BaseException] = None
+
+
+def _detach_members(data: Any) -> None:
+    for item in data if isinstance(data, (list, tuple)) else (data,):
+        if isinstance(item, MemberRef):
+            item._detach()
+
+
+class Prefetch(IterDataPipe):
+    # Iterates the datapipe in a background thread and hands over the items through a
+    # bounded queue. File reads, zlib, and most image decoders release the GIL, so
+    # multiple sources wrapped like this make progress in parallel. With buffer_size=0
+    # the datapipe is iterated in the calling thread, but the state has the same
+    # format. Thus, the prefetch of a dataset can be changed between checkpoints.
+    def __init__(self, datapipe: Iterable[D], buffer_size: int = 64) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.buffer_size = buffer_size
+
+        # The thread runs ahead of the consumer. Thus, we store the state of the input
+        # together with the item it was taken after and only expose it once the item
+        # was consumed. In between and if the input has no state, we count the
+        # consumed items.
+        self._input_state: Optional[Dict[str, Any]] = None
+        self._skip = 0
+        self._inline = False
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def _start(self) -> bool:
+        state, self._resume = self._resume, None
+        self._input_state, self._skip = (
+            (state["input"], state["skip"]) if state else (None, 0)
+        )
+        if self._input_state is not None:
+            load_pipeline_state_dict(self.datapipe, self._input_state)
+
+        return bool(_stateful_datapipes(self.datapipe))
+
+    def __iter__(self) -> Iterator[D]:
+        seekable = self._start()
+        if not self.buffer_size:
+            yield from self._iter_inline(seekable)
+            return
+
+        buffer: queue.Queue = queue.Queue(self.buffer_size)
+        stop = threading.Event()
+        account = _MEMORY_BUDGET.account("Prefetch")
+        thread = threading.Thread(
+            target=self._produce,
+            args=(buffer, stop, account),
+            kwargs=dict(seekable=seekable, skip=self._skip),
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if isinstance(item, _Done):
+                    if item.error is not None:
+                        raise item.error
+                    return
+
+                data, input_state, nbytes = item
+                _MEMORY_BUDGET.charge(account, -nbytes)
+                if input_state is not None:
+                    self._input_state, self._skip = input_state, 0
+                else:
+                    self._skip += 1
+                yield data
+        finally:
+            stop.set()
+            thread.join()
+
+    def _iter_inline(self, seekable: bool) -> Iterator[D]:
+        # The input is never ahead of the consumer, so its state is only taken on demand
+        self._inline = seekable
+        try:
+            for data in itertools.islice(self.datapipe, self._skip, None):
+                if not seekable:
+                    self._skip += 1
+                yield data
+        finally:
+            if seekable:
+                self._input_state = pipeline_state_dict(self.datapipe)
+            self._inline = False
+
+    def _produce(
+        self,
+        buffer: queue.Queue,
+        stop: threading.Event,
+        account: _BudgetAccount,
+        *,
+        seekable: bool,
+        skip: int,
+    ) -> None:
+        try:
+            for idx, data in enumerate(itertools.islice(self.datapipe, skip, None), 1):
+                _detach_members(data)
+                input_state = (
+                    pipeline_state_dict(self.datapipe)
+                    if seekable and idx % _SNAPSHOT_INTERVAL == 0
+                    else None
+                )
+
+                # If the memory budget is exceeded, we wait until the consumer caught
+                # up. Waiting on an empty queue would stall the consumer for good.
+                while _MEMORY_BUDGET.exceeded() and not buffer.empty():
+                    if stop.wait(0.01):
+                        return
+
+                nbytes = _sizeof(data)
+                _MEMORY_BUDGET.charge(account, nbytes)
+                if not self._put(buffer, stop, (data, input_state, nbytes)):
+                    return
+            done = _Done()
+        except Exception as error:
+            done = _Done(error)
+        self._put(buffer, stop, done)
+
+    async def _aiterate(
+        self, executor: Optional[concurrent.futures.Executor]
+    ) -> AsyncIterator[D]:
+        # Used by aiterate(). Instead of a thread, up to buffer_size items are fetched
+        # ahead of the consumer. If the datapipe ends in stages that only map the items,
+        # e.g. decoders, the items are fetched from their input and the functions are
+        # applied to all fetched items at the same time in the executor of the loop.
+        seekable = self._start()
+        if not self.buffer_size:
+            self._inline = seekable
+            skip = self._skip
+            try:
+                async for data in _aiter(self.datapipe, executor):
+                    if skip:
+                        skip -= 1
+                        continue
+                    if not seekable:
+                        self._skip += 1
+                    yield data
+            finally:
+                if seekable:
+                    self._input_state = pipeline_state_dict(self.datapipe)
+                self._inline = False
+            return
+
+        source, fns = _split_maps(self.datapipe)
+        fn = _FusedMap(fns) if fns else None
+        pending: Deque[Tuple[asyncio.Future, Optional[Dict[str, Any]]]] = (
+            collections.deque()
+        )
+        skip = self._skip
+        idx = 0
+        iterator = _aiter(source, executor)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.buffer_size:
+                    try:
+                        data = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+
+                    if skip:
+                        skip -= 1
+                        continue
+
+                    idx += 1
+                    _detach_members(data)
+                    # The state is the same as the one after the mapped item
+                    input_state = (
+                        pipeline_state_dict(self.datapipe)
+                        if seekable and idx % _SNAPSHOT_INTERVAL == 0
+                        else None
+                    )
+                    pending.append((_schedule(executor, fn, data), input_state))
+
+                if not pending:
+                    return
+
+                future, input_state = pending.popleft()
+                data = await future
+                if input_state is not None:
+                    self._input_state, self._skip = input_state, 0
+                else:
+                    self._skip += 1
+                yield data
+        finally:
+            for future, _ in pending:
+                future.cancel()
+            await iterator.aclose()
+
+    @staticmethod
+    def _put(buffer: queue.Queue, stop: threading.Event, item: Any) -> bool:
+        # Blocking indefinitely would keep the thread alive if the consumer stops early
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def state_dict(self) -> Dict[str, Any]:
+        if self._resume:
+            return self._resume
+        elif self._inline:
+            return dict(input=pipeline_state_dict(self.datapipe), skip=0)
+        return dict(input=self._input_state, skip=self._skip)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+class Interleave(IterDataPipe):
+    # Draws the next item from a randomly chosen datapipe until all are exhausted. The
+    # probability of a datapipe is proportional to weight ** (1 / temperature), e.g.
+    # with the dataset sizes as weights, temperature=1 samples proportionally and a
+    # large temperature approaches uniform sampling.
+    #
+    # With max_open, at most that many datapipes are iterated at the same time. If
+    # another one is drawn, the least recently used one is suspended: its state is
+    # stored and its iterator, and with it the open archives, is closed. It resumes
+    # from the stored state once it is drawn again. Datapipes without a state cannot
+    # be suspended and are thus kept open.
+    def __init__(
+        self,
+        *datapipes: Iterable[Any],
+        weights: Optional[Sequence[float]] = None,
+        temperature: float = 1.0,
+        seed: Optional[int] = None,
+        max_open: Optional[int] = None,
+        prefetch: int = 0,
+    ) -> None:
+        super().__init__()
+        if weights is None:
+            weights = [1.0] * len(datapipes)
+        elif len(weights) != len(datapipes):
+            raise ValueError(
+                f"Got {len(weights)} weights for {len(datapipes)} datapipes"
+            )
+        if prefetch:
+            datapipes = tuple(
+                Prefetch(datapipe, buffer_size=prefetch) for datapipe in datapipes
+            )
+        self.datapipes = datapipes
+        self.weights = [weight ** (1 / temperature) for weight in weights]
+        self.seed = seed
+        self.max_open = max_open
+
+        self._rng = random.Random(seed)
+        self._states: List[Optional[Dict[str, Any]]] = [None] * len(datapipes)
+        self._exhausted = [False] * len(datapipes)
+        self._iterators: "collections.OrderedDict[int, Iterator[Any]]" = (
+            collections.OrderedDict()
+        )
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Any]:
+        state, self._resume = self._resume, None
+        self._rng = random.Random(self.seed)
+        self._states = [None] * len(self.datapipes)
+        self._exhausted = [False] * len(self.datapipes)
+        if state:
+            self._rng.setstate(state["rng"])
+            self._states = list(state["datapipes"])
+            self._exhausted = list(state["exhausted"])
+        self._iterators = collections.OrderedDict()
+        suspendable = [
+            bool(_stateful_datapipes(datapipe)) for datapipe in self.datapipes
+        ]
+
+        while True:
+            candidates = [
+                idx for idx, exhausted in enumerate(self._exhausted) if not exhausted
+            ]
+            if not candidates:
+                return
+
+            (idx,) = self._rng.choices(
+                candidates, weights=[self.weights[idx] for idx in candidates]
+            )
+            try:
+                data = next(self._open(idx, suspendable))
+            except StopIteration:
+                del self._iterators[idx]
+                self._states[idx] = None
+                self._exhausted[idx] = True
+                continue
+
+            yield data
+
+    def _open(self, idx: int, suspendable: List[bool]) -> Iterator[Any]:
+        if idx in self._iterators:
+            self._iterators.move_to_end(idx)
+            return self._iterators[idx]
+
+        if self.max_open is not None:
+            for other in [other for other in self._iterators if suspendable[other]]:
+                if len(self._iterators) < self.max_open:
+                    break
+                self._states[other] = pipeline_state_dict(self.datapipes[other])
+                self._iterators.pop(other).close()
+
+        datapipe = self.datapipes[idx]
+        if self._states[idx] is not None:
+            load_pipeline_state_dict(datapipe, self._states[idx])
+        iterator = self._iterators[idx] = iter(datapipe)
+        return iterator
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or dict(
+            rng=self._rng.getstate(),
+            datapipes=[
+                pipeline_state_dict(datapipe) if idx in self._iterators else state
+                for idx, (datapipe, state) in enumerate(
+                    zip(self.datapipes, self._states)
+                )
+            ],
+            exhausted=list(self._exhausted),
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _knob_attribute(knob: str) -> Tuple[Tuple[type, ...], str]:
+    # The stages that implement a knob that Autotune can set and their attribute
+    return {
+        "prefetch": ((Prefetch,), "buffer_size"),
+        "num_threads": (
+            (ReadFilesFromArchive, ReadFilesFromZip, DecodeClips),
+            "num_threads",
+        ),
+    }[knob]
+
+
+def _knob_stages(datapipe: Any, knob: str) -> List[Any]:
+    types, _ = _knob_attribute(knob)
+    stages = []
+    seen = set()
+
+    def visit(obj: Any) -> None:
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+
+        if isinstance(obj, types):
+            stages.append(obj)
+        for _, _, child in _children(obj):
+            visit(child)
+
+    visit(datapipe)
+    return stages
+
+
+def _lowest_common_stage(datapipe: Any, stages: List[Any]) -> Any:
+    # The lowest iterable stage that all given stages feed into. Draining it measures
+    # their throughput without the stages on top of it.
+    targets = {id(stage) for stage in stages}
+    reachable: Dict[int, FrozenSet[int]] = {}
+
+    def visit(obj: Any) -> FrozenSet[int]:
+        if id(obj) not in reachable:
+            reachable[id(obj)] = frozenset()
+            below = {id(obj)} & targets
+            for _, _, child in _children(obj):
+                below |= visit(child)
+            reachable[id(obj)] = frozenset(below)
+        return reachable[id(obj)]
+
+    visit(datapipe)
+    lowest = datapipe
+    while True:
+        for _, _, child in _children(lowest):
+            if reachable[id(child)] == targets and hasattr(child, "__iter__"):
+                lowest = child
+                break
+        else:
+            return lowest
+
+
+def _touch(data: Any) -> None:
+    # Members are only read lazily. A trial has to read them to measure the reader.
+    if isinstance(data, MemberRef):
+        data.read()
+    elif isinstance(data, (tuple, list)):
+        for item in data:
+            _touch(item)
+    elif isinstance(data, Mapping):
+        for item in data.values():
+            _touch(item)
+
+
+class Autotune(IterDataPipe):
+    # Picks the knobs of a dataset, e.g. prefetch or num_threads, before iterating it.
+    # The dataset is built only once. A trial sets a knob on all stages that implement
+    # it, e.g. the buffer_size of every Prefetch, and drains items as fast as possible
+    # from the lowest stage that all of them feed into. Thus, the throughput neither
+    # depends on the consumer nor on the stages on top. Afterwards, the dataset is
+    # rewound, so every trial reads the same items and the consumer sees all of them.
+    # The first trial only warms up the caches and fixes the number of items per trial.
+    # The knobs are tuned one after the other by trying their values in the given order
+    # until the throughput stops improving by more than tolerance. Configurations that
+    # exceed the memory budget are rejected. The chosen configuration is logged, so it
+    # can be pinned afterwards.
+    def __init__(
+        self,
+        datapipe: Any,
+        knobs: Dict[str, Sequence[Any]],
+        *,
+        trial_duration: float = 1.0,
+        min_items: int = 16,
+        tolerance: float = 0.05,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.knobs = knobs
+        self.trial_duration = trial_duration
+        self.min_items = min_items
+        self.tolerance = tolerance
+
+        self.config: Optional[Dict[str, Any]] = None
+        self.trials: List[Tuple[Dict[str, Any], float]] = []
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[D]:
+        state, self._resume = self._resume, None
+        if state:
+            self.config = state["config"]
+            self.datapipe.load_state_dict(state["datapipe"])
+
+        if self.config is None:
+            self.config = self._tune(self.datapipe.state_dict())
+            _LOGGER.info(
+                "Autotuned configuration: %s",
+                ", ".join(f"{knob}={value!r}" for knob, value in self.config.items()),
+            )
+        else:
+            self._apply(self.config)
+
+        yield from self.datapipe
+
+    def _apply(self, config: Dict[str, Any]) -> None:
+        for knob, value in config.items():
+            _, attribute = _knob_attribute(knob)
+            for stage in _knob_stages(self.datapipe, knob):
+                setattr(stage, attribute, value)
+
+    def _tune(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        self.trials = []
+        config = {knob: values[0] for knob, values in self.knobs.items()}
+        stages = {knob: _knob_stages(self.datapipe, knob) for knob in self.knobs}
+        if not any(stages.values()):
+            return config
+
+        try:
+            self._apply(config)
+            _, num_items = self._trial(
+                _lowest_common_stage(
+                    self.datapipe,
+                    [stage for knob_stages in stages.values() for stage in knob_stages],
+                ),
+                state,
+                num_items=None,
+            )
+            if not num_items:
+                return config
+
+            for knob, values in self.knobs.items():
+                if not stages[knob]:
+                    continue
+
+                stage = _lowest_common_stage(self.datapipe, stages[knob])
+                best, _ = self._trial(stage, state, num_items=num_items)
+                self.trials.append((config, best))
+                for value in values[1:]:
+                    candidate = {**config, knob: value}
+                    self._apply(candidate)
+                    throughput, _ = self._trial(stage, state, num_items=num_items)
+                    self.trials.append((candidate, throughput))
+                    _LOGGER.debug(
+                        "Autotune trial %s: %.1f items/s", candidate, throughput
+                    )
+                    if throughput <= best * (1 + self.tolerance):
+                        break
+                    config, best = candidate, throughput
+                self._apply(config)
+            return config
+        finally:
+            self._apply(config)
+            self.datapipe.load_state_dict(state)
+
+    def _trial(
+        self, stage: Any, state: Dict[str, Any], *, num_items: Optional[int]
+    ) -> Tuple[float, int]:
+        # Drains num_items items from the stage, or as many as fit into trial_duration,
+        # and returns the throughput in items per second together with their number
+        self.datapipe.load_state_dict(state)
+        iterator = iter(stage)
+        try:
+            # The first item includes the startup, e.g. opening the archives
+            try:
+                _touch(next(iterator))
+            except StopIteration:
+                return 0.0, 0
+
+            count = 0
+            exceeded = False
+            start = time.perf_counter()
+            while True:
+                if num_items is not None:
+                    if count >= num_items:
+                        break
+                elif (
+                    time.perf_counter() - start >= self.trial_duration
+                    and count >= self.min_items
+                ):
+                    break
+
+                try:
+                    _touch(next(iterator))
+                except StopIteration:
+                    break
+                count += 1
+                exceeded = exceeded or _MEMORY_BUDGET.exceeded()
+            elapsed = time.perf_counter() - start
+        finally:
+            # Stops background threads and closes the archives
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+        return (0.0 if exceeded else count / max(elapsed, 1e-9)), count
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or dict(
+            config=self.config, datapipe=self.datapipe.state_dict()
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+async def aiterate(
+    datapipe: Iterable[D],
+    *,
+    fn: Optional[Callable[[D], Any]] = None,
+    concurrency: int = 1,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> AsyncIterator[Any]:
+    # Iterates a datapipe without blocking the event loop. Advancing the datapipe as
+    # well as fn, e.g. decoding, run in the executor, which defaults to the one of the
+    # loop. Thus, many consumers can share a single loop and a pool of threads. Up to
+    # concurrency items are processed by fn at the same time. They are yielded in order.
+    #
+    # Prefetch and DependentGroupByKey are iterated natively: the former decodes up to
+    # buffer_size items at the same time and the latter awaits all its sources at once.
+    # Everything else is advanced by calling next() in the executor.
+    iterator = _aiter(datapipe, executor)
+    exhausted = False
+    pending: Deque[asyncio.Future] = collections.deque()
+    try:
+        while True:
+            while not exhausted and len(pending) < max(concurrency, 1):
+                try:
+                    data = await iterator.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+
+                pending.append(_schedule(executor, fn, data))
+
+            if not pending:
+                return
+
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+        await iterator.aclose()
+
+
+def _schedule(
+    executor: Optional[concurrent.futures.Executor],
+    fn: Optional[Callable[[D], Any]],
+    data: D,
+) -> asyncio.Future:
+    loop = asyncio.get_running_loop()
+    if fn is None:
+        future = loop.create_future()
+        future.set_result(data)
+        return future
+    return loop.run_in_executor(executor, fn, data)
+
+
+def _aiter(
+    datapipe: Iterable[D], executor: Optional[concurrent.futures.Executor]
+) -> AsyncIterator[D]:
+    source, fns = _split_maps(datapipe)
+    if fns:
+        return _amap(_aiter(source, executor), _FusedMap(fns), executor)
+    elif hasattr(source, "_aiterate"):
+        return source._aiterate(executor)
+    return _aiter_in_executor(source, executor)
+
+
+async def _aiter_in_executor(
+    datapipe: Iterable[D], executor: Optional[concurrent.futures.Executor]
+) -> AsyncIterator[D]:
+    # The datapipe is advanced by one thread at a time, since the next call is only
+    # scheduled after the previous one finished.
+    loop = asyncio.get_running_loop()
+    iterator = iter(datapipe)
+    end = object()
+    while True:
+        data = await loop.run_in_executor(executor, next, iterator, end)
+        if data is end:
+            return
+        yield data
+
+
+async def _amap(
+    iterator: AsyncIterator[D],
+    fn: Callable[[D], Any],
+    executor: Optional[concurrent.futures.Executor],
+) -> AsyncIterator[Any]:
+    loop = asyncio.get_running_loop()
+    try:
+        async for data in iterator:
+            yield await loop.run_in_executor(executor, fn, data)
+    finally:
+        await iterator.aclose()  # type: ignore[attr-defined]
+
+
+async def _anext_until_key(
+    iterator: AsyncIterator[D],
+    *,
+    key_fn: Callable[[D], K],
+    key: K,
+    buffer: MutableMapping[K, D],
+) -> D:
+    # Async version of next_until_key()
+    if key in buffer:
+        return buffer.pop(key)
+
+    async for data in iterator:
+        key_ = key_fn(data)
+        if key_ == key:
+            return data
+        else:
+            buffer[key_] = data
+    else:
+        raise RuntimeError(f"Key {key} was never found")
+
+
+def _split_maps(
+    datapipe: Any,
+) -> Tuple[Any, List[Tuple[Callable, Tuple, Dict[str, Any]]]]:
+    # Splits the stages at the end of a pipeline that only map every item on its own
+    # from their input. Their functions can be applied to multiple items at the same
+    # time. Only stages whose signature is known are split.
+    fns: List[Tuple[Callable, Tuple, Dict[str, Any]]] = []
+    while True:
+        map_fns = _map_fns(datapipe)
+        if map_fns is not None:
+            fns[:0] = map_fns
+        elif type(datapipe) is dp.iter.RoutedDecoder and isinstance(
+            getattr(datapipe, "decoder", None), Decoder
+        ):
+            fns.insert(0, (_route, (datapipe.decoder,), {}))
+        elif type(datapipe) is DecodeMasks:
+            fns.insert(0, (datapipe._decode, (), {}))
+        elif type(datapipe) is Resumable:
+            # Only passes the items through
+            pass
+        else:
+            return datapipe, fns
+        datapipe = datapipe.datapipe
+
+
+def _route(data: Tuple[str, Any], decoder: Decoder) -> Tuple[str, Any]:
+    # Same as dp.iter.RoutedDecoder for a single item
+    path = data[0]
+    return path, decoder(data)[path]
+
+
+class BatchImages(IterDataPipe):
+    def __init__(
+        self,
+        datapipe: Iterable[Dict[str, Any]],
+        batch_size: int,
+        *,
+        size: Tuple[int, int],
+        image_key: str = "image",
+        mask_key: Optional[str] = None,
+        mode: str = "RGB",
+        drop_last: bool = False,
+        share_memory: bool = True,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.batch_size = batch_size
+        self.size = size
+        self.image_key = image_key
+        # The masks are batched as (N, H, W) class indices, see decode_mask()
+        self.mask_key = mask_key
+        self.mode = mode
+        self.num_channels = len(mode)
+        self.drop_last = drop_last
+        self.share_memory = share_memory
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        batch: Optional[Dict[str, Any]] = None
+        keys: Optional[Set[str]] = None
+        idx = 0
+        for sample in self.datapipe:
+            # The buffers are allocated from the first sample, so every other sample
+            # has to fit into them
+            if keys is None:
+                keys = set(sample)
+            elif sample.keys() != keys:
+                raise ValueError(
+                    f"Expected samples with the keys {sorted(keys)}, "
+                    f"but got {sorted(sample)}"
+                )
+
+            if batch is None:
+                batch = self._allocate(sample)
+
+            self._fill(batch, idx, sample)
+            idx += 1
+
+            if idx == self.batch_size:
+                yield batch
+                batch = None
+                idx = 0
+
+        if batch is not None and not self.drop_last:
+            yield self._narrow(batch, idx)
+
+    def _empty(self, *shape: int, dtype: Any) -> Any:
+        import torch
+
+        tensor = torch.empty(shape, dtype=dtype)
+        # Tensors in shared memory are sent to the main process by file descriptor
+        # rather than being pickled, so no copy is made when a batch leaves a worker.
+        return tensor.share_memory_() if self.share_memory else tensor
+
+    def _allocate(self, sample: Dict[str, Any]) -> Dict[str, Any]:
+        import torch
+
+        height, width = self.size
+        batch: Dict[str, Any] = {
+            self.image_key: self._empty(
+                self.batch_size, self.num_channels, height, width, dtype=torch.uint8
+            ),
+            # (height, width) of every image in its slot, see decode_image_into()
+            f"{self.image_key}_size": self._empty(
+                self.batch_size, 2, dtype=torch.int64
+            ),
+        }
+        for key, value in sample.items():
+            if key == self.image_key:
+                continue
+            elif key == self.mask_key:
+                batch[key] = self._empty(
+                    self.batch_size, height, width, dtype=torch.uint8
+                )
+            elif isinstance(value, (bool, int)):
+                batch[key] = self._empty(self.batch_size, dtype=torch.int64)
+            elif isinstance(value, float):
+                batch[key] = self._empty(self.batch_size, dtype=torch.float64)
+            elif isinstance(value, torch.Tensor):
+                batch[key] = self._empty(
+                    self.batch_size, *value.shape, dtype=value.dtype
+                )
+            else:
+                batch[key] = [None] * self.batch_size
+        return batch
+
+    def _fill(self, batch: Dict[str, Any], idx: int, sample: Dict[str, Any]) -> None:
+        import torch
+
+        for key, value in sample.items():
+            if key == self.image_key:
+                batch[f"{key}_size"][idx] = torch.tensor(
+                    decode_image_into(value, batch[key][idx], mode=self.mode)
+                )
+            elif key == self.mask_key:
+                decode_mask_into(value, batch[key][idx])
+            else:
+                batch[key][idx] = value
+
+    def _narrow(self, batch: Dict[str, Any], length: int) -> Dict[str, Any]:
+        return {key: value[:length] for key, value in batch.items()}
+
+
+_IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "ppm", "pgm", "pbm", "pnm"}
+
+
+def _open_image(data: Any) -> Any:
+    import PIL.Image
+
+    if isinstance(data, PIL.Image.Image):
+        return data
+
+    if isinstance(data, memoryview):
+        data = _ViewReader(data)
+    elif isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    return PIL.Image.open(data)
+
+
+def _fit(size: Tuple[int, int], height: int, width: int) -> Tuple[int, int]:
+    # Largest (width, height) with the aspect ratio of size that fits into the slot
+    scale = min(width / size[0], height / size[1])
+    return (
+        min(width, max(1, round(size[0] * scale))),
+        min(height, max(1, round(size[1] * scale))),
+    )
+
+
+def _write_into(view: Any, pixels: Any, fill: int) -> None:
+    # The pixels are placed in the top left corner of the slot
+    height, width = pixels.shape[:2]
+    view[:height, :width] = pixels
+    view[:height, width:] = fill
+    view[height:] = fill
+
+
+def decode_image_into(data: Any, out: Any, *, mode: str = "RGB") -> Tuple[int, int]:
+    # Images of another size are scaled to fit into the slot without changing their
+    # aspect ratio and the rest of the slot is zeroed. Returns the (height, width) of
+    # the image in the slot.
+    import numpy as np
+    import PIL.Image
+
+    image = _open_image(data)
+    _, height, width = out.shape
+    size = _fit(image.size, height, width)
+    if size != image.size:
+        if image.format == "JPEG":
+            # libjpeg decodes at a fraction of the full size on its own, which is a
+            # lot cheaper than decoding everything and scaling it down afterwards
+            image.draft(mode, size)
+        image = image.resize(size, PIL.Image.BILINEAR)
+    if image.mode != mode:
+        image = image.convert(mode)
+
+    # out is a (C, H, W) slot of the batch tensor. Its numpy view shares the memory,
+    # so the pixels are copied straight from the decoded image into the batch.
+    _write_into(
+        out.numpy().transpose(1, 2, 0),
+        np.asarray(image).reshape(size[1], size[0], -1),
+        fill=0,
+    )
+    return size[1], size[0]
+
+
+def decode_mask(data: Any) -> Any:
+    # Segmentation masks like the ones of VOC are palette images. Their pixels are
+    # the class indices, so they are read as they are instead of being expanded to RGB
+    # and mapped back to the classes. Special values, e.g. 255 for the borders of the
+    # objects in VOC, are kept.
+    import numpy as np
+
+    image = _open_image(data)
+    if image.mode not in ("P", "L"):
+        raise ValueError(
+            f"Expected a palette or grayscale mask, but got an image of mode "
+            f"{image.mode}"
+        )
+    return np.array(image, dtype=np.uint8)
+
+
+def decode_mask_into(data: Any, out: Any, *, fill: int = 255) -> Tuple[int, int]:
+    # Like decode_image_into(), but the rest of the slot is set to fill, by default
+    # the index that VOC ignores
+    import numpy as np
+    import PIL.Image
+
+    mask = data if isinstance(data, np.ndarray) else decode_mask(data)
+    height, width = out.shape
+    size = _fit((mask.shape[1], mask.shape[0]), height, width)
+    if size != (mask.shape[1], mask.shape[0]):
+        # Interpolating would make up classes at the borders of the objects
+        mask = np.asarray(PIL.Image.fromarray(mask).resize(size, PIL.Image.NEAREST))
+
+    # out is a (H, W) slot of the batch tensor and shares its memory
+    _write_into(out.numpy(), mask, fill=fill)
+    return size[1], size[0]
+
+
+class _RunLengths(NamedTuple):
+    shape: Tuple[int, ...]
+    values: Any
+    lengths: Any
+
+
+def _encode_runs(mask: Any) -> _RunLengths:
+    import numpy as np
+
+    flat = mask.ravel()
+    starts = np.ones(flat.size, dtype=bool)
+    np.not_equal(flat[1:], flat[:-1], out=starts[1:])
+    starts = np.flatnonzero(starts)
+    lengths = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+    return _RunLengths(mask.shape, flat[starts], lengths)
+
+
+def _decode_runs(runs: _RunLengths) -> Any:
+    import numpy as np
+
+    return np.repeat(runs.values, runs.lengths).reshape(runs.shape)
+
+
+class _MaskRunCache:
+    # The run-length encoded masks, see DecodeMasks. Only the most recently used ones
+    # are kept up to max_bytes. They are charged to the memory budget, which drops all
+    # of them rather than spilling them, since they can always be decoded again. The
+    # budget might do this from another thread, so the entries are guarded by a lock,
+    # which is never held while charging the budget.
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[Any, _RunLengths]" = (
+            collections.OrderedDict()
+        )
+        self._nbytes = 0
+        self._account = _MEMORY_BUDGET.account("DecodeMasks", spill=self.clear)
+
+    @staticmethod
+    def _sizeof(runs: _RunLengths) -> int:
+        return int(runs.values.nbytes + runs.lengths.nbytes)
+
+    def get(self, key: Any) -> Optional[_RunLengths]:
+        with self._lock:
+            runs = self._entries.get(key)
+            if runs is not None:
+                self._entries.move_to_end(key)
+            return runs
+
+    def put(self, key: Any, runs: _RunLengths) -> None:
+        with self._lock:
+            if key in self._entries:
+                return
+
+            self._entries[key] = runs
+            nbytes = self._sizeof(runs)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= self._sizeof(evicted)
+                nbytes -= self._sizeof(evicted)
+        _MEMORY_BUDGET.charge(self._account, nbytes)
+
+    def clear(self) -> None:
+        with self._lock:
+            nbytes, self._nbytes = self._nbytes, 0
+            self._entries.clear()
+        _MEMORY_BUDGET.charge(self._account, -nbytes)
+
+
+# The masks are keyed by the archive and the offset of the member. The key includes the
+# size and modification time of the archive, so any change invalidates the entries.
+_MASK_CACHE_BYTES = 256 * 1024 * 1024
+_MASK_RUNS = _MaskRunCache(_MASK_CACHE_BYTES)
+
+
+class DecodeMasks(IterDataPipe):
+    # Replaces the data of every (path, data) pair by the class indices of the mask,
+    # see decode_mask(). With cache, the masks of archive members are kept run-length
+    # encoded in the process after they were decoded once. This takes a few KB per
+    # mask, since the objects are large areas of the same class, and later epochs
+    # neither read nor inflate the PNG.
+    def __init__(
+        self, datapipe: Iterable[Tuple[str, Any]], *, cache: bool = True
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.cache = cache
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        for data in self.datapipe:
+            yield self._decode(data)
+
+    def _decode(self, data: Tuple[str, Any]) -> Tuple[str, Any]:
+        path, data = data
+        if not (self.cache and isinstance(data, MemberRef)):
+            return path, decode_mask(data)
+
+        stat = os.stat(data.archive)
+        key = (
+            os.path.abspath(data.archive),
+            stat.st_size,
+            stat.st_mtime_ns,
+            data.offset,
+        )
+        runs = _MASK_RUNS.get(key)
+        if runs is not None:
+            return path, _decode_runs(runs)
+
+        mask = decode_mask(data)
+        _MASK_RUNS.put(key, _encode_runs(mask))
+        return path, mask
+
+
+class ImageInfo(NamedTuple):
+    # width, height, and mode are None if the header could not be parsed, e.g. for
+    # corrupt images or formats other than JPEG and PNG. mode follows PIL.
+    width: Optional[int]
+    height: Optional[int]
+    mode: Optional[str]
+    size: int
+
+
+_JPEG_SOF_MARKERS = {
+    0xC0,
+    0xC1,
+    0xC2,
+    0xC3,
+    0xC5,
+    0xC6,
+    0xC7,
+    0xC9,
+    0xCA,
+    0xCB,
+    0xCD,
+    0xCE,
+    0xCF,
+}
+_JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_MODES = {2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+_PNG_GRAYSCALE_MODES = {1: "1", 2: "L", 4: "L", 8: "L", 16: "I;16"}
+
+
+def _probe_jpeg(stream: Any) -> Optional[Tuple[int, int, str]]:
+    while True:
+        byte = stream.read(1)
+        # Markers can be padded with any number of 0xFF bytes
+        while byte == b"\xff":
+            byte = stream.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # standalone markers without a segment
+            continue
+        elif marker in (0xD9, 0xDA):
+            # end of image or start of scan before the frame header
+            return None
+
+        header = stream.read(2)
+        if len(header) < 2:
+            return None
+        (length,) = struct.unpack(">H", header)
+        if marker not in _JPEG_SOF_MARKERS:
+            stream.seek(length - 2, io.SEEK_CUR)
+            if stream.read(1) != b"\xff":
+                return None
+            continue
+
+        frame = stream.read(6)
+        if len(frame) < 6:
+            return None
+        _, height, width, num_components = struct.unpack(">BHHB", frame)
+        mode = _JPEG_MODES.get(num_components)
+        return (width, height, mode) if mode else None
+
+
+def _probe_png(stream: Any) -> Optional[Tuple[int, int, str]]:
+    chunk = stream.read(18)
+    if len(chunk) < 18 or chunk[4:8] != b"IHDR":
+        return None
+
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", chunk[8:])
+    if color_type == 0:
+        mode = _PNG_GRAYSCALE_MODES.get(bit_depth)
+    else:
+        mode = _PNG_MODES.get(color_type)
+    return (width, height, mode) if mode else None
+
+
+def probe_image(data: Any) -> ImageInfo:
+    # Only reads the header of the image, e.g. to filter or to bucket by the aspect
+    # ratio before decoding. The position of the stream is restored afterwards.
+    if isinstance(data, memoryview):
+        stream = _ViewReader(data)
+    elif isinstance(data, (bytes, bytearray)):
+        stream = io.BytesIO(data)
+    else:
+        stream = data
+
+    position = stream.tell()
+    try:
+        size = _stream_size(stream)
+        if size is None:
+            size = stream.seek(0, io.SEEK_END)
+            stream.seek(position)
+
+        signature = stream.read(8)
+        if signature[:2] == b"\xff\xd8":
+            stream.seek(position + 2)
+            dimensions = _probe_jpeg(stream)
+        elif signature == _PNG_SIGNATURE:
+            dimensions = _probe_png(stream)
+        else:
+            dimensions = None
+    except (OSError, ValueError, struct.error):
+        dimensions = None
+    finally:
+        stream.seek(position)
+
+    if dimensions is None:
+        return ImageInfo(None, None, None, size)
+    return ImageInfo(*dimensions, size)
+
+
+class _ArchiveCache:
+    # Results per member of an archive that are remembered across processes. The file
+    # name includes the size and modification time of the archive, so any change
+    # invalidates the entries. The values have to be JSON serializable. Only the
+    # entries of the most recently used archives are kept in memory.
+    def __init__(self, name: str, *, maxsize: int = 8) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self._entries: "collections.OrderedDict[str, Dict[str, Any]]" = (
+            collections.OrderedDict()
+        )
+
+    def _file(self, archive: str) -> pathlib.Path:
+        stat = os.stat(archive)
+        key = f"{os.path.abspath(archive)}:{stat.st_size}:{stat.st_mtime_ns}"
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return _CACHE_DIR / self.name / f"{name}.json"
+
+    def __getitem__(self, archive: str) -> Dict[str, Any]:
+        entries = self._entries.get(archive)
+        if entries is None:
+            try:
+                with open(self._file(archive)) as fh:
+                    entries = json.load(fh)
+            except (OSError, ValueError):
+                entries = {}
+            self._entries[archive] = entries
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(archive)
+        return entries
+
+    def store(self, archive: str, entries: Dict[str, Any]) -> None:
+        # The entries are passed explicitly, since they might have been evicted from
+        # memory in the meantime
+        try:
+            file = self._file(archive)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_name(f"{file.name}.{os.getpid()}")
+            with open(tmp, "w") as fh:
+                json.dump(entries, fh)
+            os.replace(tmp, file)
+        except OSError:
+            # The cache is only an optimization
+            pass
+
+
+# The probes are keyed by the offset of the member in the archive
+_PROBES = _ArchiveCache("probes")
+
+
+class ProbeImages(IterDataPipe):
+    # Replaces the image of every (path, image) pair by its ImageInfo. Members of
+    # archives that were probed before are looked up in the cache, so their data is
+    # not read at all.
+    def __init__(
+        self, datapipe: Iterable[Tuple[str, Any]], *, cache: bool = True
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.cache = cache
+
+    def __iter__(self) -> Iterator[Tuple[str, ImageInfo]]:
+        # The members of an archive are read in one go. Thus, the new probes of an
+        # archive are stored as soon as the next one starts rather than holding on to
+        # the probes of all archives until the end.
+        archive: Optional[str] = None
+        probes: Dict[str, Any] = {}
+        modified = False
+        try:
+            for path, data in self.datapipe:
+                if not (self.cache and isinstance(data, MemberRef)):
+                    yield path, probe_image(data)
+                    continue
+
+                if data.archive != archive:
+                    if modified:
+                        _PROBES.store(archive, probes)  # type: ignore[arg-type]
+                    archive, probes, modified = (
+                        data.archive,
+                        _PROBES[data.archive],
+                        False,
+                    )
+                key = str(data.offset)
+                if key not in probes:
+                    probes[key] = tuple(probe_image(data))
+                    modified = True
+                yield path, ImageInfo(*probes[key])
+        finally:
+            if modified:
+                _PROBES.store(archive, probes)  # type: ignore[arg-type]
+
+
+class VideoIndex(NamedTuple):
+    # Built by demuxing the video without decoding any frame. pts holds the
+    # presentation timestamp of every frame in presentation order and keyframes the
+    # indices of the frames a decoder can start from.
+    num_frames: int
+    fps: float
+    pts: List[int]
+    keyframes: List[int]
+
+
+class Clip(NamedTuple):
+    # video is a uint8 tensor of shape (T, H, W, C) like torchvision.io.read_video
+    video: Any
+    frames: List[int]
+    fps: float
+
+
+def _index_video(data: bytes) -> VideoIndex:
+    import av
+
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.video[0]
+        packets = []
+        for packet in container.demux(stream):
+            timestamp = packet.pts if packet.pts is not None else packet.dts
+            # the demuxer emits an empty packet at the end of the stream
+            if timestamp is None or packet.size == 0:
+                continue
+            packets.append((timestamp, packet.is_keyframe))
+        fps = float(stream.average_rate or stream.guessed_rate or 0)
+
+    packets.sort()
+    return VideoIndex(
+        num_frames=len(packets),
+        fps=fps,
+        pts=[timestamp for timestamp, _ in packets],
+        keyframes=[idx for idx, (_, keyframe) in enumerate(packets) if keyframe],
+    )
+
+
+def _decode_clip(data: bytes, index: VideoIndex, frames: List[int]) -> Clip:
+    import av
+    import numpy as np
+    import torch
+
+    # We seek to the last keyframe before the clip. The decoder might land on an
+    # earlier keyframe or skip broken frames. Thus, the decoded frames are matched
+    # to the index by their timestamp rather than by their position.
+    position = bisect.bisect_right(index.keyframes, frames[0]) - 1
+    start = index.keyframes[position] if position >= 0 else 0
+    wanted = {index.pts[idx]: idx for idx in frames}
+    last = index.pts[frames[-1]]
+    decoded: Dict[int, Any] = {}
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.video[0]
+        if start > 0:
+            container.seek(index.pts[start], stream=stream, backward=True)
+        for frame in container.decode(stream):
+            # Like the index, we fall back to the decoding timestamp, e.g. for AVI
+            timestamp = (
+                frame.pts if frame.pts is not None else getattr(frame, "dts", None)
+            )
+            if timestamp is None:
+                raise ValueError("Unable to match decoded frames without timestamps")
+            idx = wanted.get(timestamp)
+            if idx is not None:
+                decoded[idx] = frame.to_ndarray(format="rgb24")
+            if timestamp >= last:
+                break
+
+    missing = [idx for idx in frames if idx not in decoded]
+    if missing:
+        raise ValueError(
+            f"The frames {missing} of the clip could not be decoded, "
+            f"although they are in the index of the video"
+        )
+
+    video = torch.from_numpy(np.stack([decoded[idx] for idx in frames]))
+    return Clip(video=video, frames=frames, fps=index.fps)
+
+
+class UniformClipSampler:
+    # num_clips clips of clip_length frames that are evenly spaced over the video.
+    # Videos that are shorter than a single clip are skipped.
+    def __init__(self, num_clips: int, clip_length: int, *, stride: int = 1) -> None:
+        self.num_clips = num_clips
+        self.clip_length = clip_length
+        self.stride = stride
+
+    def _clip(self, start: int) -> List[int]:
+        return list(range(start, start + self.clip_length * self.stride, self.stride))
+
+    def _max_start(self, index: VideoIndex) -> int:
+        return index.num_frames - (self.clip_length - 1) * self.stride - 1
+
+    def __call__(self, path: str, index: VideoIndex) -> List[List[int]]:
+        max_start = self._max_start(index)
+        if max_start < 0:
+            return []
+        elif self.num_clips == 1:
+            return [self._clip(max_start // 2)]
+
+        return [
+            self._clip(round(idx * max_start / (self.num_clips - 1)))
+            for idx in range(self.num_clips)
+        ]
+
+
+class RandomClipSampler(UniformClipSampler):
+    # The clips of a video only depend on the seed, the epoch, and the path. Thus, they
+    # do not change when the iteration is resumed or the videos are distributed
+    # differently. Call set_epoch() to draw new clips.
+    def __init__(
+        self, num_clips: int, clip_length: int, *, stride: int = 1, seed: int = 0
+    ) -> None:
+        super().__init__(num_clips, clip_length, stride=stride)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __call__(self, path: str, index: VideoIndex) -> List[List[int]]:
+        max_start = self._max_start(index)
+        if max_start < 0:
+            return []
+
+        rng = random.Random(f"{self.seed}:{self.epoch}:{path}")
+        starts = sorted(rng.randint(0, max_start) for _ in range(self.num_clips))
+        return [self._clip(start) for start in starts]
+
+
+# The indices are keyed by the path of the video relative to the archive on disk
+_VIDEO_INDICES = _ArchiveCache("videos")
+
+
+def _file_on_disk(path: str) -> Optional[str]:
+    # Members of (nested) archives have the path of the archive on disk as prefix
+    while not os.path.isfile(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
+
+class DecodeClips(IterDataPipe):
+    # Decodes only the frames of the clips that the sampler picks from the index of a
+    # video instead of the whole video. Thus, the cost of an epoch scales with the
+    # number of clips rather than with the length of the videos. The index is cached
+    # per archive. With num_threads, the clips of a video are decoded in parallel.
+    def __init__(
+        self,
+        datapipe: Iterable[Tuple[str, Any]],
+        sampler: Callable[[str, VideoIndex], List[List[int]]],
+        *,
+        num_threads: int = 0,
+        cache: bool = True,
+    ) -> None:
+        super().__init__()
+        self.datapipe = datapipe
+        self.sampler = sampler
+        self.num_threads = num_threads
+        self.cache = cache
+
+        self._input = ResumableInput(datapipe)
+        self._position: Optional[int] = None
+        self._resume: Optional[Dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Tuple[str, Clip]]:
+        state, self._resume = self._resume, None
+        # The modified indices are kept until they are stored, even if the cache
+        # evicted them in the meantime
+        modified: Dict[str, Dict[str, Any]] = {}
+        pending: Deque[concurrent.futures.Future] = collections.deque()
+        executor = (
+            concurrent.futures.ThreadPoolExecutor(self.num_threads)
+            if self.num_threads
+            else None
+        )
+        try:
+            for (path, stream), position in self._input.iterate(state):
+                self._position = None
+                data = stream.read()
+                index = self._index(path, data, modified)
+
+                # The position is the index of the last clip yielded from this video
+                start = 0 if position is None else position + 1
+                clips = self.sampler(path, index)[start:]
+                decode = functools.partial(_decode_clip, data, index)
+                if executor is not None:
+                    pending.extend(executor.submit(decode, clip) for clip in clips)
+                    decoded: Iterator[Clip] = (
+                        pending.popleft().result() for _ in range(len(clips))
+                    )
+                else:
+                    decoded = map(decode, clips)
+
+                for idx, clip in enumerate(decoded, start):
+                    self._position = idx
+                    yield path, clip
+        finally:
+            # If the consumer stops early, the clips that are not decoded yet are
+            # cancelled and the running decodes are waited for, so no thread outlives
+            # the iteration
+            for future in pending:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True)
+            for archive, indices in modified.items():
+                _VIDEO_INDICES.store(archive, indices)
+
+    def _index(
+        self, path: str, data: bytes, modified: Dict[str, Dict[str, Any]]
+    ) -> VideoIndex:
+        archive = _file_on_disk(path) if self.cache else None
+        if archive is None:
+            return _index_video(data)
+
+        indices = _VIDEO_INDICES[archive]
+        key = os.path.relpath(path, archive)
+        if key not in indices:
+            indices[key] = tuple(_index_video(data))
+            modified[archive] = indices
+        return VideoIndex(*indices[key])
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self._resume or self._input.state_dict(self._position)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._resume = state
+
+
+_SORTED_BY = b"datapipes.sorted_by"
+
+
+def write_table(
+    rows: Iterable[Dict[str, Any]],
+    path: Union[str, pathlib.Path],
+    *,
+    key: str = "sample_id",
+    schema: Any = None,
+    batch_size: int = 65536,
+) -> pathlib.Path:
+    # Writes flat annotation rows as Arrow IPC file or, if the path ends in .parquet,
+    # as Parquet file. The rows are converted in batches, so they never have to be in
+    # memory at the same time. Unless a pyarrow.Schema is passed, the schema is
+    # inferred from the first batch. The rows are sorted by the key column, so
+    # AnnotationTable can binary search it in place.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if schema is not None and key not in schema.names:
+        raise ValueError(f"The schema has no key column {key!r}")
+
+    path = pathlib.Path(path)
+    parquet = path.suffix == ".parquet"
+    if parquet:
+        import pyarrow.parquet as pq
+
+    # The rows are written unsorted first. Afterwards, only the key column and the
+    # sort order are held in memory, while the rows are copied batch by batch.
+    unsorted = path.with_name(f"{path.name}.{os.getpid()}.unsorted")
+    tmp = path.with_name(f"{path.name}.{os.getpid()}")
+    writer = None
+    iterator = iter(rows)
+    try:
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch and writer is not None:
+                break
+            elif not batch and schema is None:
+                # Nothing to infer the schema from. The table only gets the key
+                # column, so every lookup simply finds no rows.
+                schema = pa.schema([(key, pa.null())])
+
+            record_batch = pa.RecordBatch.from_pylist(batch, schema=schema)
+            if writer is None:
+                schema = record_batch.schema
+                writer = pa.ipc.new_file(str(unsorted), schema)
+            writer.write_batch(record_batch)
+        writer.close()
+        writer = None
+
+        table = pa.ipc.open_file(pa.memory_map(str(unsorted))).read_all()
+        order = pc.sort_indices(table, sort_keys=[(key, "ascending")])
+        schema = table.schema.with_metadata({_SORTED_BY: key.encode()})
+        writer = (
+            pq.ParquetWriter(str(tmp), schema)
+            if parquet
+            else pa.ipc.new_file(str(tmp), schema)
+        )
+        for offset in range(0, table.num_rows, batch_size):
+            writer.write_table(table.take(order[offset : offset + batch_size]))
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        unsorted.unlink(missing_ok=True)
+
+    os.replace(tmp, path)
+    return path
+
+
+class _ColumnView:
+    # Sequence over the Python values of an Arrow column for the bisect module, which
+    # only converts the values that are actually compared
+    def __init__(self, column: Any) -> None:
+        self._column = column
+
+    def __len__(self) -> int:
+        return len(self._column)
+
+    def __getitem__(self, idx: int) -> Any:
+        return self._column[idx].as_py()
+
+
+class AnnotationTable:
+    # Memory maps a table written by write_table. The columns of an Arrow IPC file are
+    # used in place, so the pages are shared by all processes that load the same file,
+    # e.g. the DataLoader workers. Pickling only transfers the path. Parquet files
+    # are memory mapped as well, but have to be decoded into every process. The rows
+    # of a key are found by binary searching the sorted key column, so no process
+    # builds an index of its own.
+    def __init__(self, path: Union[str, pathlib.Path], *, key: str = "sample_id"):
+        self.path = pathlib.Path(path)
+        self.key = key
+        self._table: Any = None
+
+    @property
+    def table(self) -> Any:
+        # the pyarrow.Table
+        if self._table is None:
+            import pyarrow as pa
+
+            if self.path.suffix == ".parquet":
+                import pyarrow.parquet as pq
+
+                table = pq.read_table(str(self.path), memory_map=True)
+            else:
+                source = pa.memory_map(str(self.path))
+                table = pa.ipc.open_file(source).read_all()
+
+            sorted_by = (table.schema.metadata or {}).get(_SORTED_BY)
+            if sorted_by != self.key.encode():
+                raise ValueError(
+                    f"{self.path} is not sorted by {self.key}. "
+                    f"Write it with write_table(..., key={self.key!r})."
+                )
+            self._table = table
+        return self._table
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def _keys(self) -> _ColumnView:
+        # Nulls are sorted to the end and are never looked up
+        column = self.table.column(self.key)
+        return _ColumnView(column.slice(0, len(column) - column.null_count))
+
+    def _rows(self, key: Any) -> Tuple[int, int]:
+        keys = self._keys()
+        try:
+            start = bisect.bisect_left(keys, key)
+        except TypeError:
+            # Like a dict, a key of another type is simply not found
+            return 0, 0
+        stop = bisect.bisect_right(keys, key, lo=start)
+        return start, stop
+
+    def keys(self) -> Iterator[Any]:
+        # The column is converted chunk by chunk rather than at once
+        previous: Any = object()
+        for chunk in self.table.column(self.key).chunks:
+            for key in chunk.to_pylist():
+                if key is not None and key != previous:
+                    yield key
+                previous = key
+
+    def __contains__(self, key: Any) -> bool:
+        start, stop = self._rows(key)
+        return stop > start
 
-                inner_path = str(pathlib.Path(path) / info.filename)
+    def __getitem__(self, key: Any) -> List[Dict[str, Any]]:
+        # All rows of a sample, e.g. one for every object of an image. The slice does
+        # not copy the table.
+        start, stop = self._rows(key)
+        if start == stop:
+            raise KeyError(key)
+        return self.table.slice(start, stop - start).to_pylist()
 
-                file_obj = rar.open(info)
-                file_obj.source_rar = rar
+    def __getstate__(self) -> Dict[str, Any]:
+        return dict(path=self.path, key=self.key)
 
-                yield inner_path, file_obj
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["path"], key=state["key"])  # type: ignore[misc]
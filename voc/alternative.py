@@ -1,19 +1,13 @@
 import collections
-import io
 import pathlib
-import sys
-from typing import Any, Dict, Tuple, Union, Optional
+from typing import Any, Dict, Union, Optional
 import xml.etree.ElementTree as ET
 
-import torch.utils.data.datapipes as dp
 from torch.utils.data.datapipes.utils.decoder import imagehandler, Decoder
 
+from utils import ReadLineFromFile, decode_mask
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import ReadLineFromFile
-
-SPLIT_FOLDER = dict(detection="Main", segmentation="Segmentation")
-TARGET_TYPE_FOLDER = dict(detection="Annotations", segmentation="SegmentationClass")
+from voc.main import _members
 
 
 class VOC:
@@ -25,66 +19,38 @@ class VOC:
         split: str = "train",
         target_type: str = "detection",  # segmentation
         decoder: Optional[str] = "pil",
+        verify: bool = False,
     ):
         self.target_type = target_type
         self.decoder = Decoder([imagehandler(decoder)]) if decoder else None
 
-        root = pathlib.Path(root).resolve()
-        # TODO: make this variable based on the input
-        archive = "VOCtrainval_11-May-2012.tar"
-
-        split_folder = SPLIT_FOLDER[target_type]
-        target_type_folder = TARGET_TYPE_FOLDER[target_type]
-
-        datapipe = (str(root / archive),)
-        datapipe = dp.iter.LoadFilesFromDisk(datapipe)
-        datapipe = dp.iter.ReadFilesFromTar(datapipe)
-
-        split_files: Dict[str, Tuple[str, io.BufferedIOBase]] = {}
-        self.images: Dict[str, Tuple[str, io.BufferedIOBase]] = {}
-        self.targets: Dict[str, Tuple[str, io.BufferedIOBase]] = {}
-
-        for data in datapipe:
-            parent_ = pathlib.Path(data[0]).parent
-            parent = parent_.name
-            grand_parent = parent_.parent.name
-
-            if grand_parent == "ImageSets" and parent == split_folder:
-                dct = split_files
-            elif parent == "JPEGImages":
-                dct = self.images
-            elif parent == target_type_folder:
-                dct = self.targets
-            else:
-                continue
+        # The archive is only scanned once. Afterwards, every process, e.g. a
+        # DataLoader worker, memory maps the index from the cache.
+        self.members = _members(root, target_type=target_type, verify=verify)
 
-            dct[self._data_to_key(data)] = data
+        self.keys = ReadLineFromFile((self.members[f"split/{split}"],))
 
-        self.keys = ReadLineFromFile((split_files[split],))
+    def state_dict(self) -> Dict[str, Any]:
+        return self.keys.state_dict()
 
-    @staticmethod
-    def _data_to_key(data: Tuple[str, Any]) -> str:
-        return pathlib.Path(data[0]).stem
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.keys.load_state_dict(state)
 
     def __iter__(self):
         for _, key in self.keys:
-            image_data = self.images[key]
+            image_data = self.members[f"image/{key}"]
             image_path = image_data[0]
             image = (
                 self.decoder(image_data)[image_path] if self.decoder else image_data[1]
             )
 
-            target_data = self.targets[key]
+            target_data = self.members[f"target/{key}"]
             target_path = target_data[0]
             if self.target_type == "detection":
                 target_ = self._parse_voc_xml(ET.parse(target_data[1]).getroot())
                 target = target_["annotation"]["object"]
             else:  # self.target_type == "segmentation":
-                target = (
-                    self.decoder(target_data)[target_path]
-                    if self.decoder
-                    else target_data[1]
-                )
+                target = decode_mask(target_data[1]) if self.decoder else target_data[1]
 
             yield dict(
                 image_path=image_path,
@@ -117,5 +83,5 @@ class VOC:
 
 
 if __name__ == "__main__":
-    for sample in VOC("."):
+    for sample in VOC(pathlib.Path(__file__).parent):
         pass
@@ -1,17 +1,47 @@
 import collections
 import functools
 import pathlib
-import sys
-from typing import Any, Dict, Tuple, Union, Iterable, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    Tuple,
+    Union,
+    Iterable,
+    Iterator,
+    Optional,
+)
 import xml.etree.ElementTree as ET
 
 import torch.utils.data.datapipes as dp
 from torch.utils.data.datapipes.utils.decoder import imagehandler
 
-
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-from utils import DependentGroupByKey, SplitByKey, ReadLineFromFile, collate_sample
-
+from utils import (
+    aiterate,
+    DecodeMasks,
+    DependentGroupByKey,
+    Drop,
+    DropByPath,
+    ImageInfo,
+    MemberPath,
+    ProbeImages,
+    SplitByKey,
+    ReadLineFromFile,
+    ReadFilesFromArchive,
+    Sample,
+    pipeline_state_dict,
+    load_pipeline_state_dict,
+    member_path,
+    MemberIndex,
+    optimize,
+    ReadFilesFromTar,
+    shared,
+    Verify,
+)
+
+MD5S = {"VOCtrainval_11-May-2012.tar": "6cd6e144f989b92b3379bac3b3de84fd"}
 
 SPLIT_FOLDER = dict(detection="Main", segmentation="Segmentation")
 TARGET_TYPE_FOLDER = dict(detection="Annotations", segmentation="SegmentationClass")
@@ -26,33 +56,139 @@ class VOC:
         split: str = "train",
         target_type: str = "detection",  # segmentation
         decoder: Optional[str] = "pil",
+        verify: bool = False,
     ):
+        self.root = pathlib.Path(root)
+        self.year = year
+        self.split = split
+        self.target_type = target_type
+
         archive_datapipe = _make_archive_datapipe(
-            root, year=year, split=split, target_type=target_type
+            root, year=year, split=split, target_type=target_type, verify=verify
         )
 
         split_datapipe = _make_split_datapipe(
             archive_datapipe["split"], target_type=target_type, split=split
         )
 
+        # Images and targets outside of the split are dropped before they are decoded.
+        # Otherwise, they would be buffered by DependentGroupByKey until the end.
+        # The keys are looked up in the cached member index rather than scanning the
+        # archive a second time. The archive itself is verified while it is iterated.
+        not_in_split = functools.partial(
+            _not_in_split,
+            keys=_read_split_keys(_members(root, target_type=target_type), split=split),
+        )
         image_datapipe = _make_image_datapipe(
-            archive_datapipe["image"], decoder=decoder
+            DropByPath(archive_datapipe["image"], not_in_split), decoder=decoder
         )
         target_datapipe = _make_target_datapipe(
-            archive_datapipe["target"], target_type=target_type, decoder=decoder
+            DropByPath(archive_datapipe["target"], not_in_split),
+            target_type=target_type,
+            decoder=decoder,
         )
 
         datapipe = DependentGroupByKey(
             split_datapipe, image_datapipe, target_datapipe, key_fn=_group_key_fn
         )
-        self.datapipe = dp.iter.Map(datapipe, collate_sample)
+        datapipe = dp.iter.Map(
+            datapipe,
+            _collate_sample,
+            fn_kwargs=dict(sample_type=SAMPLE_TYPE[target_type]),
+        )
+        # The split files and all other folders of the archive are not consumed by any
+        # branch. Thus, they are dropped right away instead of being buffered.
+        self.datapipe = optimize(datapipe)
 
-    def __iter__(self):
+    def __iter__(self) -> Iterator[Sample]:
         yield from self.datapipe
 
+    def __aiter__(self) -> AsyncIterator[Sample]:
+        # The images and targets are read and decoded at the same time
+        return aiterate(self.datapipe)
+
+    def metadata(self, *, probe: bool = False) -> Iterator[Dict[str, Any]]:
+        # Only the split files and the images are visited and the targets are skipped.
+        # With probe, the headers of the images of the split are read as well.
+        archive_datapipe = _make_archive_datapipe(
+            self.root,
+            year=self.year,
+            split=self.split,
+            target_type=self.target_type,
+            filter_fn=_is_split_or_image,
+        )
+        keys = {
+            key
+            for _, key in _make_split_datapipe(
+                archive_datapipe["split"],
+                target_type=self.target_type,
+                split=self.split,
+            )
+        }
+
+        datapipe: Iterable = Drop(
+            archive_datapipe["image"], lambda data: _path_to_key(data[0]) not in keys
+        )
+        if probe:
+            datapipe = ProbeImages(datapipe)
+        for path, info in datapipe:
+            sample = dict(image_path=path, size=info.size)
+            if isinstance(info, ImageInfo):
+                sample.update(info._asdict())
+            yield sample
+
+    def annotations(self) -> Iterator[Dict[str, Any]]:
+        # One flat row per object of the images in the split for utils.write_table,
+        # keyed by the image id. Only the split file and the XML files are read.
+        archive_datapipe = _make_archive_datapipe(
+            self.root,
+            year=self.year,
+            split=self.split,
+            target_type="detection",
+            filter_fn=_is_split_or_annotation,
+        )
+        keys = {
+            key
+            for _, key in _make_split_datapipe(
+                archive_datapipe["split"],
+                target_type=self.target_type,
+                split=self.split,
+            )
+        }
+
+        for path, xml in archive_datapipe["target"]:
+            key = _path_to_key(path)
+            if key not in keys:
+                continue
+
+            annotation = parse_voc_xml(ET.parse(xml).getroot())["annotation"]
+            for obj in annotation["object"]:
+                row = dict(sample_id=key, name=obj["name"], pose=obj.get("pose"))
+                row.update(
+                    (flag, int(obj[flag]) if flag in obj else None)
+                    for flag in ("truncated", "difficult")
+                )
+                row.update(
+                    (coordinate, int(float(value)))
+                    for coordinate, value in obj["bndbox"].items()
+                )
+                yield row
+
+    def state_dict(self) -> Dict[str, Any]:
+        return pipeline_state_dict(self.datapipe)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        load_pipeline_state_dict(self.datapipe, state)
+
 
 def _make_archive_datapipe(
-    root: Union[str, pathlib.Path], *, year: str, split: str, target_type: str
+    root: Union[str, pathlib.Path],
+    *,
+    year: str,
+    split: str,
+    target_type: str,
+    verify: bool = False,
+    filter_fn: Optional[Callable[[MemberPath], bool]] = None,
 ) -> SplitByKey:
     root = pathlib.Path(root).resolve()
     # TODO: make this variable based on the input
@@ -60,7 +196,9 @@ def _make_archive_datapipe(
 
     datapipe = (str(root / archive),)
     datapipe = dp.iter.LoadFilesFromDisk(datapipe)
-    datapipe = dp.iter.ReadFilesFromTar(datapipe)
+    if verify:
+        datapipe = Verify(datapipe, MD5S)
+    datapipe = ReadFilesFromArchive(datapipe, filter_fn=filter_fn)
     datapipe = SplitByKey(
         datapipe, key_fn=functools.partial(_split_key_fn, target_type=target_type)
     )
@@ -71,13 +209,62 @@ def _make_split_datapipe(
     datapipe, *, target_type: str, split: str
 ) -> Iterable[Tuple[str, str]]:
     for data in datapipe:
-        path = pathlib.Path(data[0])
-        if path.parent.name == SPLIT_FOLDER[target_type] and path.stem == split:
+        path = member_path(data[0])
+        if path.parents[0] == SPLIT_FOLDER[target_type] and path.stem == split:
             return ReadLineFromFile((data,))
     else:
         raise RuntimeError
 
 
+def _index_archive(
+    archive: pathlib.Path, *, target_type: str, verify: bool
+) -> MemberIndex:
+    datapipe: Iterable = (str(archive),)
+    datapipe = dp.iter.LoadFilesFromDisk(datapipe)
+    if verify:
+        datapipe = Verify(datapipe, MD5S)
+    datapipe = ReadFilesFromTar(datapipe)
+
+    # The index only stores where the members are located in the archive rather
+    # than keeping an open stream for every one of them. The keys are prefixed
+    # with the kind of the member.
+    members = MemberIndex()
+    for data in datapipe:
+        kind = _split_key_fn(data, target_type=target_type)
+        if kind is None:
+            continue
+        elif kind == "split" and _split_folder(data[0]) != SPLIT_FOLDER[target_type]:
+            continue
+
+        members.add(f"{kind}/{_path_to_key(data[0])}", *data)
+
+    return members
+
+
+def _members(
+    root: Union[str, pathlib.Path], *, target_type: str, verify: bool = False
+) -> MemberIndex:
+    root = pathlib.Path(root).resolve()
+    # TODO: make this variable based on the input
+    archive = "VOCtrainval_11-May-2012.tar"
+
+    # The archive is only scanned once. Afterwards, every process, e.g. a
+    # DataLoader worker, memory maps the index from the cache.
+    return shared(
+        "voc",
+        (root / archive,),
+        lambda: _index_archive(root / archive, target_type=target_type, verify=verify),
+        target_type=target_type,
+        verify=verify,
+    )
+
+
+def _read_split_keys(members: MemberIndex, *, split: str) -> FrozenSet[str]:
+    # The split file is read straight from its location in the cached index instead
+    # of scanning the headers of the archive for it
+    return frozenset(key for _, key in ReadLineFromFile((members[f"split/{split}"],)))
+
+
 def _make_image_datapipe(
     datapipe: Iterable, *, decoder: Optional[str]
 ) -> Iterable[Tuple[str, Dict[str, Any]]]:
@@ -94,8 +281,10 @@ def _make_target_datapipe(
         # TODO
         collate = _collate_target_detection
     else:  # target_type == "segmentation":
+        # The masks are always decoded to the (H, W) class indices of the palette
+        # independent of the image decoder
         if decoder:
-            datapipe = dp.iter.RoutedDecoder(datapipe, handlers=[imagehandler(decoder)])
+            datapipe = DecodeMasks(datapipe)
 
         collate = _collate_target_segmentation
     datapipe = dp.iter.Map(datapipe, collate)
@@ -103,33 +292,49 @@ def _make_target_datapipe(
 
 
 def _split_key_fn(data: Tuple[str, Any], *, target_type: str) -> Optional[str]:
-    path = pathlib.Path(data[0])
+    parents = member_path(data[0]).parents
 
-    if path.parent.parent.name == "ImageSets":
+    if parents[1] == "ImageSets":
         return "split"
-    elif path.parent.name == "JPEGImages":
+    elif parents[0] == "JPEGImages":
         return "image"
-    elif path.parent.name == TARGET_TYPE_FOLDER[target_type]:
+    elif parents[0] == TARGET_TYPE_FOLDER[target_type]:
         return "target"
 
 
+def _split_folder(path: str) -> str:
+    return member_path(path).parents[0]
+
+
+def _not_in_split(path: MemberPath, *, keys: FrozenSet[str]) -> bool:
+    return path.stem not in keys
+
+
+def _is_split_or_image(path: MemberPath) -> bool:
+    return path.parents[1] == "ImageSets" or path.parents[0] == "JPEGImages"
+
+
+def _is_split_or_annotation(path: MemberPath) -> bool:
+    return path.parents[1] == "ImageSets" or path.parents[0] == "Annotations"
+
+
 def _group_key_fn(data: Tuple[str, str]):
     return data[1]
 
 
 def _path_to_key(path: str) -> str:
-    return pathlib.Path(path).stem
+    return member_path(path).stem
 
 
-def _collate_image(data: Tuple[str, Any]) -> Tuple[str, Dict[str, Any]]:
+def _collate_image(data: Tuple[str, Any]) -> Tuple[str, str, Any]:
     path, image = data
-    return _path_to_key(path), dict(image_path=path, image=image)
+    return _path_to_key(path), path, image
 
 
-def _collate_target_detection(data: Tuple) -> Tuple:
+def _collate_target_detection(data: Tuple) -> Tuple[str, str, Any]:
     path, xml = data
     target = parse_voc_xml(ET.parse(xml).getroot())["annotation"]["object"]
-    return _path_to_key(path), dict(target_path=path, target=target)
+    return _path_to_key(path), path, target
 
 
 # straight outta torchvision.datasets
@@ -153,11 +358,45 @@ def parse_voc_xml(node: ET.Element) -> Dict[str, Any]:
     return voc_dict
 
 
-def _collate_target_segmentation(data: Tuple) -> Tuple:
+def _collate_target_segmentation(data: Tuple) -> Tuple[str, str, Any]:
     path, seg = data
-    return _path_to_key(path), dict(seg_path=path, seg=seg)
+    return _path_to_key(path), path, seg
+
+
+class VOCDetectionSample(Sample):
+    __slots__ = ("image_path", "image", "target_path", "target")
+
+    def __init__(
+        self, image_path: str, image: Any, target_path: str, target: Any
+    ) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.target_path = target_path
+        self.target = target
+
+
+class VOCSegmentationSample(Sample):
+    __slots__ = ("image_path", "image", "seg_path", "seg")
+
+    def __init__(self, image_path: str, image: Any, seg_path: str, seg: Any) -> None:
+        self.image_path = image_path
+        self.image = image
+        self.seg_path = seg_path
+        self.seg = seg
+
+
+SAMPLE_TYPE = dict(detection=VOCDetectionSample, segmentation=VOCSegmentationSample)
+
+
+def _collate_sample(
+    data: Tuple[Tuple[str, str], Tuple[str, str, Any], Tuple[str, str, Any]],
+    *,
+    sample_type: Callable[[str, Any, str, Any], Sample],
+) -> Sample:
+    _, (_, image_path, image), (_, target_path, target) = data
+    return sample_type(image_path, image, target_path, target)
 
 
 if __name__ == "__main__":
-    for sample in VOC("."):
+    for sample in VOC(pathlib.Path(__file__).parent):
         pass